@@ -1,15 +1,95 @@
-from io import BytesIO
-from typing import Optional
+import asyncio
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, BinaryIO, List, Literal, Optional, Tuple, Union
 
-from PIL import Image
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import (
+    Body,
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Query,
+    UploadFile,
+    File,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
 from loguru import logger
+from PIL import Image
 
-from .infer import InferClient
-from .infer.error import LoadError, FileSizeMismatchError, DownloadError
+from .files import check_size, is_archive, iter_archive, open_image
+from .infer import (
+    METRICS,
+    InferClient,
+    OnnxRuntimeManager,
+    PreprocessPool,
+    RESULT_FIELDS,
+    ProbabilityStore,
+    ResultCache,
+)
+from .infer.metrics import UPLOAD_READ_SECONDS
+from .infer.error import (
+    LoadError,
+    FileSizeMismatchError,
+    DownloadError,
+    QueueFullError,
+    ImageTooLargeError,
+)
 from .settings import InferSettingCurrent
+from .values import all_wd_models
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
-app = FastAPI()
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    global _loader
+    # Connections are accepted while the model loads, /readyz tells when it is warm.
+    # A daemon thread, so shutdown never waits for a load retrying an unreachable hub
+    _stopping.clear()
+    _loader = threading.Thread(
+        target=_load_default_model, name="load-default-model", daemon=True
+    )
+    _loader.start()
+    yield
+    _stopping.set()
+
+
+app = FastAPI(lifespan=lifespan)
+_STARTED_AT = time.perf_counter()
+_load_error: Optional[str] = None
+# Seconds before loading the default model again after a failure, doubled up to the max
+LOAD_RETRY_DELAY = 1.0
+LOAD_RETRY_MAX_DELAY = 60.0
+_draining = threading.Event()
+# Set on shutdown or drain, ends the retries of the default model load
+_stopping = threading.Event()
+_loader: Optional[threading.Thread] = None
+_tag_result_warned = False
 
 
 def verify_token(token):
@@ -17,12 +97,332 @@ def verify_token(token):
     return True
 
 
+METRICS.enabled = InferSettingCurrent.metrics_enabled
+OnnxRuntimeManager.configure(**InferSettingCurrent.ort_options)
+RESULT_CACHE = (
+    ResultCache(
+        max_bytes=InferSettingCurrent.result_cache_max_mb * 1024 * 1024,
+        disk_path=InferSettingCurrent.result_cache_path,
+    )
+    if InferSettingCurrent.result_cache_enabled
+    else None
+)
+PROB_STORE = (
+    ProbabilityStore(
+        path=InferSettingCurrent.prob_store_path,
+        dtype=InferSettingCurrent.prob_store_dtype,
+        index_threshold=InferSettingCurrent.prob_store_index_threshold,
+    )
+    if InferSettingCurrent.prob_store_path
+    else None
+)
+# Started before any session, so the workers are forked without ORT threads
+PREPROCESS_POOL = (
+    PreprocessPool(workers=InferSettingCurrent.preprocess_workers)
+    if InferSettingCurrent.preprocess_workers > 0
+    else None
+)
 INFER_APP = InferClient(
     model_name=InferSettingCurrent.wd_model_name,
     model_dir=InferSettingCurrent.wd_model_dir,
     skip_auto_download=InferSettingCurrent.skip_auto_download,
+    max_workers=InferSettingCurrent.infer_workers,
+    max_queue_size=InferSettingCurrent.infer_queue_size,
+    max_batch_size=InferSettingCurrent.max_batch_size,
+    max_batch_wait_ms=InferSettingCurrent.max_batch_wait_ms,
+    memory_budget_mb=InferSettingCurrent.wd_model_memory_budget_mb,
+    result_cache=RESULT_CACHE,
+    preprocess_pool=PREPROCESS_POOL,
+    precision=InferSettingCurrent.wd_model_precision,
+    preload=False,
+    download_base_url=InferSettingCurrent.hf_endpoint,
+    download_connections=InferSettingCurrent.download_connections,
+    prob_store=PROB_STORE,
+    tile_overlap=InferSettingCurrent.tile_overlap,
+)
+
+
+def _load_default_model():
+    """
+    Load the default model, retried with backoff until it works or the server stops
+    """
+    global _load_error
+    delay = LOAD_RETRY_DELAY
+    while not INFER_APP.ready:
+        try:
+            INFER_APP.set_up(
+                model_name=InferSettingCurrent.wd_model_name,
+                model_dir=InferSettingCurrent.wd_model_dir,
+                skip_auto_download=InferSettingCurrent.skip_auto_download,
+            )
+        except Exception as e:
+            logger.exception(e)
+            _load_error = f"{type(e).__name__}: {e}"
+            logger.warning(f"Loading the default model again in {delay:.0f}s")
+            if _stopping.wait(delay):
+                return
+            delay = min(delay * 2, LOAD_RETRY_MAX_DELAY)
+    _load_error = None
+    logger.info(
+        f"Infer app init success in {time.perf_counter() - _STARTED_AT:.2f}s, "
+        f"model_path: {INFER_APP.model_path}"
+    )
+
+
+METRICS.gauge(
+    "wd_queue_pending",
+    "Requests admitted and not finished, running or queued",
+    lambda: INFER_APP.executor.pending,
+)
+METRICS.gauge(
+    "wd_queue_waiting",
+    "Requests waiting for a free worker",
+    lambda: INFER_APP.executor.queued,
+)
+METRICS.gauge(
+    "wd_model_load_seconds",
+    "Download, session creation and warm-up time of each loaded model",
+    lambda: {
+        model_name: entry.load_seconds
+        for model_name, entry in INFER_APP.registry.entries.items()
+    },
+    label="model",
+)
+METRICS.gauge(
+    "wd_model_loaded_bytes",
+    "Size of the loaded model files",
+    lambda: INFER_APP.registry.loaded_bytes,
+)
+if RESULT_CACHE is not None:
+    METRICS.gauge(
+        "wd_cache_hits_total",
+        "Result cache hits, from memory or disk",
+        lambda: RESULT_CACHE.hits + RESULT_CACHE.disk_hits,
+        kind="counter",
+    )
+    METRICS.gauge(
+        "wd_cache_misses_total",
+        "Result cache misses",
+        lambda: RESULT_CACHE.misses,
+        kind="counter",
+    )
+    METRICS.gauge(
+        "wd_cache_hit_rate",
+        "Result cache hits over lookups",
+        lambda: RESULT_CACHE.stats()["hit_rate"],
+    )
+METRICS.gauge(
+    "wd_process_max_rss_bytes",
+    "Peak resident memory of the process",
+    lambda: _max_rss_bytes(),
+)
+
+
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness, answers as long as the event loop runs, whatever the model state
+    """
+    return {
+        "status": "ok",
+        "model": INFER_APP.model_name,
+        "model_loaded": INFER_APP.ready,
+        "error": _load_error,
+        "draining": _draining.is_set(),
+    }
+
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness, 503 while the model loads, when the queue is full or while draining
+    """
+    executor = INFER_APP.executor
+    ready = INFER_APP.ready and not executor.full and not _draining.is_set()
+    content = {
+        "ready": ready,
+        "model": INFER_APP.model_name,
+        "model_loaded": INFER_APP.ready,
+        "error": _load_error,
+        "draining": _draining.is_set(),
+        "pending": executor.pending,
+        "capacity": executor.max_workers + executor.max_queue_size,
+        # Tells the workers of SERVER_WORKERS apart, they share the port
+        "pid": os.getpid(),
+    }
+    if INFER_APP.ready:
+        entry = INFER_APP.registry.entries.get(INFER_APP.model_name)
+        content["load_seconds"] = entry.load_seconds if entry is not None else None
+    return JSONResponse(status_code=200 if ready else 503, content=content)
+
+
+def drain(timeout: float, delay: float = 0.0) -> bool:
+    """
+    Stop taking new requests and wait for the admitted ones to finish, called on SIGTERM
+    :param timeout: Longest wait for running and queued inferences
+    :param delay: Keep failing /readyz this long first, so load balancers stop routing
+        here
+    :return: False if inferences were still running at the timeout
+    """
+    _draining.set()
+    _stopping.set()
+    logger.info(f"Draining, {INFER_APP.executor.pending} requests in flight")
+    time.sleep(delay)
+    deadline = time.monotonic() + timeout
+    while INFER_APP.executor.pending:
+        if time.monotonic() >= deadline:
+            logger.warning(
+                f"Drain timed out, {INFER_APP.executor.pending} requests dropped"
+            )
+            return False
+        time.sleep(0.05)
+    logger.info("Drained")
+    return True
+
+
+def is_draining() -> bool:
+    return _draining.is_set()
+
+
+def _check_accepting():
+    if _draining.is_set():
+        raise HTTPException(
+            status_code=503,
+            detail="Server is shutting down",
+            headers={"Retry-After": str(InferSettingCurrent.infer_retry_after)},
+        )
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        "pending": INFER_APP.executor.pending,
+        "queued": INFER_APP.executor.queued,
+        "loaded_bytes": INFER_APP.registry.loaded_bytes,
+        "models": {
+            model_name: {
+                "batch_sizes": dict(sorted(entry.scheduler.batch_sizes.items())),
+            }
+            for model_name, entry in INFER_APP.registry.entries.items()
+        },
+        "cache": RESULT_CACHE.stats() if RESULT_CACHE is not None else None,
+        "store": PROB_STORE.stats() if PROB_STORE is not None else None,
+        "max_rss_bytes": _max_rss_bytes(),
+        "pid": os.getpid(),
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    if not METRICS.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(
+        METRICS.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def _verify_admin(
+    authorization: Optional[str] = Header(None),
+    x_admin_token: Optional[str] = Header(None),
+):
+    """
+    The token comes in a header, query strings end up in the access log
+    """
+    admin_token = InferSettingCurrent.admin_token
+    if not admin_token:
+        raise HTTPException(
+            status_code=403, detail="Admin API is disabled, set ADMIN_TOKEN"
+        )
+    token = x_admin_token
+    if token is None and authorization is not None:
+        scheme, _, credentials = authorization.partition(" ")
+        if scheme.lower() == "bearer":
+            token = credentials.strip()
+    if token is None or not hmac.compare_digest(token, admin_token):
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+
+def _model_status() -> dict:
+    return {
+        "model": INFER_APP.model_name,
+        "previous": INFER_APP.previous_model_name,
+        "swap": dict(INFER_APP.swap_status),
+    }
+
+
+def _start_swap(func, model_name: str) -> dict:
+    if INFER_APP.swap_status["state"] in ("loading", "draining"):
+        raise HTTPException(status_code=409, detail="A model swap is already running")
+    INFER_APP.swap_status = {"state": "loading", "target": model_name, "error": None}
+
+    def swap():
+        try:
+            func(drain_timeout=InferSettingCurrent.drain_timeout)
+        except Exception as e:
+            logger.exception(e)
+
+    asyncio.get_running_loop().run_in_executor(None, swap)
+    return _model_status()
+
+
+@app.get("/admin/model", dependencies=[Depends(_verify_admin)])
+async def admin_model():
+    return _model_status()
+
+
+@app.post("/admin/model", status_code=202, dependencies=[Depends(_verify_admin)])
+async def admin_swap_model(model_name: str):
+    """
+    Load and warm up another default model in the background, then switch to it
+    and free the old one once its requests are done. Poll GET /admin/model for the
+    state.
+    """
+    if model_name not in all_wd_models:
+        raise HTTPException(status_code=400, detail=f"model must be in {all_wd_models}")
+    return _start_swap(
+        lambda drain_timeout: INFER_APP.swap_model(model_name, drain_timeout),
+        model_name,
+    )
+
+
+@app.post(
+    "/admin/model/rollback", status_code=202, dependencies=[Depends(_verify_admin)]
 )
-logger.info(f"Infer app init success, model_path: {INFER_APP.model_path}")
+async def admin_rollback_model():
+    """
+    Swap back to the default model in use before the last swap
+    """
+    if INFER_APP.previous_model_name is None:
+        raise HTTPException(status_code=409, detail="No previous model to roll back to")
+    return _start_swap(INFER_APP.rollback_model, INFER_APP.previous_model_name)
+
+
+def _max_rss_bytes() -> Optional[int]:
+    if resource is None:
+        return None
+    # Linux reports KiB, macOS bytes
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def _max_upload_bytes() -> int:
+    return InferSettingCurrent.max_upload_mb * 1024 * 1024
+
+
+async def _open_upload(source: Union[bytes, BinaryIO]) -> Union[Image.Image, bytes]:
+    """
+    Check the upload against the pixel limit from its header, without decoding it.
+    The image stays on the spooled file, unless the preprocess pool needs the encoded
+    bytes
+    :param source: Encoded file, or the spooled file of an UploadFile
+    :raises: ImageTooLargeError
+    """
+    if PREPROCESS_POOL is not None and not isinstance(source, bytes):
+        source = await run_in_threadpool(source.read)
+    image = await run_in_threadpool(
+        open_image, source, InferSettingCurrent.max_image_pixels
+    )
+    return source if PREPROCESS_POOL is not None else image
 
 
 @app.post("/upload")
@@ -33,34 +433,85 @@ async def upload(
     character_threshold: Optional[float] = 0.85,
     general_mcut_enabled: Optional[bool] = False,
     character_mcut_enabled: Optional[bool] = False,
+    model: Optional[str] = None,
+    image_id: Optional[str] = None,
+    tiles: bool = False,
+    max_tiles: Optional[int] = None,
+    tile_merge: Literal["max", "mean"] = "max",
+    fields: Optional[
+        List[
+            Literal["sorted_general_strings", "rating", "character_res", "general_res"]
+        ]
+    ] = Query(None),
+    top_k: Optional[int] = Query(None, ge=1),
+    digits: Optional[int] = Query(None, ge=0, le=10),
+    response_format: Literal["json", "msgpack"] = "json",
 ):
+    """
+    Tag one image, with image_id its predictions are kept in the probability store.
+    With tiles, the whole image and overlapping crops of it are tagged in one batch,
+    max_tiles rows at most, and the probabilities merged per tag with tile_merge.
+    fields picks the keys of the response, only those are built, top_k keeps the most
+    confident general and character tags and digits rounds the probabilities.
+    """
     if not verify_token(token):
         raise HTTPException(status_code=401, detail="Invalid token")
+    if model is not None and model not in all_wd_models:
+        raise HTTPException(status_code=400, detail=f"model must be in {all_wd_models}")
+    tile_cap = InferSettingCurrent.tile_max_count
+    if max_tiles is not None and not 1 <= max_tiles <= tile_cap:
+        raise HTTPException(
+            status_code=400, detail=f"max_tiles must be between 1 and {tile_cap}"
+        )
+    if response_format == "msgpack" and msgpack is None:
+        raise HTTPException(
+            status_code=400,
+            detail="msgpack output needs msgpack, run `pip install msgpack`",
+        )
+    _check_accepting()
 
     try:
-        image: Image = Image.open(BytesIO(await file.read()))
-        (
-            sorted_general_strings,
-            rating,
-            character_res,
-            general_res,
-        ) = await INFER_APP.infer(
+        if file.size is not None:
+            check_size(file.size, _max_upload_bytes())
+        with UPLOAD_READ_SECONDS.time():
+            digest = None
+            if RESULT_CACHE is not None:
+                digest = await run_in_threadpool(ResultCache.digest, file.file)
+            image = await _open_upload(file.file)
+        result = await INFER_APP.infer(
             image=image,
             general_threshold=general_threshold,
             character_threshold=character_threshold,
             general_mcut_enabled=general_mcut_enabled,
             character_mcut_enabled=character_mcut_enabled,
+            model_name=model,
+            digest=digest,
+            image_id=image_id,
+            max_tiles=(max_tiles or tile_cap) if tiles else 1,
+            tile_merge=tile_merge,
+            top_k=top_k,
+            fields=fields,
         )
-        logger.warning(
-            "tag_result has been deprecated, use sorted_general_strings instead"
+        if fields is None:
+            _warn_tag_result()
+            body = {"tag_result": result[0], **_tag_response(*result)}
+        else:
+            body = {
+                field: value
+                for field, value in zip(RESULT_FIELDS, result)
+                if field in fields
+            }
+        return _encode(body, response_format, digits)
+    except ImageTooLargeError as e:
+        logger.warning(e)
+        raise HTTPException(status_code=413, detail=str(e))
+    except QueueFullError as e:
+        logger.warning(e)
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(InferSettingCurrent.infer_retry_after)},
         )
-        return {
-            "tag_result": sorted_general_strings,
-            "sorted_general_strings": sorted_general_strings,
-            "rating": rating,
-            "character_res": character_res,
-            "general_res": general_res,
-        }
     except LoadError as e:
         logger.exception(e)
         raise HTTPException(status_code=500, detail=str(e))
@@ -75,3 +526,217 @@ async def upload(
     except Exception as e:
         logger.exception(e)
         raise HTTPException(status_code=500, detail="服务器内部错误...")
+
+
+def _warn_tag_result():
+    global _tag_result_warned
+    if not _tag_result_warned:
+        _tag_result_warned = True
+        logger.warning(
+            "tag_result has been deprecated, use sorted_general_strings instead"
+        )
+
+
+def _encode(body: dict, response_format: str, digits: Optional[int]) -> Response:
+    """
+    Encode the response ourselves, FastAPI would walk it through jsonable_encoder first
+    """
+    if digits is not None:
+        body = {
+            key: (
+                {name: round(p, digits) for name, p in value.items()}
+                if isinstance(value, dict)
+                else value
+            )
+            for key, value in body.items()
+        }
+    if response_format == "msgpack":
+        return Response(msgpack.packb(body), media_type="application/msgpack")
+    if orjson is not None:
+        return Response(orjson.dumps(body), media_type="application/json")
+    return Response(
+        json.dumps(body, ensure_ascii=False, separators=(",", ":")),
+        media_type="application/json",
+    )
+
+
+def _tag_response(sorted_general_strings, rating, character_res, general_res) -> dict:
+    return {
+        "sorted_general_strings": sorted_general_strings,
+        "rating": rating,
+        "character_res": character_res,
+        "general_res": general_res,
+    }
+
+
+async def _iter_uploads(
+    files: List[UploadFile],
+) -> AsyncIterator[Tuple[str, Union[bytes, Exception]]]:
+    """
+    Uploaded images, archives are unpacked member by member outside of the event loop
+    """
+    max_bytes = _max_upload_bytes()
+    for file in files:
+        if not is_archive(file.filename or ""):
+            try:
+                if file.size is not None:
+                    check_size(file.size, max_bytes)
+            except ImageTooLargeError as e:
+                yield file.filename, e
+                continue
+            yield file.filename, await file.read()
+            continue
+        members = iter_archive(file.file, file.filename, max_bytes=max_bytes)
+        while True:
+            try:
+                member = await run_in_threadpool(next, members, None)
+            except Exception as e:
+                yield file.filename, e
+                break
+            if member is None:
+                break
+            yield member
+
+
+@app.post("/upload/batch")
+async def upload_batch(
+    token: Optional[str] = None,
+    files: List[UploadFile] = File(...),
+    general_threshold: Optional[float] = 0.35,
+    character_threshold: Optional[float] = 0.85,
+    general_mcut_enabled: Optional[bool] = False,
+    character_mcut_enabled: Optional[bool] = False,
+    model: Optional[str] = None,
+    store: bool = False,
+):
+    """
+    Tag many images, or zip/tar archives of images, in one request.
+    Results are streamed as NDJSON, one line per image, as each batch completes.
+    With store, predictions are kept in the probability store under each file name.
+    """
+    if not verify_token(token):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if model is not None and model not in all_wd_models:
+        raise HTTPException(status_code=400, detail=f"model must be in {all_wd_models}")
+    _check_accepting()
+    if INFER_APP.executor.full:
+        raise HTTPException(
+            status_code=503,
+            detail="Inference queue is full",
+            headers={"Retry-After": str(InferSettingCurrent.infer_retry_after)},
+        )
+
+    async def tag(index: int, filename: str, content: Union[bytes, Exception]) -> str:
+        line = {"index": index, "file": filename}
+        try:
+            if isinstance(content, Exception):
+                raise content
+            with UPLOAD_READ_SECONDS.time():
+                digest = None
+                if RESULT_CACHE is not None:
+                    digest = await run_in_threadpool(ResultCache.digest, content)
+                image = await _open_upload(content)
+            result = await INFER_APP.infer(
+                image=image,
+                general_threshold=general_threshold,
+                character_threshold=character_threshold,
+                general_mcut_enabled=general_mcut_enabled,
+                character_mcut_enabled=character_mcut_enabled,
+                model_name=model,
+                digest=digest,
+                image_id=filename if store else None,
+            )
+            line.update(_tag_response(*result))
+        except Exception as e:
+            logger.warning(f"Tagging {filename} failed: {e}")
+            line["error"] = f"{type(e).__name__}: {e}"
+        return json.dumps(line, ensure_ascii=False) + "\n"
+
+    async def stream():
+        # Each chunk is submitted at once, so the batch scheduler merges it into one
+        # model run
+        chunk_size = INFER_APP.registry.max_batch_size
+        chunk = []
+        index = 0
+        async for filename, content in _iter_uploads(files):
+            chunk.append(tag(index, filename, content))
+            index += 1
+            if len(chunk) >= chunk_size:
+                for line in await asyncio.gather(*chunk):
+                    yield line
+                chunk = []
+        for line in await asyncio.gather(*chunk):
+            yield line
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+def _check_store(token: Optional[str], model: Optional[str]):
+    if not verify_token(token):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if model is not None and model not in all_wd_models:
+        raise HTTPException(status_code=400, detail=f"model must be in {all_wd_models}")
+    if PROB_STORE is None:
+        raise HTTPException(
+            status_code=404, detail="Probability store is disabled, set PROB_STORE_PATH"
+        )
+
+
+@app.get("/store/search")
+async def store_search(
+    tags: List[str] = Query(...),
+    threshold: float = 0.35,
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+    model: Optional[str] = None,
+    token: Optional[str] = None,
+):
+    """
+    Stored images scoring at least threshold on every tag, in the order they were stored
+    """
+    _check_store(token, model)
+    try:
+        image_ids, probs = await INFER_APP.search(
+            tags, threshold, limit=limit, offset=offset, model_name=model
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "images": [
+            {"image_id": image_id, "probs": dict(zip(tags, row.tolist()))}
+            for image_id, row in zip(image_ids, probs)
+        ]
+    }
+
+
+@app.post("/store/rethreshold")
+async def store_rethreshold(
+    image_ids: List[str] = Body(..., embed=True),
+    general_threshold: float = 0.35,
+    character_threshold: float = 0.85,
+    general_mcut_enabled: bool = False,
+    character_mcut_enabled: bool = False,
+    model: Optional[str] = None,
+    token: Optional[str] = None,
+):
+    """
+    Tag stored images again with other thresholds, the model is not run
+    """
+    _check_store(token, model)
+    if len(image_ids) > 1000:
+        raise HTTPException(status_code=400, detail="At most 1000 image_ids at once")
+    found, results = await INFER_APP.rethreshold(
+        image_ids,
+        general_threshold=general_threshold,
+        character_threshold=character_threshold,
+        general_mcut_enabled=general_mcut_enabled,
+        character_mcut_enabled=character_mcut_enabled,
+        model_name=model,
+    )
+    return {
+        "results": [
+            {"image_id": image_id, **_tag_response(*result)}
+            for image_id, result in zip(found, results)
+        ],
+        "missing": sorted(set(image_ids) - set(found)),
+    }
@@ -0,0 +1,303 @@
+import glob
+import json
+import os
+import pathlib
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Container, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from .files import is_archive, is_image, iter_archive
+from .infer import Predictor, PreprocessPool
+from .infer.predictor import prepare_image
+
+# Archive members are keyed as <archive path>::<member name>
+MEMBER_SEPARATOR = "::"
+
+
+def iter_sources(
+    sources: Iterable[str],
+    file_list: Optional[str] = None,
+    skip: Optional[Container[str]] = None,
+) -> Iterator[Tuple[str, bytes]]:
+    """
+    Read images from directories, globs, archives, single files and a file list
+    :param skip: Keys passed over without reading them, e.g. Checkpoint.done
+    :return: (key, content), the key is unique for every image
+    """
+    skip = skip if skip is not None else ()
+    paths = list(sources)
+    if file_list:
+        with open(file_list, "r", encoding="utf-8") as f:
+            paths.extend(line.strip() for line in f if line.strip())
+    for source in paths:
+        if glob.has_magic(source):
+            for path in sorted(glob.glob(source, recursive=True)):
+                yield from _iter_path(path, skip)
+        else:
+            yield from _iter_path(source, skip)
+
+
+def _iter_path(path: str, skip: Container[str]) -> Iterator[Tuple[str, bytes]]:
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if is_image(name):
+                    yield from _iter_path(os.path.join(root, name), skip)
+    elif is_archive(path):
+        with open(path, "rb") as f:
+            for member, content in iter_archive(
+                f, path, skip=lambda member: _member_key(path, member) in skip
+            ):
+                yield _member_key(path, member), content
+    elif is_image(path):
+        if path in skip:
+            return
+        with open(path, "rb") as f:
+            yield path, f.read()
+    else:
+        logger.warning(f"Skip {path}, not an image, archive or directory")
+
+
+def _member_key(path: str, member: str) -> str:
+    return f"{path}{MEMBER_SEPARATOR}{member}"
+
+
+class Checkpoint(object):
+    def __init__(self, path: str):
+        """
+        Append-only list of finished keys, so an interrupted run can be resumed
+        """
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.done = {line.rstrip("\n") for line in f if line.strip()}
+        self._file = open(path, "a", encoding="utf-8")
+
+    def add(self, keys: List[str]):
+        self._file.writelines(key + "\n" for key in keys)
+        self._file.flush()
+        self.done.update(keys)
+
+    def close(self):
+        self._file.close()
+
+
+class JsonlWriter(object):
+    def __init__(self, path: str):
+        self._file = open(path, "a", encoding="utf-8")
+
+    def write(self, key: str, result: dict):
+        self._file.write(json.dumps({"file": key, **result}, ensure_ascii=False) + "\n")
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter(object):
+    def __init__(self, path: str, rows_per_group: int = 4096):
+        """
+        Every run writes its own part file into the output directory
+        """
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output needs pyarrow, run `pip install pyarrow`")
+        self._pa = pyarrow
+        self._schema = pyarrow.schema(
+            [
+                ("file", pyarrow.string()),
+                ("sorted_general_strings", pyarrow.string()),
+                ("rating", pyarrow.string()),
+                ("character_res", pyarrow.string()),
+                ("general_res", pyarrow.string()),
+            ]
+        )
+        pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+        part = pathlib.Path(path).joinpath(
+            f"part-{time.strftime('%Y%m%d-%H%M%S')}.parquet"
+        )
+        self._writer = pyarrow.parquet.ParquetWriter(str(part), self._schema)
+        self._rows = []
+        self.rows_per_group = rows_per_group
+
+    def write(self, key: str, result: dict):
+        self._rows.append(
+            {
+                "file": key,
+                "sorted_general_strings": result["sorted_general_strings"],
+                "rating": json.dumps(result["rating"]),
+                "character_res": json.dumps(
+                    result["character_res"], ensure_ascii=False
+                ),
+                "general_res": json.dumps(result["general_res"], ensure_ascii=False),
+            }
+        )
+        if len(self._rows) >= self.rows_per_group:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            table = self._pa.Table.from_pylist(self._rows, schema=self._schema)
+            self._writer.write_table(table)
+            self._rows = []
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+
+class CaptionWriter(object):
+    def __init__(self, output_dir: Optional[str] = None):
+        """
+        Sidecar .txt captions as training tools expect them, characters first.
+        Without an output directory they are written next to the images,
+        archive members always go to the output directory.
+        """
+        self.output_dir = output_dir
+
+    def _caption_path(self, key: str) -> pathlib.Path:
+        if MEMBER_SEPARATOR in key:
+            if not self.output_dir:
+                raise ValueError("Captions of archive members need an output directory")
+            archive, member = key.split(MEMBER_SEPARATOR, 1)
+            relative = pathlib.Path(pathlib.Path(archive).stem, member)
+        elif self.output_dir:
+            absolute = pathlib.Path(os.path.abspath(key))
+            relative = pathlib.Path(os.path.relpath(absolute))
+            if relative.parts[0] == os.pardir:
+                relative = absolute.relative_to(absolute.anchor)
+        else:
+            return pathlib.Path(key).with_suffix(".txt")
+        path = pathlib.Path(self.output_dir).joinpath(relative).with_suffix(".txt")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def write(self, key: str, result: dict):
+        characters = sorted(
+            result["character_res"], key=result["character_res"].get, reverse=True
+        )
+        tags = [name.replace("(", r"\(").replace(")", r"\)") for name in characters]
+        if result["sorted_general_strings"]:
+            tags.append(result["sorted_general_strings"])
+        self._caption_path(key).write_text(", ".join(tags), encoding="utf-8")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def open_writer(output_format: str, output: Optional[str]):
+    if output_format == "jsonl":
+        return JsonlWriter(output or "tags.jsonl")
+    if output_format == "parquet":
+        return ParquetWriter(output or "tags_parquet")
+    if output_format == "txt":
+        return CaptionWriter(output)
+    raise ValueError(f"Unknown output format {output_format}")
+
+
+def _batched(items: Iterator, batch_size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def tag_files(
+    items: Iterator[Tuple[str, bytes]],
+    predictor: Predictor,
+    writer,
+    checkpoint: Optional[Checkpoint] = None,
+    batch_size: int = 16,
+    threads: int = 4,
+    preprocess_pool: Optional[PreprocessPool] = None,
+    general_threshold: float = 0.35,
+    character_threshold: float = 0.85,
+    general_mcut_enabled: bool = False,
+    character_mcut_enabled: bool = False,
+    report_every: float = 10.0,
+) -> int:
+    """
+    Tag a stream of images: while one batch runs in the model, the next one
+    is decoded and prepared in the thread or process pool.
+    :return: Number of images tagged
+    """
+    target_size = predictor.model_target_size
+    if checkpoint is not None:
+        items = (item for item in items if item[0] not in checkpoint.done)
+
+    def prepare(content: bytes) -> np.ndarray:
+        if preprocess_pool is not None:
+            return preprocess_pool.prepare_sync(content, target_size)
+        return prepare_image(content, target_size)
+
+    def submit(batch) -> List[Tuple[str, Future]]:
+        return [(key, pool.submit(prepare, content)) for key, content in batch]
+
+    tagged = 0
+    failed = 0
+    started = last_report = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="bulk") as pool:
+        batches = _batched(items, batch_size)
+        pending = submit(next(batches, []))
+        while pending:
+            current, pending = pending, submit(next(batches, []))
+            keys, arrays = [], []
+            for key, future in current:
+                try:
+                    arrays.append(future.result())
+                    keys.append(key)
+                except Exception as e:
+                    failed += 1
+                    logger.warning(f"Skip {key}: {e}")
+            if arrays:
+                preds = predictor.run(np.concatenate(arrays, axis=0))
+                results = predictor.postprocess_batch(
+                    preds,
+                    general_thresh=general_threshold,
+                    general_mcut_enabled=general_mcut_enabled,
+                    character_thresh=character_threshold,
+                    character_mcut_enabled=character_mcut_enabled,
+                )
+                for key, result in zip(keys, results):
+                    writer.write(
+                        key,
+                        {
+                            "sorted_general_strings": result[0],
+                            "rating": result[1],
+                            "character_res": result[2],
+                            "general_res": result[3],
+                        },
+                    )
+                writer.flush()
+                if checkpoint is not None:
+                    checkpoint.add(keys)
+                tagged += len(keys)
+            now = time.perf_counter()
+            if now - last_report >= report_every:
+                last_report = now
+                logger.info(
+                    f"{tagged} images tagged, {failed} failed, "
+                    f"{tagged / (now - started):.1f} images/s"
+                )
+    elapsed = time.perf_counter() - started
+    logger.success(
+        f"Done: {tagged} images tagged, {failed} failed in {elapsed:.1f}s, "
+        f"{tagged / elapsed if elapsed else 0:.1f} images/s"
+    )
+    return tagged
@@ -0,0 +1,91 @@
+import tarfile
+import zipfile
+from io import BytesIO
+from typing import BinaryIO, Callable, Iterator, Optional, Tuple, Union
+
+from PIL import Image
+
+from .infer.error import ImageTooLargeError
+
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif", ".tif", ".tiff")
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+
+def is_archive(filename: str) -> bool:
+    return filename.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def is_image(filename: str) -> bool:
+    return filename.lower().endswith(IMAGE_SUFFIXES)
+
+
+def open_image(source: Union[bytes, BinaryIO], max_pixels: int = 0) -> Image.Image:
+    """
+    Open an image reading only its header, the pixels are decoded on first use
+    :param source: Encoded file, or a file object which must stay open until the image
+        is used
+    :param max_pixels: Largest width * height accepted, 0 for no limit
+    :raises: ImageTooLargeError
+    """
+    if isinstance(source, bytes):
+        source = BytesIO(source)
+    try:
+        image = Image.open(source)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e)) from e
+    width, height = image.size
+    if max_pixels and width * height > max_pixels:
+        image.close()
+        raise ImageTooLargeError(
+            f"Image is {width}x{height}, more than {max_pixels} pixels"
+        )
+    return image
+
+
+def check_size(size: int, max_bytes: int):
+    """
+    :raises: ImageTooLargeError
+    """
+    if max_bytes and size > max_bytes:
+        raise ImageTooLargeError(f"File is {size} bytes, more than {max_bytes}")
+
+
+def iter_archive(
+    fileobj: BinaryIO,
+    filename: str,
+    max_bytes: int = 0,
+    skip: Optional[Callable[[str], bool]] = None,
+) -> Iterator[Tuple[str, Union[bytes, ImageTooLargeError]]]:
+    """
+    Read the images of a zip or tar archive one by one
+    :param fileobj: Archive file, must be seekable for zip
+    :param filename: Archive name, picks the format
+    :param max_bytes: Members larger than this are not extracted, 0 for no limit
+    :param skip: Members it returns True for are passed over without being extracted
+    :return: (member name, content), or the error in place of an oversized member
+    """
+    # Declared sizes are checked before inflating, so archive bombs are never extracted
+    if filename.lower().endswith(".zip"):
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and is_image(info.filename):
+                    if skip is not None and skip(info.filename):
+                        continue
+                    try:
+                        check_size(info.file_size, max_bytes)
+                    except ImageTooLargeError as e:
+                        yield info.filename, e
+                        continue
+                    yield info.filename, archive.read(info)
+        return
+    with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+        for member in archive:
+            if member.isfile() and is_image(member.name):
+                if skip is not None and skip(member.name):
+                    continue
+                try:
+                    check_size(member.size, max_bytes)
+                except ImageTooLargeError as e:
+                    yield member.name, e
+                    continue
+                yield member.name, archive.extractfile(member).read()
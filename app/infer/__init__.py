@@ -4,122 +4,27 @@
 # @File    : __init__.py
 
 import asyncio
-import pathlib
+import threading
+from typing import Collection, List, Optional, Union
+
 import numpy as np
 from PIL import Image
 from loguru import logger
 
+from .cache import ResultCache
+from .error import LoadError
+from .executor import InferExecutor
 from .load import OnnxRuntimeManager, load_labels, singleton, mcut_threshold
-from .setup import download_csv, download_model
+from .metrics import METRICS, PREPARE_SECONDS
+from .predictor import RESULT_FIELDS, TILE_MERGES, Predictor, merge_tiles
+from .preprocess import PreprocessPool
+from .registry import ModelEntry, ModelRegistry
+from .setup import CONNECTIONS, HF_ENDPOINT, download_csv, download_model
+from .store import ProbabilityStore
 
 
 # import nest_asyncio
 # nest_asyncio.apply()
-class Predictor(object):
-    def __init__(
-        self,
-        model,
-        model_target_size,
-        tag_names,
-        rating_indexes,
-        general_indexes,
-        character_indexes,
-    ):
-        self.model = model
-        self.model_target_size = model_target_size
-        self.tag_names = tag_names
-        self.rating_indexes = rating_indexes
-        self.general_indexes = general_indexes
-        self.character_indexes = character_indexes
-
-    def prepare_image(self, image):
-        target_size = self.model_target_size
-
-        # Convert to RGBA
-        image = image.convert("RGBA")
-
-        canvas = Image.new("RGBA", image.size, (255, 255, 255))
-        canvas.alpha_composite(image)
-        image = canvas.convert("RGB")
-
-        # Pad image to square
-        image_shape = image.size
-        max_dim = max(image_shape)
-        pad_left = (max_dim - image_shape[0]) // 2
-        pad_top = (max_dim - image_shape[1]) // 2
-
-        padded_image = Image.new("RGB", (max_dim, max_dim), (255, 255, 255))
-        padded_image.paste(image, (pad_left, pad_top))
-
-        # Resize
-        if max_dim != target_size:
-            padded_image = padded_image.resize(
-                (target_size, target_size),
-                Image.BICUBIC,
-            )
-
-        # Convert to numpy array
-        image_array = np.asarray(padded_image, dtype=np.float32)
-
-        # Convert PIL-native RGB to BGR
-        image_array = image_array[:, :, ::-1]
-
-        return np.expand_dims(image_array, axis=0)
-
-    def predict(
-        self,
-        image: Image.Image,
-        general_thresh: float,
-        general_mcut_enabled: bool,
-        character_thresh: float,
-        character_mcut_enabled: bool,
-    ):
-        image = self.prepare_image(image)
-
-        input_name = self.model.get_inputs()[0].name
-        label_name = self.model.get_outputs()[0].name
-        preds = self.model.run([label_name], {input_name: image})[0]
-
-        labels = list(zip(self.tag_names, preds[0].astype(float)))
-
-        # First 4 labels are actually ratings: pick one with argmax
-        ratings_names = [labels[i] for i in self.rating_indexes]
-        rating = dict(ratings_names)
-
-        # Then we have general tags: pick anywhere prediction confidence > threshold
-        general_names = [labels[i] for i in self.general_indexes]
-
-        if general_mcut_enabled:
-            general_probs = np.array([x[1] for x in general_names])
-            general_thresh = mcut_threshold(general_probs)
-
-        general_res = [x for x in general_names if x[1] > general_thresh]
-        general_res = dict(general_res)
-
-        # Everything else is characters: pick anywhere prediction confidence > threshold
-        character_names = [labels[i] for i in self.character_indexes]
-
-        if character_mcut_enabled:
-            character_probs = np.array([x[1] for x in character_names])
-            character_thresh = mcut_threshold(character_probs)
-            character_thresh = max(0.15, character_thresh)
-
-        character_res = [x for x in character_names if x[1] > character_thresh]
-        character_res = dict(character_res)
-
-        sorted_general_strings = sorted(
-            general_res.items(),
-            key=lambda x: x[1],
-            reverse=True,
-        )
-        sorted_general_strings = [x[0] for x in sorted_general_strings]
-        sorted_general_strings = (
-            ", ".join(sorted_general_strings).replace("(", "\(").replace(")", "\)")
-        )
-
-        return sorted_general_strings, rating, character_res, general_res
-
-
 @singleton
 class InferClient(object):
     def __init__(
@@ -127,7 +32,36 @@ class InferClient(object):
         model_name: str,
         model_dir: str = "models",
         skip_auto_download: bool = False,
+        max_workers: int = 1,
+        max_queue_size: int = 32,
+        max_batch_size: int = 8,
+        max_batch_wait_ms: float = 5.0,
+        memory_budget_mb: int = 0,
+        result_cache: Optional[ResultCache] = None,
+        preprocess_pool: Optional[PreprocessPool] = None,
+        precision: str = "fp32",
+        preload: bool = True,
+        download_base_url: str = HF_ENDPOINT,
+        download_connections: int = CONNECTIONS,
+        prob_store: Optional[ProbabilityStore] = None,
+        tile_overlap: float = 0.25,
     ):
+        """
+        :param preload: Load the default model now, otherwise call set_up later,
+            requests arriving before that wait for the model
+        :param download_base_url: The hub, or a mirror with the same layout
+        :param prob_store: Keeps the predictions of images tagged with an image_id
+        :param tile_overlap: Fraction of a tile shared with its neighbours in tiled
+            inference
+        """
+        self.model_name = model_name
+        self.previous_model_name = None
+        self.swap_status = {"state": "idle", "target": None, "error": None}
+        self._swap_lock = threading.Lock()
+        self.result_cache = result_cache
+        self.preprocess_pool = preprocess_pool
+        self.prob_store = prob_store
+        self.tile_overlap = tile_overlap
         self.model_path = None
         self.tag_csv_path = None
 
@@ -136,72 +70,289 @@ class InferClient(object):
         self.general_indexes = None
         self.character_indexes = None
 
-        self.set_up(
-            model_name=model_name,
+        self.executor = InferExecutor(
+            max_workers=max_workers, max_queue_size=max_queue_size
+        )
+        self.registry = ModelRegistry(
+            executor=self.executor,
             model_dir=model_dir,
             skip_auto_download=skip_auto_download,
+            memory_budget_mb=memory_budget_mb,
+            max_batch_size=max_batch_size,
+            max_batch_wait_ms=max_batch_wait_ms,
+            precision=precision,
+            download_base_url=download_base_url,
+            download_connections=download_connections,
         )
+        if preload:
+            self.set_up(
+                model_name=model_name,
+                model_dir=model_dir,
+                skip_auto_download=skip_auto_download,
+            )
 
-    def set_up(self, model_name: str, model_dir: str, skip_auto_download: bool = False):
-        # Download model and csv
-        def sync(coro):
-            loop = asyncio.get_event_loop()
-            return loop.run_until_complete(coro)
+    @property
+    def ready(self) -> bool:
+        """
+        The default model is loaded and warmed up
+        """
+        return self.model_path is not None
 
+    def set_up(self, model_name: str, model_dir: str, skip_auto_download: bool = False):
         logger.info("Setting up inference client...")
         if skip_auto_download:
             logger.warning("Skipping auto download")
-            model_path = (
-                pathlib.Path(model_dir).joinpath(f"{model_name}.onnx").absolute()
-            )
-            tag_csv_path = (
-                pathlib.Path(model_dir).joinpath(f"{model_name}.csv").absolute()
-            )
-            if not model_path.exists():
-                raise FileNotFoundError(f"Model {model_name} not exists")
-            if not tag_csv_path.exists():
-                raise FileNotFoundError(f"Tagger CSV {model_name} not exists")
-            self.model_path = str(model_path)
-            self.tag_csv_path = str(tag_csv_path)
-        else:
-            model_path = sync(download_model(model_name, file_dir=model_dir))
-            tag_csv_path = sync(download_csv(model_name, file_dir=model_dir))
-            self.model_path = model_path
-            self.tag_csv_path = tag_csv_path
-
-        # Load labels
-        tag_names, rating_indexes, general_indexes, character_indexes = load_labels(
-            self.tag_csv_path
-        )
-        self.tag_names = tag_names
-        self.rating_indexes = rating_indexes
-        self.general_indexes = general_indexes
-        self.character_indexes = character_indexes
+        self.registry.model_dir = model_dir
+        self.registry.skip_auto_download = skip_auto_download
+        # The default model is loaded now and never evicted, others on first use
+        self._activate(self.registry.load(model_name, pin=True))
         return self
 
+    def _activate(self, entry: ModelEntry):
+        self.tag_csv_path = entry.tag_csv_path
+        self.tag_names = entry.predictor.tag_names
+        self.rating_indexes = entry.predictor.rating_indexes
+        self.general_indexes = entry.predictor.general_indexes
+        self.character_indexes = entry.predictor.character_indexes
+        self.model_path = entry.model_path
+        # Requests pick the default model by name, so this switches them over at once
+        self.model_name = entry.model_name
+
+    def swap_model(self, model_name: str, drain_timeout: float = 30.0) -> bool:
+        """
+        Load and warm up another default model, switch new requests to it,
+        then free the old one once its in-flight requests are done.
+        The current model keeps serving if loading fails.
+        :param drain_timeout: Longest wait for requests on the old model
+        :return: False if the old model was still busy at the timeout, it is freed later
+        :raises: LoadError, DownloadError, FileNotFoundError
+        """
+        with self._swap_lock:
+            old_name = self.model_name
+            self.swap_status = {"state": "loading", "target": model_name, "error": None}
+            try:
+                entry = self.registry.load(model_name, pin=True)
+            except Exception as e:
+                self.swap_status.update(
+                    state="failed", error=f"{type(e).__name__}: {e}"
+                )
+                raise
+            if model_name == old_name:
+                self.swap_status["state"] = "done"
+                return True
+            self._activate(entry)
+            self.previous_model_name = old_name
+            logger.info(f"Default model switched from {old_name} to {model_name}")
+            self.swap_status["state"] = "draining"
+            drained = self.registry.unload(old_name, timeout=drain_timeout)
+            self.swap_status["state"] = "done"
+            return drained
+
+    def rollback_model(self, drain_timeout: float = 30.0) -> bool:
+        """
+        Swap back to the default model in use before the last swap
+        :raises: LoadError if there was no swap
+        """
+        if self.previous_model_name is None:
+            raise LoadError("No previous model to roll back to")
+        return self.swap_model(self.previous_model_name, drain_timeout=drain_timeout)
+
+    def get_predictor(self, model_name: Optional[str] = None) -> Predictor:
+        return self.registry.load(model_name or self.model_name).predictor
+
+    async def get_model(self, model_name: Optional[str] = None) -> ModelEntry:
+        entry = await self.registry.get(model_name or self.model_name)
+        if self.model_path is None and entry.model_name == self.model_name:
+            # set_up failed and a request has loaded the default model since
+            self._activate(self.registry.load(entry.model_name, pin=True))
+        return entry
+
     async def infer(
         self,
-        image: Image.Image,
+        image: Union[Image.Image, bytes],
         general_threshold: float = 0.35,
         character_threshold: float = 0.85,
         character_mcut_enabled: bool = True,
         general_mcut_enabled: bool = True,
+        model_name: Optional[str] = None,
+        digest: Optional[str] = None,
+        image_id: Optional[str] = None,
+        max_tiles: int = 1,
+        tile_merge: str = "max",
+        top_k: Optional[int] = None,
+        fields: Optional[Collection[str]] = None,
     ) -> tuple:
-        model = OnnxRuntimeManager.get_runtime(model_path=self.model_path)
-        _, model_target_size, width, _ = model.get_inputs()[0].shape
-        # Infer tag
-        predictor = Predictor(
-            model=model,
-            model_target_size=model_target_size,
-            tag_names=self.tag_names,
-            rating_indexes=self.rating_indexes,
-            general_indexes=self.general_indexes,
-            character_indexes=self.character_indexes,
+        """
+        Tag the image in the worker pool, the event loop is not blocked.
+        Result cache hits skip the worker pool and its admission queue.
+        Images from concurrent calls share one model run through the batch scheduler.
+        :param image: Image, or the encoded file which may be decoded in the preprocess
+            pool
+        :param model_name: One of all_wd_models, the default model if None
+        :param digest: ResultCache.digest of the uploaded bytes, enables the result
+            cache
+        :param image_id: Keep the predictions under this id in the probability store
+        :param max_tiles: Above 1, the whole image and overlapping model-sized crops of
+            it run as one batch of up to this many rows, their probabilities are merged
+            per tag
+        :param tile_merge: One of TILE_MERGES
+        :param top_k: Keep only the k most confident general and character tags
+        :param fields: Subset of RESULT_FIELDS to build, the others are returned as None
+        :raises: QueueFullError, ValueError for an unknown tile_merge
+        """
+        if tile_merge not in TILE_MERGES:
+            raise ValueError(f"tile_merge must be in {TILE_MERGES}")
+        entry = await self.get_model(model_name)
+        loop = asyncio.get_running_loop()
+        # Counted, so a swapped out model is only freed once its requests are done
+        with entry.in_use():
+            predictor = entry.predictor
+            preds = None
+            cache_key = None
+            if self.result_cache is not None and digest is not None:
+                variant = None
+                if max_tiles > 1:
+                    variant = f"tiles-{max_tiles}-{tile_merge}-{self.tile_overlap}"
+                cache_key = ResultCache.key(digest, self._model_key(entry), variant)
+                # Off the inference workers, a hit never waits behind model runs
+                preds = await loop.run_in_executor(
+                    None, self.result_cache.get, cache_key
+                )
+            if preds is None:
+                # Only model runs count against the admission queue
+                with self.executor.admit():
+                    if max_tiles > 1:
+                        preds = await self._infer_tiles(
+                            entry, image, max_tiles, tile_merge
+                        )
+                    else:
+                        preds = await self._infer_one(entry, image)
+                if cache_key is not None:
+                    await loop.run_in_executor(
+                        None, self.result_cache.put, cache_key, preds
+                    )
+            if self.prob_store is not None and image_id is not None:
+                await loop.run_in_executor(
+                    None, self.prob_store.put, self._model_key(entry), image_id, preds
+                )
+            return await loop.run_in_executor(
+                None,
+                lambda: predictor.postprocess(
+                    preds,
+                    general_thresh=general_threshold,
+                    general_mcut_enabled=general_mcut_enabled,
+                    character_thresh=character_threshold,
+                    character_mcut_enabled=character_mcut_enabled,
+                    top_k=top_k,
+                    fields=fields,
+                ),
+            )
+
+    def _model_key(self, entry: ModelEntry) -> str:
+        """
+        Key of the predictions of a model in the result cache and the probability store,
+        both outlive restarts, so predictions made at another precision are told apart
+        """
+        return f"{entry.model_name}@{self.registry.precision}"
+
+    async def _infer_one(
+        self, entry: ModelEntry, image: Union[Image.Image, bytes]
+    ) -> np.ndarray:
+        predictor = entry.predictor
+        if self.preprocess_pool is not None and isinstance(image, bytes):
+            # Timed here, observations inside the pool processes are lost
+            with PREPARE_SECONDS.time():
+                image_array = await self.preprocess_pool.prepare(
+                    image, predictor.model_target_size
+                )
+        else:
+            image_array = await self.executor.run(predictor.prepare_image, image)
+        return await entry.scheduler.submit(image_array)
+
+    async def _infer_tiles(
+        self,
+        entry: ModelEntry,
+        image: Union[Image.Image, bytes],
+        max_tiles: int,
+        tile_merge: str,
+    ) -> np.ndarray:
+        predictor = entry.predictor
+        tiles = await self.executor.run(
+            predictor.prepare_tiles, image, max_tiles, self.tile_overlap
+        )
+        if len(tiles) == 1:
+            # Small enough for the model input, batched with other requests as usual
+            return await entry.scheduler.submit(tiles)
+        # The tiles already fill a batch of their own
+        preds = await self.executor.run(predictor.run, tiles)
+        return merge_tiles(preds, tile_merge)
+
+    async def rethreshold(
+        self,
+        image_ids: List[str],
+        general_threshold: float = 0.35,
+        character_threshold: float = 0.85,
+        character_mcut_enabled: bool = True,
+        general_mcut_enabled: bool = True,
+        model_name: Optional[str] = None,
+    ) -> tuple:
+        """
+        Threshold the stored predictions of images again, the model is not run
+        :return: The ids found, and their (sorted_general_strings, rating,
+            character_res, general_res)
+        :raises: LoadError if the probability store is off
+        """
+        if self.prob_store is None:
+            raise LoadError("Probability store is disabled")
+        entry = await self.get_model(model_name)
+        loop = asyncio.get_running_loop()
+        found, preds = await loop.run_in_executor(
+            None, self.prob_store.get, self._model_key(entry), image_ids
+        )
+        if not found:
+            return [], []
+        results = await loop.run_in_executor(
+            None,
+            lambda: entry.predictor.postprocess_batch(
+                preds,
+                general_thresh=general_threshold,
+                general_mcut_enabled=general_mcut_enabled,
+                character_thresh=character_threshold,
+                character_mcut_enabled=character_mcut_enabled,
+            ),
         )
-        return predictor.predict(
-            image=image,
-            general_thresh=general_threshold,
-            general_mcut_enabled=general_mcut_enabled,
-            character_thresh=character_threshold,
-            character_mcut_enabled=character_mcut_enabled,
+        return found, results
+
+    async def search(
+        self,
+        tags: List[str],
+        threshold: float,
+        limit: int = 100,
+        offset: int = 0,
+        model_name: Optional[str] = None,
+    ) -> tuple:
+        """
+        Stored images scoring at least threshold on every tag
+        :param tags: Names as the tag results spell them
+        :return: image ids, and their [n, len(tags)] probabilities of the tags
+        :raises: LoadError if the probability store is off, ValueError for an unknown
+            tag or a threshold below the index threshold
+        """
+        if self.prob_store is None:
+            raise LoadError("Probability store is disabled")
+        entry = await self.get_model(model_name)
+        tag_index = entry.predictor.tag_index
+        unknown = [tag for tag in tags if tag not in tag_index]
+        if unknown:
+            raise ValueError(f"Unknown tags for {entry.model_name}: {unknown}")
+        tag_indexes = [tag_index[tag] for tag in tags]
+        return await asyncio.get_running_loop().run_in_executor(
+            None,
+            lambda: self.prob_store.search(
+                self._model_key(entry),
+                tag_indexes,
+                threshold,
+                limit=limit,
+                offset=offset,
+            ),
         )
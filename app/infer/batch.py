@@ -0,0 +1,134 @@
+import asyncio
+import threading
+import weakref
+from collections import Counter
+from typing import Callable, List, Tuple
+
+import numpy as np
+from .executor import InferExecutor
+
+
+class BatchScheduler(object):
+    def __init__(
+        self,
+        run_batch: Callable[[np.ndarray], np.ndarray],
+        executor: InferExecutor,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 5.0,
+    ):
+        """
+        Gather prepared images from concurrent requests into one model call
+        :param run_batch: Callable mapping [B, H, W, 3] to [B, num_tags]
+        :param executor: Worker pool the batches run in
+        :param max_batch_size: Largest batch handed to the model
+        :param max_wait_ms: How long the first image of a batch waits for company
+        """
+        self.run_batch = run_batch
+        self.executor = executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        # batch size -> number of model calls with that size
+        self.batch_sizes = Counter()
+        # Every event loop gets its own queue and collector task
+        self._queues = weakref.WeakKeyDictionary()
+        self._tasks = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _get_queue(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            queue = self._queues.get(loop)
+            if queue is None:
+                queue = asyncio.Queue()
+                self._queues[loop] = queue
+                self._tasks[loop] = loop.create_task(self._collect_forever(queue))
+        return queue
+
+    def close(self):
+        """
+        Stop the collector tasks, so the model they call can be freed
+        """
+        with self._lock:
+            self._closed = True
+            tasks = list(self._tasks.items())
+            self._tasks.clear()
+            self._queues.clear()
+        for loop, task in tasks:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(task.cancel)
+
+    async def submit(self, image: np.ndarray) -> np.ndarray:
+        """
+        Queue one prepared image and wait for its prediction row
+        :param image: [1, H, W, 3] prepared image
+        :return: [num_tags] probabilities
+        """
+        # Late requests on a closed scheduler run alone instead of starting a collector
+        if self.max_batch_size == 1 or self._closed:
+            preds = await self.executor.run(self.run_batch, image)
+            self.batch_sizes[1] += 1
+            return preds[0]
+        queue = self._get_queue()
+        future = asyncio.get_running_loop().create_future()
+        queue.put_nowait((image, future))
+        return await future
+
+    async def _collect(
+        self, queue: asyncio.Queue
+    ) -> List[Tuple[np.ndarray, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        items = []
+        while not items:
+            item = await queue.get()
+            if not item[1].cancelled():
+                items.append(item)
+        deadline = loop.time() + self.max_wait
+        while len(items) < self.max_batch_size:
+            if queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = queue.get_nowait()
+            if not item[1].cancelled():
+                items.append(item)
+        return items
+
+    async def _collect_forever(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.executor.max_workers)
+        while True:
+            # Hold images back while every worker is busy, so they pile up into a bigger
+            # batch
+            await slots.acquire()
+            try:
+                items = await self._collect(queue)
+            except BaseException:
+                slots.release()
+                raise
+            loop.create_task(self._dispatch(items, slots))
+
+    async def _dispatch(
+        self,
+        items: List[Tuple[np.ndarray, asyncio.Future]],
+        slots: asyncio.Semaphore,
+    ):
+        try:
+            batch = np.concatenate([image for image, _ in items], axis=0)
+            self.batch_sizes[len(items)] += 1
+            preds = await self.executor.run(self.run_batch, batch)
+        except Exception as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for row, (_, future) in zip(preds, items):
+                if not future.done():
+                    future.set_result(row)
+        finally:
+            slots.release()
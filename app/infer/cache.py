@@ -0,0 +1,123 @@
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import BinaryIO, Optional, Union
+
+import numpy as np
+from loguru import logger
+
+
+class ResultCache(object):
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, disk_path: str = None):
+        """
+        Raw prediction vectors by image content and model, any threshold can be applied
+        later
+        :param max_bytes: Size limit of the in-memory tier
+        :param disk_path: Sqlite file for the float16 on-disk tier, None to keep memory
+            only
+        """
+        self.max_bytes = max_bytes
+        self.disk_path = disk_path
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if disk_path:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS preds (key TEXT PRIMARY KEY, value BLOB)"
+            )
+            self._db.commit()
+            logger.info(f"Result cache persisted at {disk_path}")
+
+    @staticmethod
+    def digest(data: Union[bytes, BinaryIO]) -> str:
+        """
+        :param data: Encoded file, or a seekable file object hashed in chunks and
+            rewound
+        """
+        if isinstance(data, bytes):
+            return hashlib.blake2b(data, digest_size=20).hexdigest()
+        hasher = hashlib.blake2b(digest_size=20)
+        data.seek(0)
+        for chunk in iter(lambda: data.read(1024 * 1024), b""):
+            hasher.update(chunk)
+        data.seek(0)
+        return hasher.hexdigest()
+
+    @staticmethod
+    def key(digest: str, model_name: str, variant: Optional[str] = None) -> str:
+        """
+        :param variant: Set when the predictions were not made from the plain image,
+            e.g. tiled
+        """
+        if variant:
+            return f"{model_name}:{variant}:{digest}"
+        return f"{model_name}:{digest}"
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        :return: [num_tags] probabilities, or None
+        """
+        with self._lock:
+            preds = self._memory.get(key)
+            if preds is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return preds
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value FROM preds WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    preds = np.frombuffer(row[0], dtype=np.float16).astype(np.float32)
+                    self._put_memory(key, preds)
+                    self.disk_hits += 1
+                    return preds
+            self.misses += 1
+            return None
+
+    def put(self, key: str, preds: np.ndarray):
+        preds = np.array(preds, dtype=np.float32)
+        preds.setflags(write=False)
+        with self._lock:
+            self._put_memory(key, preds)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO preds (key, value) VALUES (?, ?)",
+                    (key, preds.astype(np.float16).tobytes()),
+                )
+                self._db.commit()
+
+    def _put_memory(self, key: str, preds: np.ndarray):
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= old.nbytes
+        if preds.nbytes > self.max_bytes:
+            return
+        self._memory[key] = preds
+        self._memory_bytes += preds.nbytes
+        while self._memory_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -13,3 +13,11 @@ class DownloadError(Exception):
 
 class FileSizeMismatchError(Exception):
     pass
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class ImageTooLargeError(Exception):
+    pass
@@ -0,0 +1,75 @@
+import asyncio
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from .error import QueueFullError
+
+
+class InferExecutor(object):
+    def __init__(self, max_workers: int = 1, max_queue_size: int = 32):
+        """
+        Worker pool which keeps inference off the event loop
+        :param max_workers: Number of worker threads running the model
+        :param max_queue_size: Number of jobs allowed to wait for a free worker
+        """
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="infer"
+        )
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        """
+        Jobs admitted and not finished yet, running or queued
+        """
+        return self._pending
+
+    @property
+    def full(self) -> bool:
+        return self._pending >= self.max_workers + self.max_queue_size
+
+    @property
+    def queued(self) -> int:
+        return max(0, self._pending - self.max_workers)
+
+    @contextlib.contextmanager
+    def admit(self):
+        """
+        Count one request against the admission queue while the block runs
+        :raises: QueueFullError
+        """
+        if self.full:
+            raise QueueFullError(
+                f"Inference queue is full ({self.max_queue_size} waiting)"
+            )
+        self._pending += 1
+        try:
+            yield
+        finally:
+            self._pending -= 1
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run func in the worker pool without admission control
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def submit(self, func, *args, **kwargs):
+        """
+        Run func in the worker pool and wait for the result
+        :raises: QueueFullError
+        """
+        with self.admit():
+            return await self.run(func, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True):
+        logger.info("Shutting down inference workers...")
+        self._executor.shutdown(wait=wait)
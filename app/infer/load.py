@@ -3,16 +3,50 @@
 # @Author  : sudoskys
 # @File    : load.py
 # @Software: PyCharm
+import csv
+import functools
+import hashlib
 import os
+import platform
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
 from typing import Tuple
 
 import numpy as np
 import onnxruntime as ort
-import pandas as pd
+from loguru import logger
 from onnxruntime import InferenceSession
 
 from .error import LoadError
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+@functools.lru_cache(maxsize=None)
+def cpu_fingerprint() -> str:
+    """
+    Architecture and a hash of the CPU feature flags, so optimized graphs saved on a
+    shared models volume are only reused by CPUs with the same instruction sets
+    """
+    flags = platform.processor()
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                # "flags" on x86, "Features" on arm
+                if key.strip() in ("flags", "Features"):
+                    flags = " ".join(sorted(value.split()))
+                    break
+    except OSError:
+        pass
+    digest = hashlib.blake2b(flags.encode(), digest_size=4).hexdigest()
+    return f"{platform.machine().lower() or 'cpu'}-{digest}"
+
 
 def singleton(cls):
     _instance = {}
@@ -25,11 +59,9 @@ def singleton(cls):
     return _singleton
 
 
-def load_labels(
-    label_csv_path: str,
-) -> Tuple:
-    # https://github.com/toriato/stable-diffusion-webui-wd14-tagger/blob/a9eacb1eff904552d3012babfa28b57e1d3e295c/tagger/ui.py#L368
-    kaomojis = [
+# https://github.com/toriato/stable-diffusion-webui-wd14-tagger/blob/a9eacb1eff904552d3012babfa28b57e1d3e295c/tagger/ui.py#L368
+KAOMOJIS = frozenset(
+    [
         "0_0",
         "(o)_(o)",
         "+_+",
@@ -50,9 +82,16 @@ def load_labels(
         "|_|",
         "||_||",
     ]
+)
+LABEL_CACHE_SUFFIX = ".labels.npz"
+_LABEL_CACHE_VERSION = 1
+
+
+def load_labels(label_csv_path: str, cache: bool = True) -> Tuple:
     """
-    Load labels from csv
+    Load labels from csv, the parsed table is kept in a binary sidecar next to it
     :param label_csv_path: csv path
+    :param cache: Read and write models/<name>.labels.npz, rebuilt when the csv changes
     :return: tag_names, rating_indexes, general_indexes, character_indexes
     :raises: LoadError
     """
@@ -63,35 +102,231 @@ def load_labels(
         raise LoadError("label csv path must end with .csv")
     if not os.path.isfile(label_csv_path):
         raise LoadError("label csv path must be a file")
-    df = pd.read_csv(label_csv_path)
-    name_series = df["name"]
-    name_series = name_series.map(
-        lambda x: x.replace("_", " ") if x not in kaomojis else x
+    source = os.stat(label_csv_path)
+    source_key = np.array(
+        [_LABEL_CACHE_VERSION, source.st_size, source.st_mtime_ns], dtype=np.int64
     )
-    tag_names = name_series.tolist()
-    rating_indexes = list(np.where(df["category"] == 9)[0])
-    general_indexes = list(np.where(df["category"] == 0)[0])
-    character_indexes = list(np.where(df["category"] == 4)[0])
+    cache_path = label_csv_path[: -len(".csv")] + LABEL_CACHE_SUFFIX
+    labels = _read_label_cache(cache_path, source_key) if cache else None
+    if labels is None:
+        labels = _parse_label_csv(label_csv_path)
+        if cache:
+            _write_label_cache(cache_path, source_key, *labels)
+    tag_names, categories = labels
+    rating_indexes = np.flatnonzero(categories == 9)
+    general_indexes = np.flatnonzero(categories == 0)
+    character_indexes = np.flatnonzero(categories == 4)
     return tag_names, rating_indexes, general_indexes, character_indexes
 
 
+def _parse_label_csv(label_csv_path: str) -> Tuple[list, np.ndarray]:
+    tag_names = []
+    categories = []
+    with open(label_csv_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            name = row["name"]
+            tag_names.append(name if name in KAOMOJIS else name.replace("_", " "))
+            categories.append(int(row["category"]))
+    return tag_names, np.array(categories, dtype=np.int16)
+
+
+def _read_label_cache(cache_path: str, source_key: np.ndarray):
+    try:
+        with np.load(cache_path) as data:
+            if not np.array_equal(data["source"], source_key):
+                return None
+            tag_names = data["names"].tobytes().decode("utf-8").split("\n")
+            return tag_names, data["categories"]
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Label cache {cache_path} unreadable, parsing the csv: {e}")
+        return None
+
+
+def _write_label_cache(
+    cache_path: str, source_key: np.ndarray, tag_names: list, categories: np.ndarray
+):
+    # Names are stored as one utf-8 buffer, so loading needs no pickle
+    names = np.frombuffer("\n".join(tag_names).encode("utf-8"), dtype=np.uint8)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, source=source_key, names=names, categories=categories)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning(f"Label cache {cache_path} not written: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def mcut_threshold(probs):
     """
     Maximum Cut Thresholding (MCut)
     Largeron, C., Moulin, C., & Gery, M. (2012). MCut: A Thresholding Strategy
      for Multi-label Classification. In 11th International Symposium, IDA 2012
      (pp. 172-183).
+    Works on the last axis, so a [B, N] matrix gives one threshold per row.
     """
-    sorted_probs = probs[probs.argsort()[::-1]]
-    difs = sorted_probs[:-1] - sorted_probs[1:]
-    t = difs.argmax()
-    thresh = (sorted_probs[t] + sorted_probs[t + 1]) / 2
-    return thresh
+    sorted_probs = -np.sort(-probs, axis=-1)
+    difs = sorted_probs[..., :-1] - sorted_probs[..., 1:]
+    t = difs.argmax(axis=-1)[..., None]
+    thresh = (
+        np.take_along_axis(sorted_probs, t, axis=-1)
+        + np.take_along_axis(sorted_probs, t + 1, axis=-1)
+    ) / 2
+    return thresh[..., 0][()]
+
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+# Providers whose optimized graphs can be saved and loaded again safely
+_CPU_PROVIDERS = ("CPUExecutionProvider", "AzureExecutionProvider")
 
 
 class RuntimeManager(object):
     def __init__(self):
         self._cached_runtime = {}
+        self._lock = threading.Lock()
+        self.intra_op_threads = 0
+        self.inter_op_threads = 0
+        self.graph_optimization_level = "all"
+        self.execution_mode = "sequential"
+        self.enable_mem_arena = True
+        self.optimized_model_cache = False
+        self.shared_weights = False
+
+    def configure(
+        self,
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0,
+        graph_optimization_level: str = "all",
+        execution_mode: str = "sequential",
+        enable_mem_arena: bool = True,
+        optimized_model_cache: bool = False,
+        shared_weights: bool = False,
+    ):
+        """
+        Set the options of the sessions created from now on
+        :param intra_op_threads: Threads inside one operator, 0 lets ORT decide
+        :param inter_op_threads: Threads running operators in parallel, 0 lets ORT
+            decide
+        :param graph_optimization_level: disable, basic, extended or all
+        :param execution_mode: sequential or parallel
+        :param enable_mem_arena: Keep freed CPU memory in ORT's arena for reuse
+        :param optimized_model_cache: Save the optimized graph next to the model and
+            load it next time
+        :param shared_weights: Save the optimized graph with its weights in a separate
+            file and map that file instead of copying it, so processes on one host
+            share the weights. Turns off ORT's weight prepacking, which is slower on
+            some CPUs
+        """
+        if graph_optimization_level not in GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(
+                f"graph_optimization_level must be in {list(GRAPH_OPTIMIZATION_LEVELS)}"
+            )
+        if execution_mode not in EXECUTION_MODES:
+            raise ValueError(f"execution_mode must be in {list(EXECUTION_MODES)}")
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.graph_optimization_level = graph_optimization_level
+        self.execution_mode = execution_mode
+        self.enable_mem_arena = enable_mem_arena
+        self.optimized_model_cache = optimized_model_cache
+        self.shared_weights = shared_weights
+        return self
+
+    def session_options(self) -> ort.SessionOptions:
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = self.intra_op_threads
+        options.inter_op_num_threads = self.inter_op_threads
+        options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[
+            self.graph_optimization_level
+        ]
+        options.execution_mode = EXECUTION_MODES[self.execution_mode]
+        options.enable_cpu_mem_arena = self.enable_mem_arena
+        if self.shared_weights:
+            # Prepacked weights are private copies, the mapped file is only shared
+            # without them
+            options.add_session_config_entry("session.disable_prepacking", "1")
+        return options
+
+    def optimized_model_path(self, model_path: str) -> str:
+        """
+        models/<name>.onnx -> models/<name>.<level>.ort-<version>.<cpu>.onnx,
+        the saved graph is only valid for the ORT version, level and CPU which produced
+        it, level all adds layouts for the instruction sets of the CPU.
+        With shared weights -> models/<name>.<level>.ort-<version>.<cpu>.shared.onnx
+        and .onnx.data
+        """
+        stem = model_path[: -len(".onnx")]
+        suffix = ".shared" if self.shared_weights else ""
+        return (
+            f"{stem}.{self.graph_optimization_level}.ort-{ort.__version__}"
+            f".{cpu_fingerprint()}{suffix}.onnx"
+        )
+
+    def _create_session(self, model_path: str) -> InferenceSession:
+        providers = ort.get_available_providers()
+        options = self.session_options()
+        if any(provider not in _CPU_PROVIDERS for provider in providers) or not (
+            self.shared_weights
+            or (
+                self.optimized_model_cache
+                and self.graph_optimization_level != "disable"
+            )
+        ):
+            return InferenceSession(model_path, options, providers=providers)
+        cache_path = self.optimized_model_path(model_path)
+        # Workers starting together wait for the first one instead of all optimizing the
+        # model
+        with file_lock(f"{cache_path}.lock"):
+            if not _is_fresh(cache_path, model_path):
+                model = self._save_optimized(model_path, cache_path, options, providers)
+                if not self.shared_weights:
+                    return model
+                # The weights of this session were read into memory, load them mapped
+                # instead
+                del model
+                options = self.session_options()
+        logger.info(f"Load optimized model from {cache_path}")
+        options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS["disable"]
+        return InferenceSession(cache_path, options, providers=providers)
+
+    def _save_optimized(
+        self, model_path: str, cache_path: str, options, providers
+    ) -> InferenceSession:
+        # Written in a temporary directory, so other processes never load half a file
+        temp_dir = tempfile.mkdtemp(dir=os.path.dirname(cache_path) or ".")
+        try:
+            temp_path = os.path.join(temp_dir, os.path.basename(cache_path))
+            options.optimized_model_filepath = temp_path
+            if self.shared_weights:
+                # Resolved next to the graph, the file name is kept when it is moved
+                options.add_session_config_entry(
+                    "session.optimized_model_external_initializers_file_name",
+                    f"{os.path.basename(cache_path)}.data",
+                )
+                options.add_session_config_entry(
+                    "session.optimized_model_external_initializers_min_size_in_bytes",
+                    "1024",
+                )
+            model = InferenceSession(model_path, options, providers=providers)
+            if os.path.exists(f"{temp_path}.data"):
+                os.replace(f"{temp_path}.data", f"{cache_path}.data")
+            os.replace(temp_path, cache_path)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        logger.info(f"Optimized model saved at {cache_path}")
+        return model
 
     def get_runtime(self, model_path: str):
         """
@@ -99,15 +334,48 @@ class RuntimeManager(object):
         :param model_path:
         :return:
         """
+        if model_path in self._cached_runtime:
+            return self._cached_runtime[model_path]
         if os.path.exists(model_path) is False:
             raise LoadError("model path not exists")
         if not model_path.endswith(".onnx"):
             raise LoadError("model path must end with .onnx")
-        if model_path in self._cached_runtime:
-            return self._cached_runtime[model_path]
-        model = InferenceSession(model_path, providers=ort.get_available_providers())
-        self._cached_runtime[model_path] = model
+        with self._lock:
+            if model_path in self._cached_runtime:
+                return self._cached_runtime[model_path]
+            model = self._create_session(model_path)
+            self._cached_runtime[model_path] = model
         return model
 
+    def release(self, model_path: str):
+        """
+        Drop a session from the cache, it is freed once nothing else holds it
+        """
+        with self._lock:
+            self._cached_runtime.pop(model_path, None)
+
+
+def _is_fresh(cache_path: str, model_path: str) -> bool:
+    # The weights file is moved in place before the graph, a fresh graph has its weights
+    return os.path.exists(cache_path) and os.path.getmtime(
+        cache_path
+    ) >= os.path.getmtime(model_path)
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Exclusive lock between processes, a no-op without fcntl
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
 
 OnnxRuntimeManager = RuntimeManager()
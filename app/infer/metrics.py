@@ -0,0 +1,177 @@
+import bisect
+import functools
+import threading
+import time
+from contextlib import nullcontext
+from typing import Callable, Dict, Optional, Sequence, Union
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+_DISABLED = nullcontext()
+
+
+class Metrics(object):
+    def __init__(self):
+        """
+        Histograms observed on the hot path and gauges collected on scrape,
+        rendered in the Prometheus text format. Nothing is recorded until enabled.
+        """
+        self.enabled = False
+        self._histograms = []
+        self._gauges = []
+
+    def histogram(
+        self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> "Histogram":
+        histogram = Histogram(self, name, documentation, buckets)
+        self._histograms.append(histogram)
+        return histogram
+
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        collect: Callable[[], Union[float, Dict[str, float], None]],
+        label: Optional[str] = None,
+        kind: str = "gauge",
+    ):
+        """
+        Register a value read when scraped
+        :param collect: Returns the value, or {label value: value} when label is set,
+            None to skip
+        :param kind: gauge or counter
+        """
+        self._gauges.append((name, documentation, collect, label, kind))
+
+    def render(self) -> str:
+        lines = []
+        for histogram in self._histograms:
+            lines.extend(histogram.render())
+        for name, documentation, collect, label, kind in self._gauges:
+            value = collect()
+            if value is None:
+                continue
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            if label is None:
+                lines.append(f"{name} {_number(value)}")
+                continue
+            for label_value, sample in value.items():
+                lines.append(
+                    f'{name}{{{label}="{_escape(label_value)}"}} {_number(sample)}'
+                )
+        return "\n".join(lines) + "\n"
+
+
+class Histogram(object):
+    def __init__(
+        self, metrics: Metrics, name: str, documentation: str, buckets: Sequence[float]
+    ):
+        self.metrics = metrics
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        if not self.metrics.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def time(self):
+        """
+        Context manager observing the seconds spent inside, a shared no-op when disabled
+        """
+        if not self.metrics.enabled:
+            return _DISABLED
+        return _Timer(self)
+
+    def timed(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.time():
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def render(self) -> list:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{_number(bound)}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {_number(total)}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class _Timer(object):
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+def _number(value) -> str:
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+METRICS = Metrics()
+UPLOAD_READ_SECONDS = METRICS.histogram(
+    "wd_upload_read_seconds", "Hashing and header parsing of an uploaded file"
+)
+DECODE_SECONDS = METRICS.histogram(
+    "wd_decode_seconds", "Decoding the image pixels, in process only"
+)
+PREPARE_SECONDS = METRICS.histogram(
+    "wd_prepare_image_seconds", "Decoding, resizing and padding an image"
+)
+MODEL_RUN_SECONDS = METRICS.histogram(
+    "wd_model_run_seconds", "One ONNX Runtime session run"
+)
+BATCH_SIZE = METRICS.histogram(
+    "wd_batch_size", "Images per session run", buckets=BATCH_SIZE_BUCKETS
+)
+POSTPROCESS_SECONDS = METRICS.histogram(
+    "wd_postprocess_seconds", "Thresholding the predictions of one batch"
+)
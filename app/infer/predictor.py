@@ -0,0 +1,416 @@
+import math
+from io import BytesIO
+from typing import Collection, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from .load import OnnxRuntimeManager, load_labels, mcut_threshold
+from .metrics import (
+    BATCH_SIZE,
+    DECODE_SECONDS,
+    MODEL_RUN_SECONDS,
+    POSTPROCESS_SECONDS,
+    PREPARE_SECONDS,
+)
+
+TILE_MERGES = ("max", "mean")
+# What postprocess returns, in order. Fields left out are None and not built at all
+RESULT_FIELDS = ("sorted_general_strings", "rating", "character_res", "general_res")
+
+
+class Predictor(object):
+    def __init__(
+        self,
+        model,
+        model_target_size,
+        tag_names,
+        rating_indexes,
+        general_indexes,
+        character_indexes,
+        input_name: str = None,
+        output_name: str = None,
+    ):
+        """
+        Long-lived handle of a loaded model, everything the hot path needs is resolved
+        here
+        """
+        self.model = model
+        self.model_target_size = model_target_size
+        self.input_name = input_name
+        self.output_name = output_name
+        self.tag_names = tag_names
+        # Tag name -> index, the first one if a name repeats
+        self.tag_index = {
+            name: index for index, name in reversed(list(enumerate(tag_names)))
+        }
+        self.rating_indexes = _frozen(np.asarray(rating_indexes, dtype=np.intp))
+        self.general_indexes = _frozen(np.asarray(general_indexes, dtype=np.intp))
+        self.character_indexes = _frozen(np.asarray(character_indexes, dtype=np.intp))
+
+        names = np.asarray(tag_names, dtype=object)
+        self.rating_names = names[self.rating_indexes].tolist()
+        self.general_names = _frozen(names[self.general_indexes])
+        self.character_names = _frozen(names[self.character_indexes])
+
+    @classmethod
+    def load(cls, model_path: str, tag_csv_path: str) -> "Predictor":
+        """
+        Load the session and labels and read the model metadata once
+        :raises: LoadError
+        """
+        model = OnnxRuntimeManager.get_runtime(model_path=model_path)
+        model_input = model.get_inputs()[0]
+        _, model_target_size, width, _ = model_input.shape
+        tag_names, rating_indexes, general_indexes, character_indexes = load_labels(
+            tag_csv_path
+        )
+        return cls(
+            model=model,
+            model_target_size=model_target_size,
+            tag_names=tag_names,
+            rating_indexes=rating_indexes,
+            general_indexes=general_indexes,
+            character_indexes=character_indexes,
+            input_name=model_input.name,
+            output_name=model.get_outputs()[0].name,
+        )
+
+    def warmup(self, batch_size: int = 1):
+        """
+        Run a blank batch, so the first request does not pay for ORT allocations
+        """
+        size = self.model_target_size
+        self.run(np.full((batch_size, size, size, 3), 255, dtype=np.float32))
+
+    def prepare_image(
+        self, image: Union[Image.Image, bytes], out: np.ndarray = None
+    ) -> np.ndarray:
+        """
+        Fit the image in a white square of the model size, as BGR float32
+        :param image: Image, may still be undecoded, or the encoded file
+        :param out: [1, size, size, 3] float32 array to write into, allocated if None
+        :return: [1, size, size, 3]
+        """
+        return prepare_image(image, self.model_target_size, out=out)
+
+    def prepare_tiles(
+        self, image: Union[Image.Image, bytes], max_tiles: int, overlap: float = 0.25
+    ) -> np.ndarray:
+        """
+        The whole image followed by overlapping crops of it, each prepared like
+        prepare_image. The image is decoded once at full resolution.
+        :param max_tiles: Rows at most, the whole image included
+        :param overlap: Fraction of a crop shared with its neighbours
+        :return: [n, size, size, 3], n is 1 when the image is no larger than the model
+            input
+        """
+        if isinstance(image, bytes):
+            image = Image.open(BytesIO(image))
+        with DECODE_SECONDS.time():
+            image.load()
+        boxes = tile_boxes(
+            *image.size, self.model_target_size, max_tiles - 1, overlap=overlap
+        )
+        size = self.model_target_size
+        out = np.empty((1 + len(boxes), size, size, 3), dtype=np.float32)
+        prepare_image(image, size, out=out[:1])
+        for row, box in enumerate(boxes, start=1):
+            prepare_image(image.crop(box), size, out=out[row : row + 1])
+        return out
+
+    def predict(
+        self,
+        image: Image.Image,
+        general_thresh: float,
+        general_mcut_enabled: bool,
+        character_thresh: float,
+        character_mcut_enabled: bool,
+        top_k: Optional[int] = None,
+        fields: Optional[Collection[str]] = None,
+    ):
+        preds = self.run(self.prepare_image(image))
+        return self.postprocess(
+            preds[0],
+            general_thresh=general_thresh,
+            general_mcut_enabled=general_mcut_enabled,
+            character_thresh=character_thresh,
+            character_mcut_enabled=character_mcut_enabled,
+            top_k=top_k,
+            fields=fields,
+        )
+
+    def run(self, images: np.ndarray) -> np.ndarray:
+        """
+        Run the model on a batch of prepared images
+        :param images: [B, H, W, 3] BGR float32
+        :return: [B, num_tags] probabilities
+        """
+        BATCH_SIZE.observe(images.shape[0])
+        with MODEL_RUN_SECONDS.time():
+            return self.model.run([self.output_name], {self.input_name: images})[0]
+
+    def postprocess(
+        self,
+        preds: np.ndarray,
+        general_thresh: float,
+        general_mcut_enabled: bool,
+        character_thresh: float,
+        character_mcut_enabled: bool,
+        top_k: Optional[int] = None,
+        fields: Optional[Collection[str]] = None,
+    ):
+        """
+        Threshold the prediction of one image
+        :param preds: [num_tags] probabilities
+        :return: sorted_general_strings, rating, character_res, general_res
+        """
+        return self.postprocess_batch(
+            preds[None, :],
+            general_thresh=general_thresh,
+            general_mcut_enabled=general_mcut_enabled,
+            character_thresh=character_thresh,
+            character_mcut_enabled=character_mcut_enabled,
+            top_k=top_k,
+            fields=fields,
+        )[0]
+
+    @POSTPROCESS_SECONDS.timed
+    def postprocess_batch(
+        self,
+        preds: np.ndarray,
+        general_thresh,
+        general_mcut_enabled,
+        character_thresh,
+        character_mcut_enabled,
+        top_k: Optional[int] = None,
+        fields: Optional[Collection[str]] = None,
+    ) -> list:
+        """
+        Threshold a whole batch of predictions at once
+        :param preds: [B, num_tags] probabilities
+        :param general_thresh: Threshold, one for all rows or one per row, same for the
+            others
+        :param top_k: Keep only the k most confident general and character tags
+        :param fields: Subset of RESULT_FIELDS to build, the others are None, all if
+            None
+        :return: list of (sorted_general_strings, rating, character_res, general_res)
+        """
+        fields = RESULT_FIELDS if fields is None else fields
+        want_rating = "rating" in fields
+        want_character = "character_res" in fields
+        want_strings = "sorted_general_strings" in fields
+        want_general = "general_res" in fields
+        preds = np.asarray(preds, dtype=np.float64)
+        batch_size = preds.shape[0]
+
+        ratings = preds[:, self.rating_indexes]
+        general = preds[:, self.general_indexes]
+        character = preds[:, self.character_indexes]
+
+        # Pick anywhere prediction confidence > threshold
+        general_mask = None
+        if want_strings or want_general:
+            general_thresh = _per_row(general_thresh, batch_size, np.float64)
+            general_mcut_enabled = _per_row(general_mcut_enabled, batch_size, bool)
+            if general_mcut_enabled.any():
+                general_thresh = np.where(
+                    general_mcut_enabled, mcut_threshold(general), general_thresh
+                )
+            general_mask = general > general_thresh[:, None]
+
+        character_mask = None
+        if want_character:
+            character_thresh = _per_row(character_thresh, batch_size, np.float64)
+            character_mcut_enabled = _per_row(character_mcut_enabled, batch_size, bool)
+            if character_mcut_enabled.any():
+                character_thresh = np.where(
+                    character_mcut_enabled,
+                    np.maximum(0.15, mcut_threshold(character)),
+                    character_thresh,
+                )
+            character_mask = character > character_thresh[:, None]
+
+        results = []
+        for row in range(batch_size):
+            rating = None
+            if want_rating:
+                rating = dict(zip(self.rating_names, ratings[row].tolist()))
+
+            general_res = sorted_general_strings = None
+            if general_mask is not None:
+                general_hits = _top_k(
+                    np.flatnonzero(general_mask[row]), general[row], top_k
+                )
+                general_probs = general[row, general_hits]
+                general_names = self.general_names[general_hits]
+                if want_general:
+                    general_res = dict(
+                        zip(general_names.tolist(), general_probs.tolist())
+                    )
+                if want_strings:
+                    # Stable sort keeps csv order between equal confidences
+                    order = np.argsort(-general_probs, kind="stable")
+                    sorted_general_strings = (
+                        ", ".join(general_names[order].tolist())
+                        .replace("(", r"\(")
+                        .replace(")", r"\)")
+                    )
+
+            character_res = None
+            if character_mask is not None:
+                character_hits = _top_k(
+                    np.flatnonzero(character_mask[row]), character[row], top_k
+                )
+                character_res = dict(
+                    zip(
+                        self.character_names[character_hits].tolist(),
+                        character[row, character_hits].tolist(),
+                    )
+                )
+            results.append((sorted_general_strings, rating, character_res, general_res))
+        return results
+
+
+@PREPARE_SECONDS.timed
+def prepare_image(
+    image: Union[Image.Image, bytes], target_size: int, out: np.ndarray = None
+) -> np.ndarray:
+    """
+    Fit the image in a white square of the model size, as BGR float32
+    :param image: Image, may still be undecoded, or the encoded file
+    :param target_size: Model input size
+    :param out: [1, size, size, 3] float32 array to write into, allocated if None
+    :return: [1, size, size, 3]
+    """
+    if isinstance(image, bytes):
+        image = Image.open(BytesIO(image))
+    width, height = image.size
+    max_dim = max(width, height)
+    if max_dim > target_size:
+        # Shrink before padding, so only the target size is ever padded
+        scale = target_size / max_dim
+        new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        pad_size = target_size
+        # JPEG can be decoded at 1/2, 1/4 or 1/8 scale, no need for the full resolution
+        image.draft("RGB", new_size)
+    else:
+        new_size = (width, height)
+        pad_size = max_dim
+    with DECODE_SECONDS.time():
+        image.load()
+
+    has_alpha = image.mode in ("RGBA", "RGBa", "LA", "La", "PA") or (
+        "transparency" in image.info
+    )
+    image = image.convert("RGBA" if has_alpha else "RGB")
+    if image.size != new_size:
+        image = image.resize(new_size, Image.BICUBIC, reducing_gap=3.0)
+
+    if has_alpha:
+        canvas = Image.new("RGBA", new_size, (255, 255, 255, 255))
+        canvas.alpha_composite(image)
+        image = canvas.convert("RGB")
+
+    # Pad image to square
+    if new_size != (pad_size, pad_size):
+        padded_image = Image.new("RGB", (pad_size, pad_size), (255, 255, 255))
+        padded_image.paste(
+            image, ((pad_size - new_size[0]) // 2, (pad_size - new_size[1]) // 2)
+        )
+        image = padded_image
+
+    # Small images are padded first and then upscaled
+    if pad_size != target_size:
+        image = image.resize((target_size, target_size), Image.BICUBIC)
+
+    if out is None:
+        out = np.empty((1, target_size, target_size, 3), dtype=np.float32)
+    # Convert PIL-native RGB to BGR
+    np.copyto(out[0], np.asarray(image)[:, :, ::-1])
+    return out
+
+
+def tile_boxes(
+    width: int, height: int, tile_size: int, max_tiles: int, overlap: float = 0.25
+) -> List[Tuple[int, int, int, int]]:
+    """
+    Square crops covering the image, as small as the model input allows
+    while keeping their number within max_tiles
+    :param tile_size: Smallest crop side, there is no detail to gain below the model
+        input
+    :param overlap: Fraction of a crop shared with its neighbours
+    :return: (left, upper, right, lower) boxes, none if a single crop would hold the
+        whole image
+    """
+    longest = max(width, height)
+    if max_tiles < 1 or longest <= tile_size:
+        return []
+    stride = 1 - min(max(overlap, 0.0), 0.9)
+
+    def count(side: int) -> int:
+        return _tiles_along(width, side, stride) * _tiles_along(height, side, stride)
+
+    # The count only drops as crops grow, find the smallest side that fits
+    low, high = tile_size, longest
+    while low < high:
+        middle = (low + high) // 2
+        if count(middle) <= max_tiles:
+            high = middle
+        else:
+            low = middle + 1
+    if low >= longest:
+        return []
+    lefts = _tile_starts(width, low, stride)
+    uppers = _tile_starts(height, low, stride)
+    return [
+        (left, upper, min(left + low, width), min(upper + low, height))
+        for upper in uppers
+        for left in lefts
+    ]
+
+
+def _tiles_along(length: int, side: int, stride: float) -> int:
+    if length <= side:
+        return 1
+    return math.ceil((length - side) / (side * stride)) + 1
+
+
+def _tile_starts(length: int, side: int, stride: float) -> List[int]:
+    count = _tiles_along(length, side, stride)
+    if count == 1:
+        return [0]
+    return np.rint(np.linspace(0, length - side, count)).astype(int).tolist()
+
+
+def merge_tiles(preds: np.ndarray, merge: str = "max") -> np.ndarray:
+    """
+    :param preds: [n, num_tags] probabilities of the tiles of one image
+    :param merge: max keeps a tag seen in any tile, mean favours tags seen across the
+        image
+    :return: [num_tags]
+    """
+    if merge == "max":
+        return preds.max(axis=0)
+    if merge == "mean":
+        return preds.mean(axis=0)
+    raise ValueError(f"merge must be in {TILE_MERGES}")
+
+
+def _top_k(hits: np.ndarray, probs: np.ndarray, top_k: Optional[int]) -> np.ndarray:
+    """
+    The k most confident hits, still in csv order
+    """
+    if top_k is None or len(hits) <= top_k:
+        return hits
+    keep = np.argsort(-probs[hits], kind="stable")[:top_k]
+    return hits[np.sort(keep)]
+
+
+def _frozen(array: np.ndarray) -> np.ndarray:
+    array.setflags(write=False)
+    return array
+
+
+def _per_row(value, batch_size: int, dtype) -> np.ndarray:
+    return np.broadcast_to(np.asarray(value, dtype=dtype), (batch_size,))
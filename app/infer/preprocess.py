@@ -0,0 +1,128 @@
+import asyncio
+import atexit
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from loguru import logger
+
+from .predictor import prepare_image
+
+# Shared memory blocks attached by this worker process, by name
+_attached = {}
+
+
+def _slot_view(shm: SharedMemory, slots: int, target_size: int) -> np.ndarray:
+    return np.ndarray(
+        (slots, target_size, target_size, 3), dtype=np.float32, buffer=shm.buf
+    )
+
+
+def _prepare_into_slot(
+    data: bytes, target_size: int, shm_name: str, slots: int, slot: int
+):
+    """
+    Runs in a worker process: decode and prepare the image straight into its shared
+    memory slot
+    """
+    shm = _attached.get(shm_name)
+    if shm is None:
+        shm = _attached[shm_name] = SharedMemory(name=shm_name)
+    view = _slot_view(shm, slots, target_size)
+    prepare_image(data, target_size, out=view[slot : slot + 1])
+
+
+def _noop():
+    return None
+
+
+class _SlotBlock(object):
+    def __init__(self, target_size: int, slots: int):
+        self.target_size = target_size
+        self.slots = slots
+        self.shm = SharedMemory(
+            create=True, size=slots * target_size * target_size * 3 * 4
+        )
+        self.view = _slot_view(self.shm, slots, target_size)
+        self.free = queue.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+
+    def close(self):
+        self.view = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+class PreprocessPool(object):
+    def __init__(self, workers: int):
+        """
+        Decode and prepare images in worker processes, tensors come back through shared
+        memory
+        :param workers: Number of worker processes
+        """
+        self.workers = workers
+        methods = multiprocessing.get_all_start_methods()
+        # Forked before ORT starts its threads, spawned where fork is unavailable
+        context = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+        # Workers must share our tracker, or they would unlink the blocks when they exit
+        resource_tracker.ensure_running()
+        self._processes = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        self._threads = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="preprocess"
+        )
+        self._blocks = {}
+        self._lock = threading.Lock()
+        # Submitting starts the worker processes right away. The results are not
+        # awaited, the pool may be built while its own package is still importing
+        for _ in range(workers):
+            self._processes.submit(_noop)
+        atexit.register(self.shutdown)
+        logger.info(f"Preprocess pool started with {workers} processes")
+
+    def _block(self, target_size: int) -> _SlotBlock:
+        with self._lock:
+            block = self._blocks.get(target_size)
+            if block is None:
+                block = self._blocks[target_size] = _SlotBlock(
+                    target_size, slots=self.workers
+                )
+            return block
+
+    def prepare_sync(self, data: bytes, target_size: int) -> np.ndarray:
+        """
+        Decode and prepare the encoded image in a worker process
+        :return: [1, size, size, 3] BGR float32
+        """
+        block = self._block(target_size)
+        slot = block.free.get()
+        try:
+            self._processes.submit(
+                _prepare_into_slot,
+                data,
+                target_size,
+                block.shm.name,
+                block.slots,
+                slot,
+            ).result()
+            return block.view[slot : slot + 1].copy()
+        finally:
+            block.free.put(slot)
+
+    async def prepare(self, data: bytes, target_size: int) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._threads, self.prepare_sync, data, target_size
+        )
+
+    def shutdown(self):
+        self._threads.shutdown(wait=True)
+        self._processes.shutdown(wait=True)
+        with self._lock:
+            for block in self._blocks.values():
+                block.close()
+            self._blocks.clear()
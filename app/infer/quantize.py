@@ -0,0 +1,191 @@
+import os
+import time
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from .error import LoadError
+from .predictor import Predictor, prepare_image
+
+# precision -> suffix of the model file, fp32 is the downloaded model itself
+PRECISION_SUFFIXES = {
+    "fp32": ".onnx",
+    "int8": ".int8.onnx",
+    "int8-static": ".int8-static.onnx",
+}
+
+
+def quantized_model_path(model_path: str, precision: str) -> str:
+    """
+    models/<name>.onnx -> models/<name>.int8.onnx
+    """
+    return model_path[: -len(".onnx")] + PRECISION_SUFFIXES[precision]
+
+
+def _quantization():
+    try:
+        from onnxruntime import quantization
+    except ImportError:
+        raise ImportError("Quantization needs onnx, run `pip install onnx`")
+    return quantization
+
+
+def quantize_dynamic(model_path: str, output_path: Optional[str] = None) -> str:
+    """
+    Dynamic int8 quantization of the MatMul/Gemm weights, no calibration data needed.
+    Conv layers stay fp32, ConvInteger is slower than fp32 Conv on most CPUs.
+    :return: Path of the quantized model
+    """
+    quantization = _quantization()
+    output_path = output_path or quantized_model_path(model_path, "int8")
+    temp_path = f"{output_path}.{os.getpid()}.tmp"
+    logger.info(f"Quantizing {model_path} to dynamic int8...")
+    quantization.quantize_dynamic(
+        model_path,
+        temp_path,
+        op_types_to_quantize=["MatMul", "Gemm"],
+        weight_type=quantization.QuantType.QInt8,
+    )
+    os.replace(temp_path, output_path)
+    logger.success(f"Quantized model saved at {output_path}")
+    return output_path
+
+
+def quantize_static(
+    model_path: str,
+    calibration_images: Iterable[bytes],
+    output_path: Optional[str] = None,
+    target_size: int = 448,
+) -> str:
+    """
+    Static int8 quantization in QDQ format, activations calibrated on local images
+    :param calibration_images: Encoded images, a few hundred typical uploads are enough
+    :return: Path of the quantized model
+    """
+    quantization = _quantization()
+    output_path = output_path or quantized_model_path(model_path, "int8-static")
+    temp_path = f"{output_path}.{os.getpid()}.tmp"
+
+    import onnxruntime as ort
+
+    input_name = (
+        ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        .get_inputs()[0]
+        .name
+    )
+
+    class Reader(quantization.CalibrationDataReader):
+        def __init__(self):
+            self._images = iter(calibration_images)
+
+        def get_next(self):
+            for data in self._images:
+                try:
+                    return {input_name: prepare_image(data, target_size)}
+                except Exception as e:
+                    logger.warning(f"Skip calibration image: {e}")
+            return None
+
+    logger.info(f"Quantizing {model_path} to static int8...")
+    quantization.quantize_static(
+        model_path,
+        temp_path,
+        Reader(),
+        quant_format=quantization.QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=quantization.QuantType.QUInt8,
+        weight_type=quantization.QuantType.QInt8,
+    )
+    os.replace(temp_path, output_path)
+    logger.success(f"Quantized model saved at {output_path}")
+    return output_path
+
+
+def ensure_precision(model_path: str, precision: str) -> str:
+    """
+    Path of the model at the given precision, dynamic int8 is created on first use
+    :raises: LoadError
+    """
+    if precision not in PRECISION_SUFFIXES:
+        raise LoadError(f"precision must be in {list(PRECISION_SUFFIXES)}")
+    if precision == "fp32":
+        return model_path
+    path = quantized_model_path(model_path, precision)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(model_path):
+        return path
+    if precision == "int8":
+        return quantize_dynamic(model_path, path)
+    raise LoadError(
+        f"{path} not found, create it with `python cli.py quantize --static <images>`"
+    )
+
+
+def evaluate(
+    reference: Predictor,
+    candidate: Predictor,
+    images: Iterable[Tuple[str, bytes]],
+    top_k: int = 10,
+    batch_size: int = 8,
+) -> dict:
+    """
+    Compare a quantized model against the fp32 one on local images
+    :return: top-k general tag agreement, rating drift and speed of both models
+    """
+    agreements: List[float] = []
+    rating_drift: List[float] = []
+    rating_flips = 0
+    max_drift = 0.0
+    timings = {"reference": 0.0, "candidate": 0.0}
+    count = 0
+
+    def run(name: str, predictor: Predictor, batch: np.ndarray) -> np.ndarray:
+        started = time.perf_counter()
+        preds = predictor.run(batch)
+        timings[name] += time.perf_counter() - started
+        return preds.astype(np.float64)
+
+    arrays = []
+
+    def flush():
+        nonlocal rating_flips, max_drift, count
+        batch = np.concatenate(arrays, axis=0)
+        arrays.clear()
+        expected = run("reference", reference, batch)
+        actual = run("candidate", candidate, batch)
+        general = reference.general_indexes
+        k = min(top_k, len(general))
+        for row_expected, row_actual in zip(expected, actual):
+            top_expected = set(general[np.argsort(-row_expected[general])[:k]])
+            top_actual = set(general[np.argsort(-row_actual[general])[:k]])
+            agreements.append(len(top_expected & top_actual) / k)
+            ratings_expected = row_expected[reference.rating_indexes]
+            ratings_actual = row_actual[reference.rating_indexes]
+            rating_drift.append(float(np.abs(ratings_expected - ratings_actual).mean()))
+            rating_flips += int(ratings_expected.argmax() != ratings_actual.argmax())
+            max_drift = max(max_drift, float(np.abs(row_expected - row_actual).max()))
+            count += 1
+
+    for key, data in images:
+        try:
+            arrays.append(prepare_image(data, reference.model_target_size))
+        except Exception as e:
+            logger.warning(f"Skip {key}: {e}")
+            continue
+        if len(arrays) >= batch_size:
+            flush()
+    if arrays:
+        flush()
+    if not count:
+        raise ValueError("No image could be evaluated")
+    return {
+        "images": count,
+        f"top{top_k}_agreement": float(np.mean(agreements)),
+        f"top{top_k}_agreement_min": float(np.min(agreements)),
+        "rating_mean_abs_drift": float(np.mean(rating_drift)),
+        "rating_argmax_flips": rating_flips,
+        "max_abs_prob_diff": max_drift,
+        "reference_images_per_second": count / timings["reference"],
+        "candidate_images_per_second": count / timings["candidate"],
+        "speedup": timings["reference"] / timings["candidate"],
+    }
@@ -0,0 +1,269 @@
+import asyncio
+import contextlib
+import os
+import pathlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from loguru import logger
+
+from .batch import BatchScheduler
+from .executor import InferExecutor
+from .load import OnnxRuntimeManager
+from .predictor import Predictor
+from .quantize import ensure_precision
+from .setup import CONNECTIONS, HF_ENDPOINT, download_model_files
+
+
+class ModelEntry(object):
+    def __init__(
+        self,
+        model_name: str,
+        model_path: str,
+        tag_csv_path: str,
+        predictor: Predictor,
+        scheduler: BatchScheduler,
+        load_seconds: float = 0.0,
+    ):
+        self.model_name = model_name
+        self.model_path = model_path
+        self.tag_csv_path = tag_csv_path
+        self.predictor = predictor
+        self.scheduler = scheduler
+        self.size_bytes = os.path.getsize(model_path)
+        self.load_seconds = load_seconds
+        self._active = 0
+        self._idle = threading.Condition()
+
+    @property
+    def active(self) -> int:
+        """
+        Requests currently using this model
+        """
+        return self._active
+
+    @contextlib.contextmanager
+    def in_use(self):
+        with self._idle:
+            self._active += 1
+        try:
+            yield self
+        finally:
+            with self._idle:
+                self._active -= 1
+                if not self._active:
+                    self._idle.notify_all()
+
+    def wait_idle(self, timeout: float = None) -> bool:
+        """
+        :return: False if requests were still using the model at the timeout
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._active, timeout)
+
+
+class ModelRegistry(object):
+    def __init__(
+        self,
+        executor: InferExecutor,
+        model_dir: str = "models",
+        skip_auto_download: bool = False,
+        memory_budget_mb: int = 0,
+        max_batch_size: int = 8,
+        max_batch_wait_ms: float = 5.0,
+        precision: str = "fp32",
+        download_base_url: str = HF_ENDPOINT,
+        download_connections: int = CONNECTIONS,
+    ):
+        """
+        Loaded models by name, loaded on first use and evicted least recently used first
+        :param executor: Worker pool shared by the models
+        :param memory_budget_mb: Total size of the loaded model files, 0 for no limit
+        :param precision: fp32, or a quantized variant from quantize.PRECISION_SUFFIXES
+        :param download_base_url: The hub, or a mirror with the same layout
+        :param download_connections: Chunks of one file fetched at once
+        """
+        self.executor = executor
+        self.model_dir = model_dir
+        self.skip_auto_download = skip_auto_download
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait_ms = max_batch_wait_ms
+        self.precision = precision
+        self.download_base_url = download_base_url
+        self.download_connections = download_connections
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._pinned = set()
+        self._lock = threading.Lock()
+
+    @property
+    def entries(self) -> dict:
+        return dict(self._entries)
+
+    @property
+    def loaded_bytes(self) -> int:
+        return sum(entry.size_bytes for entry in self._entries.values())
+
+    def resolve_files(self, model_name: str):
+        """
+        Download the model and csv if needed, both at once
+        :return: fp32 model_path, tag_csv_path
+        :raises: FileNotFoundError, DownloadError, FileSizeMismatchError
+        """
+        if self.skip_auto_download:
+            model_path = (
+                pathlib.Path(self.model_dir).joinpath(f"{model_name}.onnx").absolute()
+            )
+            tag_csv_path = (
+                pathlib.Path(self.model_dir).joinpath(f"{model_name}.csv").absolute()
+            )
+            if not model_path.exists():
+                raise FileNotFoundError(f"Model {model_name} not exists")
+            if not tag_csv_path.exists():
+                raise FileNotFoundError(f"Tagger CSV {model_name} not exists")
+            return str(model_path), str(tag_csv_path)
+        return asyncio.run(
+            download_model_files(
+                model_name,
+                file_dir=self.model_dir,
+                base_url=self.download_base_url,
+                connections=self.download_connections,
+            )
+        )
+
+    def _get_loaded(self, model_name: str):
+        entry = self._entries.get(model_name)
+        if entry is not None:
+            self._entries.move_to_end(model_name)
+        return entry
+
+    def load(self, model_name: str, pin: bool = False) -> ModelEntry:
+        """
+        Get a loaded model, loading it in this thread if needed.
+        Concurrent callers asking for the same model wait for a single load.
+        :param pin: Never evict this model
+        """
+        with self._lock:
+            entry = self._get_loaded(model_name)
+            if entry is not None:
+                if pin:
+                    self._pinned.add(model_name)
+                return entry
+            future = self._loading.get(model_name)
+            if future is None:
+                future = self._loading[model_name] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            entry = future.result()
+            if pin:
+                with self._lock:
+                    self._pinned.add(model_name)
+            return entry
+        try:
+            entry = self._load(model_name)
+        except BaseException as e:
+            with self._lock:
+                self._loading.pop(model_name, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            # Pinned only once loaded, a failed load leaves nothing behind
+            if pin:
+                self._pinned.add(model_name)
+            self._entries[model_name] = entry
+            self._loading.pop(model_name, None)
+            self._evict()
+        future.set_result(entry)
+        return entry
+
+    def unload(self, model_name: str, timeout: float = None) -> bool:
+        """
+        Stop handing out a model, wait for the requests using it and free its session
+        :param timeout: Longest wait for in-flight requests, None waits for all of them
+        :return: False if requests were still using the model at the timeout
+        """
+        with self._lock:
+            self._pinned.discard(model_name)
+            entry = self._entries.pop(model_name, None)
+        if entry is None:
+            return True
+        if not entry.wait_idle(timeout):
+            logger.warning(
+                f"Model {model_name} still has {entry.active} requests, "
+                "freed once they finish"
+            )
+            self._release_when_idle(entry)
+            return False
+        self._release(entry)
+        logger.info(f"Model {model_name} unloaded")
+        return True
+
+    @staticmethod
+    def _release(entry: ModelEntry):
+        # The batch collectors hold the session, they must stop for it to be freed
+        entry.scheduler.close()
+        OnnxRuntimeManager.release(entry.model_path)
+
+    def _release_when_idle(self, entry: ModelEntry):
+        def release():
+            entry.wait_idle()
+            self._release(entry)
+
+        threading.Thread(target=release, daemon=True).start()
+
+    async def get(self, model_name: str) -> ModelEntry:
+        """
+        Get a loaded model, loads run outside of the event loop and the inference
+        workers
+        """
+        with self._lock:
+            entry = self._get_loaded(model_name)
+            future = self._loading.get(model_name)
+        if entry is not None:
+            return entry
+        if future is not None:
+            return await asyncio.wrap_future(future)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.load, model_name)
+
+    def _load(self, model_name: str) -> ModelEntry:
+        logger.info(f"Loading model {model_name}...")
+        start = time.perf_counter()
+        model_path, tag_csv_path = self.resolve_files(model_name)
+        model_path = ensure_precision(model_path, self.precision)
+        predictor = Predictor.load(model_path=model_path, tag_csv_path=tag_csv_path)
+        predictor.warmup(batch_size=self.max_batch_size)
+        scheduler = BatchScheduler(
+            run_batch=predictor.run,
+            executor=self.executor,
+            max_batch_size=self.max_batch_size,
+            max_wait_ms=self.max_batch_wait_ms,
+        )
+        load_seconds = time.perf_counter() - start
+        logger.info(f"Model {model_name} loaded and warmed up in {load_seconds:.2f}s")
+        return ModelEntry(
+            model_name=model_name,
+            model_path=model_path,
+            tag_csv_path=tag_csv_path,
+            predictor=predictor,
+            scheduler=scheduler,
+            load_seconds=load_seconds,
+        )
+
+    def _evict(self):
+        if self.memory_budget <= 0:
+            return
+        for model_name in list(self._entries)[:-1]:
+            if self.loaded_bytes <= self.memory_budget:
+                break
+            if model_name in self._pinned:
+                continue
+            entry = self._entries.pop(model_name)
+            # Requests already holding the entry keep the session until they finish
+            self._release_when_idle(entry)
+            logger.info(f"Model {model_name} evicted to stay in memory budget")
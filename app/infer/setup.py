@@ -1,76 +1,376 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
 import pathlib
-from urllib.error import URLError
+import re
+import time
+from typing import Optional, Tuple
 
+import aiohttp
 from loguru import logger
-from robust_downloader import download
 
+from .error import DownloadError, FileSizeMismatchError
+from .load import file_lock
 
-async def download_file(file_name: str, file_url: str, file_dir: str):
+HF_ENDPOINT = "https://huggingface.co"
+CONNECTIONS = 4
+CHUNK_SIZE = 16 * 1024 * 1024
+RETRIES = 3
+_READ_SIZE = 1024 * 1024
+# Large files on the hub are stored in LFS, their etag is the sha256 of the content
+_SHA256 = re.compile(r"[0-9a-f]{64}")
+_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+
+
+def model_urls(model_name: str, base_url: str = HF_ENDPOINT) -> Tuple[str, str]:
+    """
+    :param base_url: The hub, or a mirror with the same layout
+    :return: model url, csv url
     """
-    Download file from url
+    repo = f"{base_url.rstrip('/')}/SmilingWolf/{model_name}/resolve/main"
+    return f"{repo}/model.onnx", f"{repo}/selected_tags.csv"
+
+
+async def download_file(
+    file_name: str,
+    file_url: str,
+    file_dir: str,
+    session: Optional[aiohttp.ClientSession] = None,
+    connections: int = CONNECTIONS,
+    chunk_size: int = CHUNK_SIZE,
+) -> str:
+    """
+    Download file from url, in chunks fetched in parallel when the server takes ranges.
+    An interrupted download resumes from its finished chunks. A file downloaded before
+    is used without asking the server, as long as its size and mtime are unchanged.
     :param file_name: File name
     :param file_url: File url
     :param file_dir: The directory to store the file
-    :return: None
+    :param connections: Chunks fetched at once
+    :return: Path of the file
     :raises: DownloadError, FileSizeMismatchError
     """
-    if download(url=file_url, folder=file_dir, filename=file_name):
-        logger.success(f"Download file {file_name} from {file_url} success")
+    path = os.path.join(file_dir, file_name)
+    if _is_cached(path):
+        return path
+    if session is None:
+        async with aiohttp.ClientSession(timeout=_TIMEOUT, trust_env=True) as session:
+            return await download_file(
+                file_name, file_url, file_dir, session, connections, chunk_size
+            )
+    # Forked workers starting together share the .part files, one downloads while the
+    # others wait
+    async with _locked(f"{path}.lock"):
+        if _is_cached(path):
+            return path
+        return await _download(
+            path, file_name, file_url, session, connections, chunk_size
+        )
 
 
-async def download_model(model_name: str, file_dir: str = "models") -> str:
+async def _download(
+    path: str, file_name: str, file_url: str, session, connections: int, chunk_size: int
+) -> str:
+    url, size, etag, ranged = await _probe(session, file_url)
+    sha256 = etag if etag and _SHA256.fullmatch(etag) else None
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        # Downloaded before the metadata was kept, adopted if it matches the remote file
+        if sha256 is None or await _sha256(path) == sha256:
+            _write_json(_meta_path(path), _meta(path, file_url, etag))
+            return path
+    start = time.perf_counter()
+    part_path = f"{path}.part"
+    if ranged and size:
+        chunks = -(-size // chunk_size)
+        logger.info(
+            f"Downloading {file_name} ({size / 2**20:.1f} MB) from {file_url}, "
+            f"{chunks} chunks over {min(connections, chunks)} connections"
+        )
+        await _fetch_chunks(
+            session, url, part_path, size, etag, connections, chunk_size
+        )
+    else:
+        logger.info(f"Downloading {file_name} from {file_url}")
+        with open(part_path, "wb"):
+            pass
+        await _fetch_range(session, url, part_path, 0, None)
+    downloaded = os.path.getsize(part_path)
+    if size is not None and downloaded != size:
+        raise FileSizeMismatchError(
+            f"{file_name} is {downloaded} bytes, the server announced {size}"
+        )
+    if sha256 is not None and await _sha256(part_path) != sha256:
+        _remove(part_path, f"{part_path}.json")
+        raise DownloadError(f"{file_name} does not match its sha256 {sha256}")
+    os.replace(part_path, path)
+    _remove(f"{part_path}.json")
+    _write_json(_meta_path(path), _meta(path, file_url, etag))
+    logger.success(
+        f"Download file {file_name} from {file_url} success "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+    return path
+
+
+async def download_model(
+    model_name: str,
+    file_dir: str = "models",
+    base_url: str = HF_ENDPOINT,
+    session: Optional[aiohttp.ClientSession] = None,
+    connections: int = CONNECTIONS,
+) -> str:
     """
     Download model from url
     :param model_name: Model name
     :param file_dir: The directory to store the file
-    :return: None
+    :return: Absolute path of the model
+    :raises: DownloadError, FileSizeMismatchError
     """
-    # Get Current Path / Create models folder
-    pathlib.Path(file_dir).mkdir(parents=True, exist_ok=True)
-    # Download
-    model_url = (
-        f"https://huggingface.co/SmilingWolf/{model_name}/resolve/main/model.onnx"
+    model_url, _ = model_urls(model_name, base_url)
+    return await _download_or_keep(
+        "Model", f"{model_name}.onnx", model_url, file_dir, session, connections
     )
-    ab_path = pathlib.Path(file_dir).joinpath(f"{model_name}.onnx").absolute()
-    try:
-        await download_file(f"{model_name}.onnx", model_url, file_dir=file_dir)
-    except URLError:
-        if pathlib.Path(file_dir).joinpath(f"{model_name}.onnx").exists():
-            logger.warning(
-                f"Model {model_name} download failed, but file exists, skip download"
-            )
-            return str(ab_path)
-        raise URLError(f"Model {model_name} download failed")
-    except Exception as e:
-        raise e
-    else:
-        logger.info(f"Model {model_name} downloaded at {ab_path}")
-    return str(ab_path)
 
 
-async def download_csv(model_name: str, file_dir: str = "models") -> str:
+async def download_csv(
+    model_name: str,
+    file_dir: str = "models",
+    base_url: str = HF_ENDPOINT,
+    session: Optional[aiohttp.ClientSession] = None,
+    connections: int = CONNECTIONS,
+) -> str:
     """
     Download csv from url
     :param model_name: Model name
     :param file_dir: The directory to store the file
-    :return: None
+    :return: Absolute path of the csv
+    :raises: DownloadError, FileSizeMismatchError
+    """
+    _, csv_url = model_urls(model_name, base_url)
+    return await _download_or_keep(
+        "Tagger CSV", f"{model_name}.csv", csv_url, file_dir, session, connections
+    )
+
+
+async def download_model_files(
+    model_name: str,
+    file_dir: str = "models",
+    base_url: str = HF_ENDPOINT,
+    connections: int = CONNECTIONS,
+) -> Tuple[str, str]:
+    """
+    Download the model and its csv at the same time
+    :return: model_path, tag_csv_path
+    :raises: DownloadError, FileSizeMismatchError
     """
+    async with aiohttp.ClientSession(timeout=_TIMEOUT, trust_env=True) as session:
+        model_path, tag_csv_path = await asyncio.gather(
+            download_model(model_name, file_dir, base_url, session, connections),
+            download_csv(model_name, file_dir, base_url, session, connections),
+        )
+    return model_path, tag_csv_path
+
+
+async def _download_or_keep(
+    kind: str, file_name: str, file_url: str, file_dir: str, session, connections: int
+) -> str:
     # Get Current Path / Create models folder
     pathlib.Path(file_dir).mkdir(parents=True, exist_ok=True)
-    # Download
-    csv_url = f"https://huggingface.co/SmilingWolf/{model_name}/resolve/main/selected_tags.csv"
-    ab_path = pathlib.Path(file_dir).joinpath(f"{model_name}.csv").absolute()
+    ab_path = pathlib.Path(file_dir).joinpath(file_name).absolute()
     try:
-        await download_file(f"{model_name}.csv", csv_url, file_dir=file_dir)
-    except URLError:
-        if pathlib.Path(file_dir).joinpath(f"{model_name}.csv").exists():
-            logger.warning(
-                f"Tagger CSV {model_name} download failed, but file exists, skip download"
-            )
+        await download_file(
+            file_name, file_url, file_dir, session=session, connections=connections
+        )
+    except (DownloadError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        if ab_path.exists():
+            logger.warning(f"{kind} {file_name} download failed, but file exists: {e}")
             return str(ab_path)
-        raise URLError(f"Model {model_name} download failed")
-    except Exception as e:
-        raise e
-    else:
-        logger.info(f"Tagger CSV {model_name} downloaded at {ab_path}")
+        raise DownloadError(f"{kind} {file_name} download failed: {e}") from e
     return str(ab_path)
+
+
+async def _probe(session: aiohttp.ClientSession, url: str):
+    """
+    :return: url after redirects, size, etag, whether ranges are accepted
+    """
+    async with session.head(url, allow_redirects=True) as response:
+        response.raise_for_status()
+        size = etag = None
+        # The hub answers with the LFS hash before redirecting to the storage
+        for hop in (*response.history, response):
+            etag = etag or hop.headers.get("X-Linked-Etag")
+            size = size or hop.headers.get("X-Linked-Size")
+        etag = etag or response.headers.get("ETag")
+        size = size or response.headers.get("Content-Length")
+        ranged = response.headers.get("Accept-Ranges") == "bytes"
+        return (
+            str(response.url),
+            int(size) if size is not None else None,
+            etag.removeprefix("W/").strip('"') if etag else None,
+            ranged,
+        )
+
+
+async def _fetch_chunks(
+    session,
+    url: str,
+    part_path: str,
+    size: int,
+    etag,
+    connections: int,
+    chunk_size: int,
+):
+    state_path = f"{part_path}.json"
+    state = _read_json(state_path)
+    fresh = {"etag": etag, "size": size, "chunk_size": chunk_size}
+    if (
+        state is None
+        or any(state.get(key) != value for key, value in fresh.items())
+        or not os.path.exists(part_path)
+    ):
+        state = dict(fresh, done=[])
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+        _write_json(state_path, state)
+    elif state["done"]:
+        logger.info(f"Resuming {part_path}, {len(state['done'])} chunks already done")
+    done = set(state["done"])
+    semaphore = asyncio.Semaphore(connections)
+
+    async def fetch_chunk(index: int):
+        async with semaphore:
+            start = index * chunk_size
+            await _fetch_range(
+                session, url, part_path, start, min(start + chunk_size, size)
+            )
+            done.add(index)
+            _write_json(state_path, dict(state, done=sorted(done)))
+
+    tasks = [
+        asyncio.ensure_future(fetch_chunk(index))
+        for index in range(-(-size // chunk_size))
+        if index not in done
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def _fetch_range(
+    session, url: str, part_path: str, start: int, end: Optional[int]
+):
+    """
+    Write bytes [start, end) of the url into the file, the whole body if end is None.
+    Retried with backoff from where it stopped, except on client errors.
+    """
+    offset = start
+    for attempt in range(RETRIES + 1):
+        if end is None:
+            offset = start
+        headers = {"Range": f"bytes={offset}-{end - 1}"} if end is not None else None
+        try:
+            async with session.get(url, headers=headers) as response:
+                response.raise_for_status()
+                if headers is not None and response.status != 206:
+                    raise DownloadError(f"{url} ignored the range {headers['Range']}")
+                with open(part_path, "r+b") as f:
+                    f.seek(offset)
+                    if end is None:
+                        f.truncate()
+                    async for data in response.content.iter_chunked(_READ_SIZE):
+                        f.write(data)
+                        offset += len(data)
+            if end is None or offset >= end:
+                return
+            raise aiohttp.ClientPayloadError(f"Connection closed at byte {offset}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if isinstance(e, aiohttp.ClientResponseError) and e.status < 500:
+                raise DownloadError(f"{url} failed: {e}") from e
+            if attempt == RETRIES:
+                raise DownloadError(f"{url} failed after {RETRIES} retries: {e}") from e
+            logger.warning(f"{url} failed at byte {offset}, retrying: {e}")
+            await asyncio.sleep(2**attempt)
+
+
+@contextlib.asynccontextmanager
+async def _locked(path: str):
+    """
+    file_lock taken in a thread, so waiting for other processes never blocks the event
+    loop
+    """
+    lock = file_lock(path)
+    acquired = asyncio.get_running_loop().run_in_executor(None, lock.__enter__)
+    try:
+        await asyncio.shield(acquired)
+    except asyncio.CancelledError:
+        acquired.add_done_callback(lambda _: lock.__exit__(None, None, None))
+        raise
+    try:
+        yield
+    finally:
+        lock.__exit__(None, None, None)
+
+
+def _meta_path(path: str) -> str:
+    return f"{path}.download.json"
+
+
+def _meta(path: str, url: str, etag: Optional[str]) -> dict:
+    stat = os.stat(path)
+    return {
+        "url": url,
+        "etag": etag,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def _is_cached(path: str) -> bool:
+    meta = _read_json(_meta_path(path))
+    if meta is None:
+        return False
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    return stat.st_size == meta.get("size") and stat.st_mtime_ns == meta.get("mtime_ns")
+
+
+async def _sha256(path: str) -> str:
+    def digest():
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(_READ_SIZE), b""):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    return await asyncio.get_running_loop().run_in_executor(None, digest)
+
+
+def _read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path: str, value: dict):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(value, f)
+    os.replace(temp_path, path)
+
+
+def _remove(*paths: str):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
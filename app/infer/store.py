@@ -0,0 +1,293 @@
+import math
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from loguru import logger
+
+STORE_DTYPES = {"uint8": np.uint8, "float16": np.float16}
+# Postings keep the probability in 1/255 steps whatever the dtype of the rows
+_LEVELS = 255
+_GROW_ROWS = 4096
+
+
+class ProbabilityStore(object):
+    def __init__(self, path: str, dtype: str = "uint8", index_threshold: float = 0.1):
+        """
+        Full prediction vectors by image id and model, kept so new thresholds never need
+        the model again.
+        Rows live in a memory-mapped matrix per model, the ids and an inverted index of
+        the tags scoring at least index_threshold live in a sqlite file next to it.
+        Several processes can write to the same store.
+        :param path: Directory of the store
+        :param dtype: uint8 rounds to 1/255 and takes a byte per tag, float16 takes two
+        :param index_threshold: Lowest probability searches can ask for
+        """
+        if dtype not in STORE_DTYPES:
+            raise ValueError(f"dtype must be in {list(STORE_DTYPES)}")
+        self.path = path
+        self.dtype = dtype
+        self.index_threshold = index_threshold
+        self._models = {}
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        logger.info(f"Probability store at {path}")
+
+    def put(self, model_name: str, image_id: str, preds: np.ndarray):
+        """
+        Store the [num_tags] probabilities of an image, replacing what the id had before
+        """
+        with self._lock:
+            self._open(model_name, len(preds)).put(image_id, preds)
+
+    def get(self, model_name: str, image_ids: Sequence[str]) -> Tuple[list, np.ndarray]:
+        """
+        :return: The ids found, in order, and their [n, num_tags] float32 probabilities
+        """
+        with self._lock:
+            store = self._open(model_name)
+            if store is None:
+                return [], np.empty((0, 0), dtype=np.float32)
+            return store.get(image_ids)
+
+    def search(
+        self,
+        model_name: str,
+        tag_indexes: Sequence[int],
+        threshold: float,
+        limit: int = 100,
+        offset: int = 0,
+    ) -> Tuple[list, np.ndarray]:
+        """
+        Images scoring at least threshold on every tag, in the order they were stored
+        :param tag_indexes: Columns of the tags in the model's csv
+        :return: image ids, and their [n, len(tag_indexes)] float32 probabilities of
+            those tags
+        :raises: ValueError if threshold is below index_threshold
+        """
+        if threshold < self.index_threshold:
+            raise ValueError(
+                f"threshold must be at least the index threshold {self.index_threshold}"
+            )
+        with self._lock:
+            store = self._open(model_name)
+            if store is None:
+                return [], np.empty((0, len(tag_indexes)), dtype=np.float32)
+            return store.search(tag_indexes, threshold, limit, offset)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: Stored images by model
+        """
+        with self._lock:
+            return {name: store.count() for name, store in self._models.items()}
+
+    def close(self):
+        with self._lock:
+            for store in self._models.values():
+                store.close()
+            self._models.clear()
+
+    def _open(self, model_name: str, num_tags: Optional[int] = None):
+        store = self._models.get(model_name)
+        if store is not None:
+            return store
+        db_path = os.path.join(self.path, f"{model_name}.sqlite3")
+        if num_tags is None and not os.path.exists(db_path):
+            return None
+        store = _ModelStore(
+            db_path=db_path,
+            rows_path=os.path.join(self.path, f"{model_name}.{self.dtype}.rows"),
+            dtype=STORE_DTYPES[self.dtype],
+            num_tags=num_tags,
+            index_level=_level(self.index_threshold),
+        )
+        self._models[model_name] = store
+        return store
+
+
+class _ModelStore(object):
+    def __init__(
+        self,
+        db_path: str,
+        rows_path: str,
+        dtype,
+        num_tags: Optional[int],
+        index_level: int,
+    ):
+        self.rows_path = rows_path
+        self.dtype = np.dtype(dtype)
+        self.index_level = index_level
+        self._rows = None
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # Let sqlite map the index instead of copying pages into its own cache
+        self._db.execute("PRAGMA mmap_size=1073741824")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+            CREATE TABLE IF NOT EXISTS images (
+                row INTEGER PRIMARY KEY, image_id TEXT NOT NULL UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                tag INTEGER, level INTEGER, row INTEGER, PRIMARY KEY (tag, level, row)
+            ) WITHOUT ROWID;
+            """)
+        stored = self._db.execute(
+            "SELECT value FROM meta WHERE key = 'num_tags'"
+        ).fetchone()
+        if stored is None:
+            self._db.execute("INSERT INTO meta VALUES ('num_tags', ?)", (num_tags,))
+            self._db.commit()
+        elif num_tags is not None and stored[0] != num_tags:
+            raise ValueError(
+                f"{db_path} holds {stored[0]} tags per image, the model has {num_tags}"
+            )
+        self.num_tags = stored[0] if stored is not None else num_tags
+
+    def put(self, image_id: str, preds: np.ndarray):
+        preds = np.asarray(preds, dtype=np.float32)
+        # Serializes the row allocation and the file growth with other processes
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            found = self._db.execute(
+                "SELECT row FROM images WHERE image_id = ?", (image_id,)
+            ).fetchone()
+            if found is not None:
+                row = found[0]
+                rows = self._mapped(row)
+                self._db.executemany(
+                    "DELETE FROM postings WHERE tag = ? AND level = ? AND row = ?",
+                    self._postings(row, _dequantize(rows[row])),
+                )
+            else:
+                row = self._db.execute(
+                    "SELECT COALESCE(MAX(row) + 1, 0) FROM images"
+                ).fetchone()[0]
+                self._db.execute(
+                    "INSERT INTO images (row, image_id) VALUES (?, ?)", (row, image_id)
+                )
+                rows = self._mapped(row, grow=True)
+            rows[row] = _quantize(preds, self.dtype)
+            # From the stored values, so replacing the row later finds the same postings
+            self._db.executemany(
+                "INSERT INTO postings (tag, level, row) VALUES (?, ?, ?)",
+                self._postings(row, _dequantize(rows[row])),
+            )
+            self._db.commit()
+        except BaseException:
+            self._db.rollback()
+            raise
+
+    def get(self, image_ids: Sequence[str]) -> Tuple[list, np.ndarray]:
+        if not image_ids:
+            return [], np.empty((0, self.num_tags), dtype=np.float32)
+        found = dict(
+            self._db.execute(
+                "SELECT image_id, row FROM images "
+                f"WHERE image_id IN ({_marks(image_ids)})",
+                list(image_ids),
+            ).fetchall()
+        )
+        ids = [image_id for image_id in image_ids if image_id in found]
+        row_numbers = [found[image_id] for image_id in ids]
+        if not row_numbers:
+            return [], np.empty((0, self.num_tags), dtype=np.float32)
+        rows = self._mapped(max(row_numbers))
+        return ids, _dequantize(rows[row_numbers])
+
+    def search(
+        self, tag_indexes: Sequence[int], threshold: float, limit: int, offset: int
+    ) -> Tuple[list, np.ndarray]:
+        # Rounded up, rounding down would let probabilities under the threshold in
+        level = max(_ceil_level(threshold), self.index_level)
+        query = " INTERSECT ".join(
+            ["SELECT row FROM postings WHERE tag = ? AND level >= ?"] * len(tag_indexes)
+        )
+        params = [value for tag in tag_indexes for value in (int(tag), level)]
+        row_numbers = [
+            row
+            for row, in self._db.execute(
+                f"{query} ORDER BY row LIMIT ? OFFSET ?", params + [limit, offset]
+            )
+        ]
+        if not row_numbers:
+            return [], np.empty((0, len(tag_indexes)), dtype=np.float32)
+        ids = dict(
+            self._db.execute(
+                "SELECT row, image_id FROM images "
+                f"WHERE row IN ({_marks(row_numbers)})",
+                row_numbers,
+            ).fetchall()
+        )
+        rows = self._mapped(max(row_numbers))
+        probs = _dequantize(rows[np.ix_(row_numbers, list(tag_indexes))])
+        return [ids[row] for row in row_numbers], probs
+
+    def count(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def close(self):
+        self._rows = None
+        self._db.close()
+
+    def _postings(self, row: int, preds: np.ndarray) -> List[tuple]:
+        levels = _levels(preds)
+        tags = np.flatnonzero(levels >= self.index_level)
+        return [(int(tag), int(levels[tag]), row) for tag in tags]
+
+    def _mapped(self, row: int, grow: bool = False) -> np.memmap:
+        """
+        The rows mapped up to row at least, remapped when other processes or this one
+        grew the file
+        """
+        if self._rows is not None and row < len(self._rows):
+            return self._rows
+        row_bytes = self.num_tags * self.dtype.itemsize
+        size = os.path.getsize(self.rows_path) if os.path.exists(self.rows_path) else 0
+        if size < (row + 1) * row_bytes:
+            if not grow:
+                raise LookupError(f"Row {row} is past the end of {self.rows_path}")
+            # Doubled, so appending millions of rows only remaps a few dozen times
+            capacity = max(_GROW_ROWS, row + 1, 2 * (size // row_bytes))
+            with open(self.rows_path, "ab") as f:
+                f.truncate(capacity * row_bytes)
+            size = capacity * row_bytes
+        self._rows = np.memmap(
+            self.rows_path,
+            dtype=self.dtype,
+            mode="r+",
+            shape=(size // row_bytes, self.num_tags),
+        )
+        return self._rows
+
+
+def _level(probability: float) -> int:
+    return int(np.clip(np.rint(probability * _LEVELS), 0, _LEVELS))
+
+
+def _ceil_level(probability: float) -> int:
+    # Rounded first, so thresholds on the grid like 0.8 keep their own level
+    return int(np.clip(math.ceil(round(probability * _LEVELS, 6)), 0, _LEVELS))
+
+
+def _levels(preds: np.ndarray) -> np.ndarray:
+    return np.clip(np.rint(np.asarray(preds, dtype=np.float32) * _LEVELS), 0, _LEVELS)
+
+
+def _quantize(preds: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    if dtype == np.uint8:
+        return _levels(preds).astype(np.uint8)
+    return preds.astype(dtype)
+
+
+def _dequantize(rows: np.ndarray) -> np.ndarray:
+    if rows.dtype == np.uint8:
+        return rows.astype(np.float32) / _LEVELS
+    return rows.astype(np.float32)
+
+
+def _marks(values: Sequence) -> str:
+    return ", ".join("?" * len(values))
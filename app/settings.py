@@ -4,6 +4,7 @@
 # @File    : settings.py
 # @Software: PyCharm
 import pathlib
+from typing import Literal, Optional
 
 from dotenv import load_dotenv
 from loguru import logger
@@ -19,6 +20,70 @@ class InferSetting(BaseSettings):
     wd_model_name: str = "wd-swinv2-tagger-v3"
     wd_model_dir: str = "models"
     skip_auto_download: bool = False
+    # Hugging Face, or a mirror with the same layout. Downloads resume and fetch chunks
+    # in parallel
+    hf_endpoint: str = "https://huggingface.co"
+    download_connections: int = 4
+    # Other models are loaded on request, least recently used ones are dropped
+    # when their files exceed this many MB in total, 0 keeps everything
+    wd_model_memory_budget_mb: int = 0
+    # int8 is quantized from the downloaded model on first load, int8-static with
+    # `cli.py quantize`
+    wd_model_precision: Literal["fp32", "int8", "int8-static"] = "fp32"
+    # Worker threads running the model, each one runs a whole session at a time
+    infer_workers: int = 1
+    # Requests allowed to wait for a free worker before answering 503
+    infer_queue_size: int = 32
+    infer_retry_after: int = 1
+    # Enables /admin/model to swap the default model at runtime, the swap is not saved
+    # to .env
+    admin_token: Optional[str] = None
+    # On SIGTERM /readyz fails for drain_delay seconds, then queued requests get up to
+    # drain_timeout seconds to finish before the server stops
+    drain_delay: float = 0.0
+    drain_timeout: float = 30.0
+    # Concurrent images are merged into one model run of up to this many rows
+    max_batch_size: int = 8
+    max_batch_wait_ms: float = 5.0
+    # Raw predictions of seen images, so repeated uploads skip the model
+    result_cache_enabled: bool = False
+    result_cache_max_mb: int = 64
+    # Sqlite file keeping the cache across restarts, empty for memory only
+    result_cache_path: Optional[str] = None
+    # Directory keeping the full predictions of uploads sent with an image_id,
+    # searchable by tag and thresholded again without the model. uint8 takes a byte
+    # per tag, float16 two
+    prob_store_path: Optional[str] = None
+    prob_store_dtype: Literal["uint8", "float16"] = "uint8"
+    # Only tags scoring at least this are indexed, searches can't ask for less
+    prob_store_index_threshold: float = 0.1
+    # /upload?tiles=true runs the whole image and overlapping crops of it in one batch
+    # of up to this many rows, for large or very long images whose detail is lost when
+    # shrunk
+    tile_max_count: int = 8
+    tile_overlap: float = 0.25
+    # Uploads over this many MB, or images over this many pixels, are answered with 413
+    # before being decoded, 0 disables the limit
+    max_upload_mb: int = 32
+    max_image_pixels: int = 89_478_485
+    # Serve per-stage latency histograms at /metrics, the hooks are no-ops while
+    # disabled
+    metrics_enabled: bool = False
+    # Processes decoding and resizing uploads, apart from the ORT threads, 0 keeps it in
+    # the workers
+    preprocess_workers: int = 0
+    # ONNX Runtime session, 0 threads lets ORT decide
+    ort_intra_op_threads: int = 0
+    ort_inter_op_threads: int = 0
+    ort_graph_optimization_level: Literal["disable", "basic", "extended", "all"] = "all"
+    ort_execution_mode: Literal["sequential", "parallel"] = "sequential"
+    ort_enable_mem_arena: bool = True
+    # Save the optimized graph next to the model, later starts skip the optimization
+    ort_optimized_model_cache: bool = True
+    # Map the model weights from a file instead of copying them, so the workers of
+    # SERVER_WORKERS share one copy. Turns off weight prepacking, which is slower
+    # on some CPUs
+    ort_shared_weights: bool = False
 
     model_config = SettingsConfigDict(
         env_file=".env", env_file_encoding="utf-8", extra="ignore"
@@ -39,6 +104,21 @@ class InferSetting(BaseSettings):
             logger.success(f"model_dir {model_dir_obj.absolute()} created")
         if not model_dir_obj.is_dir():
             raise ValueError(f"model_dir {self.wd_model_dir} is not a dir")
+        if self.infer_workers < 1:
+            raise ValueError("infer_workers must be greater than 0")
+        if self.infer_queue_size < 0:
+            raise ValueError("infer_queue_size must not be negative")
+        if self.preprocess_workers < 0:
+            raise ValueError("preprocess_workers must not be negative")
+        if self.max_upload_mb < 0 or self.max_image_pixels < 0:
+            raise ValueError("max_upload_mb and max_image_pixels must not be negative")
+        if self.max_batch_size < 1:
+            raise ValueError("max_batch_size must be greater than 0")
+        if self.infer_queue_size < self.max_batch_size:
+            logger.warning(
+                "infer_queue_size is smaller than max_batch_size, "
+                "batches will never fill up"
+            )
         return self
 
     @property
@@ -47,5 +127,21 @@ class InferSetting(BaseSettings):
         model_path = model_dir_obj.joinpath(self.wd_model_name + ".onnx")
         return model_path
 
+    @property
+    def ort_options(self) -> dict:
+        """
+        Keyword arguments of OnnxRuntimeManager.configure, the server and the CLI
+        create the same sessions
+        """
+        return dict(
+            intra_op_threads=self.ort_intra_op_threads,
+            inter_op_threads=self.ort_inter_op_threads,
+            graph_optimization_level=self.ort_graph_optimization_level,
+            execution_mode=self.ort_execution_mode,
+            enable_mem_arena=self.ort_enable_mem_arena,
+            optimized_model_cache=self.ort_optimized_model_cache,
+            shared_weights=self.ort_shared_weights,
+        )
+
 
 InferSettingCurrent = InferSetting()
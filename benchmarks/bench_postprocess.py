@@ -0,0 +1,78 @@
+"""
+Compare per image post-processing of the legacy tuple based code and
+Predictor.postprocess_batch
+
+    python -m benchmarks.bench_postprocess --tags 10861 --batch 8
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+
+from app.infer import Predictor
+from benchmarks.legacy import legacy_postprocess
+
+
+def make_predictor(num_tags: int, seed: int = 0) -> Predictor:
+    rng = np.random.default_rng(seed)
+    # Roughly the category layout of the v3 taggers
+    categories = np.where(rng.random(num_tags) < 0.75, 0, 4)
+    categories[:4] = 9
+    return Predictor(
+        model=None,
+        model_target_size=448,
+        tag_names=[f"tag_{i}" for i in range(num_tags)],
+        rating_indexes=list(np.where(categories == 9)[0]),
+        general_indexes=list(np.where(categories == 0)[0]),
+        character_indexes=list(np.where(categories == 4)[0]),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tags", type=int, default=10861)
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--mcut", action="store_true")
+    args = parser.parse_args()
+
+    predictor = make_predictor(args.tags)
+    preds = (
+        np.random.default_rng(1)
+        .beta(0.3, 3, size=(args.batch, args.tags))
+        .astype(np.float32)
+    )
+    kwargs = dict(
+        general_thresh=0.35,
+        general_mcut_enabled=args.mcut,
+        character_thresh=0.85,
+        character_mcut_enabled=args.mcut,
+    )
+
+    def legacy():
+        for row in preds:
+            legacy_postprocess(
+                predictor.tag_names,
+                predictor.rating_indexes,
+                predictor.general_indexes,
+                predictor.character_indexes,
+                row,
+                **kwargs,
+            )
+
+    def single():
+        for row in preds:
+            predictor.postprocess(row, **kwargs)
+
+    def batch():
+        predictor.postprocess_batch(preds, **kwargs)
+
+    print(f"tags={args.tags} batch={args.batch} mcut={args.mcut}")
+    for name, func in (("legacy", legacy), ("postprocess", single), ("batch", batch)):
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(f"{name:>12}: {best / args.batch * 1000:8.3f} ms/image")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Reference implementations of hot paths which have been rewritten,
+kept to check the new code gives the same answers and to measure the speedup.
+"""
+
+import numpy as np
+from PIL import Image
+
+
+def legacy_mcut_threshold(probs):
+    sorted_probs = probs[probs.argsort()[::-1]]
+    difs = sorted_probs[:-1] - sorted_probs[1:]
+    t = difs.argmax()
+    thresh = (sorted_probs[t] + sorted_probs[t + 1]) / 2
+    return thresh
+
+
+def legacy_postprocess(
+    tag_names,
+    rating_indexes,
+    general_indexes,
+    character_indexes,
+    preds: np.ndarray,
+    general_thresh: float,
+    general_mcut_enabled: bool,
+    character_thresh: float,
+    character_mcut_enabled: bool,
+):
+    labels = list(zip(tag_names, preds.astype(float)))
+
+    ratings_names = [labels[i] for i in rating_indexes]
+    rating = dict(ratings_names)
+
+    general_names = [labels[i] for i in general_indexes]
+
+    if general_mcut_enabled:
+        general_probs = np.array([x[1] for x in general_names])
+        general_thresh = legacy_mcut_threshold(general_probs)
+
+    general_res = [x for x in general_names if x[1] > general_thresh]
+    general_res = dict(general_res)
+
+    character_names = [labels[i] for i in character_indexes]
+
+    if character_mcut_enabled:
+        character_probs = np.array([x[1] for x in character_names])
+        character_thresh = legacy_mcut_threshold(character_probs)
+        character_thresh = max(0.15, character_thresh)
+
+    character_res = [x for x in character_names if x[1] > character_thresh]
+    character_res = dict(character_res)
+
+    sorted_general_strings = sorted(
+        general_res.items(),
+        key=lambda x: x[1],
+        reverse=True,
+    )
+    sorted_general_strings = [x[0] for x in sorted_general_strings]
+    sorted_general_strings = (
+        ", ".join(sorted_general_strings).replace("(", r"\(").replace(")", r"\)")
+    )
+
+    return sorted_general_strings, rating, character_res, general_res
+
+
+def legacy_prepare_image(image: Image.Image, target_size: int) -> np.ndarray:
+    image = image.convert("RGBA")
+
+    canvas = Image.new("RGBA", image.size, (255, 255, 255))
+    canvas.alpha_composite(image)
+    image = canvas.convert("RGB")
+
+    image_shape = image.size
+    max_dim = max(image_shape)
+    pad_left = (max_dim - image_shape[0]) // 2
+    pad_top = (max_dim - image_shape[1]) // 2
+
+    padded_image = Image.new("RGB", (max_dim, max_dim), (255, 255, 255))
+    padded_image.paste(image, (pad_left, pad_top))
+
+    if max_dim != target_size:
+        padded_image = padded_image.resize(
+            (target_size, target_size),
+            Image.BICUBIC,
+        )
+
+    image_array = np.asarray(padded_image, dtype=np.float32)
+    image_array = image_array[:, :, ::-1]
+
+    return np.expand_dims(image_array, axis=0)
@@ -0,0 +1,305 @@
+"""
+Capacity planning: open-loop load on `python main.py` over a sweep of server settings
+
+    python -m benchmarks.load --rates 5 10 20 40 --workers 1 2 --batch-sizes 1 8
+    python -m benchmarks.load --model-dir models --target-rate 100
+
+Without --model-dir the server runs a tiny generated model with the wd layout (needs
+`pip install onnx`), which measures the server around the model rather than the model.
+Use the real model on the target machine for replica counts.
+
+Requests arrive as a Poisson process at each rate whether or not earlier ones finished,
+like real clients do, so an overloaded server shows up as growing latency and errors
+instead of a slower client. Latency is counted from the time a request was due to be
+sent. Uploads are drawn from --mix. For each setting, the capacity is the highest rate
+whose p99 stays within --slo-ms and whose error rate stays within --max-error-rate.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import sys
+import tempfile
+
+import aiohttp
+import numpy as np
+
+from benchmarks.run import MODEL_NAME, encoded_image
+from benchmarks.workers import memory, server
+
+DEFAULT_MIX = ("320x240=0.3", "1024x768=0.5", "2048x1536=0.15", "800x6000=0.05")
+
+
+def parse_mix(mix) -> list:
+    """
+    :param mix: WIDTHxHEIGHT=WEIGHT items
+    :return: (width, height, probability) with the probabilities summing to 1
+    """
+    sizes = []
+    for item in mix:
+        size, _, weight = item.partition("=")
+        width, height = size.lower().split("x")
+        sizes.append((int(width), int(height), float(weight or 1)))
+    total = sum(weight for _, _, weight in sizes)
+    return [(width, height, weight / total) for width, height, weight in sizes]
+
+
+async def open_loop(
+    base_url: str,
+    images: list,
+    weights: list,
+    rate: float,
+    duration: float,
+    timeout: float = 60,
+    params: dict = None,
+    seed: int = 0,
+) -> list:
+    """
+    POST images to /upload at Poisson arrivals of the rate, for duration seconds
+    :return: (status, seconds since the request was due) per request, status None on a
+        connection error or timeout
+    """
+    rng = np.random.default_rng(seed)
+    gaps = rng.exponential(1 / rate, size=int(rate * duration * 2) + 16)
+    arrivals = np.cumsum(gaps)
+    arrivals = arrivals[arrivals < duration]
+    picks = rng.choice(len(images), size=len(arrivals), p=weights)
+    loop = asyncio.get_running_loop()
+    # No connection limit, a pool would turn the open loop back into a closed one
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=0),
+        timeout=aiohttp.ClientTimeout(total=timeout),
+    ) as session:
+        start = loop.time()
+
+        async def send(at: float, image: bytes):
+            due = start + at
+            await asyncio.sleep(max(0.0, due - loop.time()))
+            form = aiohttp.FormData()
+            form.add_field(
+                "file", image, filename="load.jpg", content_type="image/jpeg"
+            )
+            try:
+                async with session.post(
+                    f"{base_url}/upload", data=form, params=params
+                ) as response:
+                    await response.read()
+                    status = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                status = None
+            return status, loop.time() - due
+
+        return await asyncio.gather(
+            *[send(at, images[pick]) for at, pick in zip(arrivals.tolist(), picks)]
+        )
+
+
+def summarize(results: list, rate: float, duration: float) -> dict:
+    """
+    :param results: What open_loop returned
+    """
+    latencies = np.array([seconds for status, seconds in results if status == 200])
+    errors = sum(1 for status, _ in results if status != 200)
+    # The run lasts until the last answer, a backlog left at the end lowers the
+    # throughput
+    elapsed = max([duration] + [seconds for _, seconds in results])
+    percentiles = (
+        np.percentile(latencies, [50, 95, 99]) * 1000
+        if len(latencies)
+        else [float("nan")] * 3
+    )
+    return {
+        "rate": rate,
+        "requests": len(results),
+        # Drawn at random, short runs may send more or less than the rate
+        "offered": len(results) / duration,
+        "throughput": len(latencies) / elapsed,
+        "error_rate": errors / len(results) if results else 0.0,
+        "rejected": sum(1 for status, _ in results if status == 503),
+        "p50_ms": float(percentiles[0]),
+        "p95_ms": float(percentiles[1]),
+        "p99_ms": float(percentiles[2]),
+    }
+
+
+def capacity(steps: list, slo_ms: float, max_error_rate: float) -> float:
+    """
+    :param steps: summarize results of one setting
+    :return: Highest rate within the SLO, 0 if none is
+    """
+    passing = [
+        step["rate"]
+        for step in steps
+        if step["p99_ms"] <= slo_ms and step["error_rate"] <= max_error_rate
+    ]
+    return max(passing, default=0.0)
+
+
+def run_setting(setting: dict, env: dict, images: list, weights: list, args) -> dict:
+    workers, batch_size = setting["workers"], setting["batch_size"]
+    threads = setting["threads"] or max(1, (os.cpu_count() or 1) // workers)
+    env = dict(env, ORT_INTRA_OP_THREADS=str(threads), MAX_BATCH_SIZE=str(batch_size))
+    steps = []
+    running = server(env, args.port, workers, args.timeout, cwd=args.work_dir)
+    with running as (base_url, process):
+        # Warm-up at the lowest rate, so every worker has run the model before measuring
+        asyncio.run(
+            open_loop(
+                base_url, images, weights, min(args.rates), 2, args.request_timeout
+            )
+        )
+        for rate in sorted(args.rates):
+            results = asyncio.run(
+                open_loop(
+                    base_url,
+                    images,
+                    weights,
+                    rate,
+                    args.duration,
+                    args.request_timeout,
+                    seed=len(steps),
+                )
+            )
+            step = summarize(results, rate, args.duration)
+            steps.append(step)
+            print(
+                f"workers={workers} threads={threads} batch={batch_size} "
+                f"rate={rate:g}/s throughput={step['throughput']:.1f}/s "
+                f"p99={step['p99_ms']:.0f}ms errors={step['error_rate']:.1%}",
+                file=sys.stderr,
+            )
+            if (
+                step["error_rate"] > args.max_error_rate * 10
+                and args.stop_when_saturated
+            ):
+                # Far past saturation, higher rates would only pile up more timeouts
+                break
+        setting_memory = memory(process.pid)
+    setting_capacity = capacity(steps, args.slo_ms, args.max_error_rate)
+    result = dict(
+        setting,
+        intra_op_threads=threads,
+        steps=steps,
+        capacity=setting_capacity,
+        **setting_memory,
+    )
+    if args.target_rate:
+        result["replicas"] = (
+            math.ceil(args.target_rate / setting_capacity) if setting_capacity else None
+        )
+    return result
+
+
+def print_table(results: list):
+    print(
+        f"{'workers':>7} {'threads':>7} {'batch':>5} {'rate/s':>7} {'sent/s':>7} "
+        f"{'done/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}"
+    )
+    for result in results:
+        for step in result["steps"]:
+            print(
+                f"{result['workers']:>7} {result['intra_op_threads']:>7} "
+                f"{result['batch_size']:>5} {step['rate']:>7g} {step['offered']:>7.1f} "
+                f"{step['throughput']:>7.1f} {step['p50_ms']:>8.1f} "
+                f"{step['p95_ms']:>8.1f} {step['p99_ms']:>8.1f} "
+                f"{step['error_rate']:>7.1%}"
+            )
+    print()
+    print(
+        f"{'workers':>7} {'threads':>7} {'batch':>5} {'capacity/s':>10} "
+        f"{'PSS MB':>8} {'replicas':>8}"
+    )
+    for result in sorted(results, key=lambda result: -result["capacity"]):
+        replicas = result.get("replicas")
+        print(
+            f"{result['workers']:>7} {result['intra_op_threads']:>7} "
+            f"{result['batch_size']:>5} {result['capacity']:>10g} "
+            f"{result['pss_bytes'] / 2**20:>8.0f} "
+            f"{'-' if replicas is None else replicas:>8}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--rates", type=float, nargs="+", default=[5, 10, 20, 40])
+    parser.add_argument("--duration", type=float, default=20, help="Seconds per rate")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1])
+    parser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        default=[0],
+        help="ORT threads per worker, 0 splits the cores between the workers",
+    )
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[8])
+    parser.add_argument("--mix", nargs="+", default=list(DEFAULT_MIX))
+    parser.add_argument("--slo-ms", type=float, default=1000, help="p99 latency target")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument(
+        "--target-rate", type=float, help="Requests/s to size replicas for"
+    )
+    parser.add_argument(
+        "--stop-when-saturated",
+        type=lambda value: value.lower() == "true",
+        default=True,
+        help="Skip the higher rates of a setting once errors pass 10x --max-error-rate",
+    )
+    parser.add_argument(
+        "--model-dir", help="Serve this model directory, not a tiny model"
+    )
+    parser.add_argument("--model-name", default=MODEL_NAME)
+    parser.add_argument(
+        "--tags", type=int, default=10861, help="Tags of the tiny model"
+    )
+    parser.add_argument("--port", type=int, default=10120)
+    parser.add_argument("--timeout", type=float, default=300, help="Startup timeout")
+    parser.add_argument("--request-timeout", type=float, default=60)
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args(argv)
+
+    sizes = parse_mix(args.mix)
+    images = [
+        encoded_image(width, height, "RGB", "JPEG", seed=index)
+        for index, (width, height, _) in enumerate(sizes)
+    ]
+    weights = [weight for _, _, weight in sizes]
+    settings = [
+        {"workers": workers, "threads": threads, "batch_size": batch_size}
+        for workers, threads, batch_size in itertools.product(
+            args.workers, args.threads, args.batch_sizes
+        )
+    ]
+    with tempfile.TemporaryDirectory() as work_dir:
+        args.work_dir = work_dir
+        model_dir = os.path.abspath(args.model_dir) if args.model_dir else work_dir
+        if not args.model_dir:
+            from benchmarks.tiny_model import make_tiny_model
+
+            make_tiny_model(model_dir, args.model_name, num_tags=args.tags)
+        env = {
+            "WD_MODEL_DIR": model_dir,
+            "WD_MODEL_NAME": args.model_name,
+            "SKIP_AUTO_DOWNLOAD": "true",
+        }
+        results = [
+            run_setting(setting, env, images, weights, args) for setting in settings
+        ]
+
+    print_table(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(
+                {"mix": args.mix, "slo_ms": args.slo_ms, "results": results},
+                f,
+                indent=2,
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
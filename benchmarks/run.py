@@ -0,0 +1,253 @@
+"""
+Offline benchmark suite of the tagging hot path, on a tiny generated model with the wd
+layout
+
+    python -m benchmarks.run --output bench.json
+    python -m benchmarks.run --output new.json --baseline bench.json --threshold 0.25
+
+Every result is in seconds, lower is better. With --baseline, results slower than the
+baseline by more than the threshold are listed and the exit code is 1.
+Needs `pip install onnx` to build the model.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+MODEL_NAME = "wd-swinv2-tagger-v3"
+STAGES = ("prepare_image", "postprocess", "mcut", "load_labels", "upload")
+PREPARE_SIZES = ((320, 240), (1024, 768), (2048, 1536))
+PREPARE_MODES = (
+    ("RGB", "JPEG"),
+    ("RGB", "PNG"),
+    ("RGBA", "PNG"),
+    ("L", "PNG"),
+    ("P", "PNG"),
+)
+
+
+def encoded_image(width: int, height: int, mode: str, image_format: str, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    # Smooth gradients with some noise, closer to real pictures than pure noise
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack(
+        [x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], -1
+    )
+    pixels = np.clip(base + rng.integers(-16, 16, base.shape), 0, 255).astype(np.uint8)
+    image = Image.fromarray(pixels, "RGB")
+    if mode == "RGBA":
+        image.putalpha(Image.fromarray((x * 255 // width).astype(np.uint8), "L"))
+    elif mode == "P":
+        image = image.quantize(256)
+    else:
+        image = image.convert(mode)
+    buffer = BytesIO()
+    image.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def _best(func, repeat: int, number: int = 1) -> float:
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def bench_prepare_image(repeat: int) -> dict:
+    from app.infer.predictor import prepare_image
+
+    out = np.empty((1, 448, 448, 3), dtype=np.float32)
+    results = {}
+    for width, height in PREPARE_SIZES:
+        for mode, image_format in PREPARE_MODES:
+            data = encoded_image(width, height, mode, image_format)
+            results[f"prepare_image/{width}x{height}/{mode}-{image_format}"] = _best(
+                lambda: prepare_image(data, 448, out=out), repeat
+            )
+    return results
+
+
+def bench_postprocess(predictor, repeat: int) -> dict:
+    num_tags = len(predictor.tag_names)
+    preds = np.random.default_rng(1).beta(0.3, 3, size=(8, num_tags)).astype(np.float32)
+    results = {}
+    for mcut in (False, True):
+        kwargs = dict(
+            general_thresh=0.35,
+            general_mcut_enabled=mcut,
+            character_thresh=0.85,
+            character_mcut_enabled=mcut,
+        )
+        suffix = "mcut" if mcut else "threshold"
+        results[f"postprocess/single/{suffix}"] = _best(
+            lambda: predictor.postprocess(preds[0], **kwargs), repeat, number=10
+        )
+        results[f"postprocess/batch8/{suffix}"] = _best(
+            lambda: predictor.postprocess_batch(preds, **kwargs), repeat, number=10
+        )
+    return results
+
+
+def bench_mcut(repeat: int) -> dict:
+    from app.infer.load import mcut_threshold
+
+    probs = np.random.default_rng(2).random((8, 8000))
+    return {
+        "mcut/single": _best(lambda: mcut_threshold(probs[0]), repeat, number=10),
+        "mcut/batch8": _best(lambda: mcut_threshold(probs), repeat, number=10),
+    }
+
+
+def bench_load_labels(tag_csv_path: str, repeat: int) -> dict:
+    from app.infer.load import load_labels
+
+    load_labels(tag_csv_path)
+    return {
+        "load_labels/csv": _best(
+            lambda: load_labels(tag_csv_path, cache=False), repeat
+        ),
+        "load_labels/cached": _best(lambda: load_labels(tag_csv_path), repeat),
+    }
+
+
+def bench_upload(concurrency: int, requests: int) -> dict:
+    from fastapi.testclient import TestClient
+
+    from app import app
+
+    image = encoded_image(1024, 768, "RGB", "JPEG")
+    with TestClient(app) as client:
+
+        def upload(_):
+            start = time.perf_counter()
+            response = client.post(
+                "/upload", files={"file": ("bench.jpg", image, "image/jpeg")}
+            )
+            response.raise_for_status()
+            return time.perf_counter() - start
+
+        # Warm-up outside of the measurement
+        list(map(upload, range(concurrency)))
+        with ThreadPoolExecutor(concurrency) as pool:
+            start = time.perf_counter()
+            latencies = np.array(list(pool.map(upload, range(requests))))
+            elapsed = time.perf_counter() - start
+    prefix = f"upload/c{concurrency}"
+    return {
+        f"{prefix}/p50": float(np.percentile(latencies, 50)),
+        f"{prefix}/p95": float(np.percentile(latencies, 95)),
+        f"{prefix}/seconds_per_image": elapsed / requests,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    :return: (name, baseline seconds, seconds) of results slower by more than threshold
+    """
+    regressions = []
+    for name, seconds in results.items():
+        before = baseline.get(name)
+        if before and seconds > before * (1 + threshold):
+            regressions.append((name, before, seconds))
+    return regressions
+
+
+def _meta() -> dict:
+    import onnxruntime
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pillow": Image.__version__,
+        "onnxruntime": onnxruntime.__version__,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="Earlier results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--tags", type=int, default=10861)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--requests", type=int, default=64)
+    args = parser.parse_args(argv)
+
+    from benchmarks.tiny_model import make_tiny_model
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        _, tag_csv_path = make_tiny_model(model_dir, MODEL_NAME, num_tags=args.tags)
+        # Read by the settings when app is first imported, so only the tiny model is
+        # loaded
+        os.environ.update(
+            WD_MODEL_DIR=model_dir,
+            WD_MODEL_NAME=MODEL_NAME,
+            SKIP_AUTO_DOWNLOAD="true",
+        )
+        from app.infer import OnnxRuntimeManager, Predictor
+        from app.settings import InferSettingCurrent
+
+        OnnxRuntimeManager.configure(**InferSettingCurrent.ort_options)
+        predictor = Predictor.load(
+            model_path=os.path.join(model_dir, f"{MODEL_NAME}.onnx"),
+            tag_csv_path=tag_csv_path,
+        )
+        results = {}
+        if "prepare_image" in args.stages:
+            results.update(bench_prepare_image(args.repeat))
+        if "postprocess" in args.stages:
+            results.update(bench_postprocess(predictor, args.repeat))
+        if "mcut" in args.stages:
+            results.update(bench_mcut(args.repeat))
+        if "load_labels" in args.stages:
+            results.update(bench_load_labels(tag_csv_path, args.repeat))
+        if "upload" in args.stages:
+            for concurrency in args.concurrency:
+                results.update(bench_upload(concurrency, args.requests))
+
+    for name, seconds in results.items():
+        print(f"{name:<44} {seconds * 1000:10.3f} ms")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"meta": _meta(), "results": results}, f, indent=2)
+    if not args.baseline:
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+    for name, before, seconds in regressions:
+        print(
+            f"REGRESSION {name}: {before * 1000:.3f} ms -> {seconds * 1000:.3f} ms "
+            f"(+{(seconds / before - 1) * 100:.0f}%)"
+        )
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""
+A tagger with the input and output layout of the wd models, small enough to build
+offline
+"""
+
+import pathlib
+
+import numpy as np
+
+
+def make_tiny_model(
+    model_dir: str,
+    model_name: str = "wd-swinv2-tagger-v3",
+    num_tags: int = 10861,
+    target_size: int = 448,
+    seed: int = 0,
+):
+    """
+    Write <model_name>.onnx and <model_name>.csv, needs `pip install onnx`.
+    The graph averages the [batch, size, size, 3] BGR input and maps it to sigmoid
+    scores.
+    :return: model_path, tag_csv_path
+    """
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+
+    rng = np.random.default_rng(seed)
+    weight = rng.normal(size=(3, num_tags)).astype(np.float32) / 255
+    bias = rng.normal(size=(num_tags,)).astype(np.float32) - 2
+    graph = helper.make_graph(
+        [
+            helper.make_node(
+                "ReduceMean", ["input"], ["mean"], axes=[1, 2], keepdims=0
+            ),
+            helper.make_node("MatMul", ["mean", "weight"], ["logits"]),
+            helper.make_node("Add", ["logits", "bias"], ["biased"]),
+            helper.make_node("Sigmoid", ["biased"], ["output"]),
+        ],
+        "tiny_tagger",
+        [
+            helper.make_tensor_value_info(
+                "input", TensorProto.FLOAT, ["batch", target_size, target_size, 3]
+            )
+        ],
+        [
+            helper.make_tensor_value_info(
+                "output", TensorProto.FLOAT, ["batch", num_tags]
+            )
+        ],
+        [
+            numpy_helper.from_array(weight, "weight"),
+            numpy_helper.from_array(bias, "bias"),
+        ],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+
+    directory = pathlib.Path(model_dir)
+    directory.mkdir(parents=True, exist_ok=True)
+    model_path = directory.joinpath(f"{model_name}.onnx")
+    tag_csv_path = directory.joinpath(f"{model_name}.csv")
+    onnx.save(model, str(model_path))
+
+    # Roughly the category layout of the v3 taggers: 4 ratings, then general and
+    # character tags
+    categories = np.where(rng.random(num_tags) < 0.75, 0, 4)
+    categories[:4] = 9
+    ratings = ["general", "sensitive", "questionable", "explicit"]
+    with open(tag_csv_path, "w", encoding="utf-8") as f:
+        f.write("tag_id,name,category,count\n")
+        for index, category in enumerate(categories):
+            if category == 9:
+                name = ratings[index]
+            elif index == 97:
+                # Kaomoji keep their underscores
+                name = "^_^"
+            else:
+                name = f"tag_{index}_(series)"
+            f.write(f"{index},{name},{category},{num_tags - index}\n")
+    return str(model_path), str(tag_csv_path)
@@ -0,0 +1,217 @@
+"""
+Throughput and memory of `python main.py` from 1 to N workers, on the configured model
+
+    export WD_MODEL_DIR=models ORT_SHARED_WEIGHTS=true
+    python -m benchmarks.workers --workers 1 2 4 8
+
+Each run starts the server with SERVER_WORKERS set, waits for every worker to be ready,
+uploads from --concurrency clients for --duration seconds, then sums the RSS and PSS of
+the parent and its workers. PSS splits shared pages between the processes mapping them,
+so it is the number that shows whether the weights are shared. Linux only.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import numpy as np
+
+from benchmarks.run import encoded_image
+
+MAIN_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py"
+)
+
+
+def _children(pid: int) -> list:
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command may hold spaces, the parent pid follows its closing paren
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if parent == pid:
+            children.append(int(entry))
+    return children
+
+
+def memory(pid: int) -> dict:
+    """
+    :return: Summed Rss and Pss bytes of the process and its children
+    """
+    total = {"rss_bytes": 0, "pss_bytes": 0}
+    for process in [pid] + _children(pid):
+        try:
+            with open(f"/proc/{process}/smaps_rollup") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            continue
+        for line in lines:
+            key, _, value = line.partition(":")
+            if key in ("Rss", "Pss"):
+                total[f"{key.lower()}_bytes"] += int(value.split()[0]) * 1024
+    return total
+
+
+def wait_ready(base_url: str, workers: int, timeout: float) -> set:
+    """
+    Poll /readyz until as many distinct worker pids answered ready as were started
+    """
+    ready = set()
+    deadline = time.monotonic() + timeout
+
+    def poll(_):
+        with httpx.Client(base_url=base_url, timeout=5) as client:
+            while len(ready) < workers and time.monotonic() < deadline:
+                try:
+                    response = client.get("/readyz")
+                except httpx.HTTPError:
+                    time.sleep(0.2)
+                    continue
+                if response.status_code == 200:
+                    ready.add(response.json()["pid"])
+                time.sleep(0.05)
+
+    with ThreadPoolExecutor(workers * 2) as pool:
+        list(pool.map(poll, range(workers * 2)))
+    if len(ready) < workers:
+        raise TimeoutError(f"{len(ready)} of {workers} workers ready after {timeout}s")
+    return ready
+
+
+def load(base_url: str, image: bytes, concurrency: int, duration: float) -> dict:
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client_loop(_):
+        nonlocal errors
+        with httpx.Client(base_url=base_url, timeout=60) as client:
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                try:
+                    response = client.post(
+                        "/upload", files={"file": ("bench.jpg", image, "image/jpeg")}
+                    )
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                elapsed = time.perf_counter() - start
+                with lock:
+                    if ok:
+                        latencies.append(elapsed)
+                    else:
+                        errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(client_loop, range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies or [float("nan")])
+    return {
+        "images_per_second": int(np.isfinite(latencies).sum()) / elapsed,
+        "p50_seconds": float(np.percentile(latencies, 50)),
+        "p95_seconds": float(np.percentile(latencies, 95)),
+        "errors": errors,
+    }
+
+
+@contextlib.contextmanager
+def server(env: dict, port: int, workers: int, timeout: float, cwd: str = None):
+    """
+    Run `python main.py` with the environment on top of ours until every worker is
+    ready, stop it with SIGTERM on exit
+    :param cwd: Where run.log is written
+    :return: The base url, and the process
+    """
+    env = dict(
+        os.environ,
+        **env,
+        SERVER_WORKERS=str(workers),
+        SERVER_PORT=str(port),
+        SERVER_HOST="127.0.0.1",
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    process = subprocess.Popen([sys.executable, MAIN_PATH], env=env, cwd=cwd)
+    try:
+        wait_ready(base_url, workers, timeout)
+        yield base_url, process
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def run(workers: int, args) -> dict:
+    intra_op_threads = args.intra_op_threads or max(1, (os.cpu_count() or 1) // workers)
+    env = {"ORT_INTRA_OP_THREADS": str(intra_op_threads)}
+    if args.shared_weights is not None:
+        env["ORT_SHARED_WEIGHTS"] = args.shared_weights
+    with server(env, args.port, workers, args.timeout) as (base_url, process):
+        image = encoded_image(1024, 768, "RGB", "JPEG")
+        # Warm-up, so every worker has run the model once before measuring
+        load(base_url, image, workers * 2, 2)
+        result = load(base_url, image, args.concurrency, args.duration)
+        result.update(memory(process.pid))
+    result.update(workers=workers, intra_op_threads=intra_op_threads)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--port", type=int, default=10110)
+    parser.add_argument("--timeout", type=float, default=300, help="Startup timeout")
+    parser.add_argument(
+        "--intra-op-threads",
+        type=int,
+        default=0,
+        help="ORT threads per worker, 0 splits the cores between the workers",
+    )
+    parser.add_argument(
+        "--shared-weights",
+        choices=["true", "false"],
+        help="Sets ORT_SHARED_WEIGHTS, inherited from the environment by default",
+    )
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args(argv)
+
+    results = [run(workers, args) for workers in args.workers]
+    print(
+        f"{'workers':>7} {'threads':>7} {'images/s':>9} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'errors':>6} {'RSS MB':>8} {'PSS MB':>8}"
+    )
+    for result in results:
+        print(
+            f"{result['workers']:>7} {result['intra_op_threads']:>7} "
+            f"{result['images_per_second']:>9.2f} {result['p50_seconds'] * 1000:>8.1f} "
+            f"{result['p95_seconds'] * 1000:>8.1f} {result['errors']:>6} "
+            f"{result['rss_bytes'] / 2**20:>8.0f} {result['pss_bytes'] / 2**20:>8.0f}"
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
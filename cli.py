@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# @File    : cli.py
+# @Software: PyCharm
+import argparse
+import itertools
+import json
+import sys
+
+from loguru import logger
+
+
+def tag_command(args):
+    from app.bulk import Checkpoint, iter_sources, open_writer, tag_files
+    from app.infer import PreprocessPool
+
+    # Forked before the session starts its threads
+    preprocess_pool = (
+        PreprocessPool(workers=args.preprocess_workers)
+        if args.preprocess_workers > 0
+        else None
+    )
+    predictor = _client().get_predictor(args.model)
+    checkpoint = Checkpoint(args.checkpoint) if args.checkpoint else None
+    writer = open_writer(args.format, args.output)
+    try:
+        tag_files(
+            iter_sources(
+                args.sources,
+                file_list=args.file_list,
+                # Finished images are not even read again
+                skip=checkpoint.done if checkpoint is not None else None,
+            ),
+            predictor=predictor,
+            writer=writer,
+            checkpoint=checkpoint,
+            batch_size=args.batch_size,
+            threads=args.threads,
+            preprocess_pool=preprocess_pool,
+            general_threshold=args.general_threshold,
+            character_threshold=args.character_threshold,
+            general_mcut_enabled=args.general_mcut,
+            character_mcut_enabled=args.character_mcut,
+            report_every=args.report_every,
+        )
+    finally:
+        writer.close()
+        if checkpoint is not None:
+            checkpoint.close()
+        if preprocess_pool is not None:
+            preprocess_pool.shutdown()
+
+
+def _client():
+    from app.infer import InferClient, OnnxRuntimeManager
+    from app.settings import InferSettingCurrent
+
+    # The session options and precision of the server, so runs here measure the same
+    OnnxRuntimeManager.configure(**InferSettingCurrent.ort_options)
+    return InferClient(
+        model_name=InferSettingCurrent.wd_model_name,
+        model_dir=InferSettingCurrent.wd_model_dir,
+        skip_auto_download=InferSettingCurrent.skip_auto_download,
+        download_base_url=InferSettingCurrent.hf_endpoint,
+        download_connections=InferSettingCurrent.download_connections,
+        precision=InferSettingCurrent.wd_model_precision,
+        # Commands load the model they are given, not necessarily the default one
+        preload=False,
+    )
+
+
+def quantize_command(args):
+    from app.bulk import iter_sources
+    from app.infer.quantize import quantize_dynamic, quantize_static
+    from app.settings import InferSettingCurrent
+
+    registry = _client().registry
+    model_path, _ = registry.resolve_files(
+        args.model or InferSettingCurrent.wd_model_name
+    )
+    if args.static:
+        images = (content for _, content in iter_sources(args.static))
+        if args.limit:
+            images = itertools.islice(images, args.limit)
+        quantize_static(model_path, images)
+    else:
+        quantize_dynamic(model_path)
+
+
+def evaluate_command(args):
+    from app.bulk import iter_sources
+    from app.infer import Predictor
+    from app.infer.quantize import ensure_precision, evaluate
+    from app.settings import InferSettingCurrent
+
+    registry = _client().registry
+    model_path, tag_csv_path = registry.resolve_files(
+        args.model or InferSettingCurrent.wd_model_name
+    )
+    reference = Predictor.load(model_path, tag_csv_path)
+    candidate = Predictor.load(
+        ensure_precision(model_path, args.precision), tag_csv_path
+    )
+    images = iter_sources(args.sources)
+    if args.limit:
+        images = itertools.islice(images, args.limit)
+    report = evaluate(reference, candidate, images, top_k=args.top_k)
+    print(json.dumps(report, indent=2))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="wd-tagger-server tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    tag = commands.add_parser(
+        "tag", help="Tag directories, globs, zip/tar archives or image files offline"
+    )
+    tag.add_argument(
+        "sources", nargs="*", help="Directories, globs, archives or images"
+    )
+    tag.add_argument("--file-list", help="Text file with one source per line")
+    tag.add_argument("--model", help="Model name, WD_MODEL_NAME by default")
+    tag.add_argument("--format", choices=("jsonl", "parquet", "txt"), default="jsonl")
+    tag.add_argument(
+        "--output",
+        help="jsonl file, parquet directory, or directory for txt captions "
+        "(next to the images if omitted)",
+    )
+    tag.add_argument("--checkpoint", help="File of finished images, to resume a run")
+    tag.add_argument("--batch-size", type=int, default=16)
+    tag.add_argument("--threads", type=int, default=4, help="Preprocessing threads")
+    tag.add_argument(
+        "--preprocess-workers",
+        type=int,
+        default=0,
+        help="Preprocess in this many processes instead of threads",
+    )
+    tag.add_argument("--general-threshold", type=float, default=0.35)
+    tag.add_argument("--character-threshold", type=float, default=0.85)
+    tag.add_argument("--general-mcut", action="store_true")
+    tag.add_argument("--character-mcut", action="store_true")
+    tag.add_argument("--report-every", type=float, default=10.0, help="Seconds")
+    tag.set_defaults(func=tag_command)
+
+    quantize = commands.add_parser(
+        "quantize", help="Create the int8 variant of a model next to the original"
+    )
+    quantize.add_argument("--model", help="Model name, WD_MODEL_NAME by default")
+    quantize.add_argument(
+        "--static",
+        nargs="+",
+        metavar="SOURCE",
+        help="Calibrate a static int8 model on these images instead of dynamic int8",
+    )
+    quantize.add_argument("--limit", type=int, default=300, help="Calibration images")
+    quantize.set_defaults(func=quantize_command)
+
+    evaluate = commands.add_parser(
+        "evaluate", help="Compare a quantized model with fp32 on local images"
+    )
+    evaluate.add_argument(
+        "sources", nargs="+", help="Directories, globs, archives or images"
+    )
+    evaluate.add_argument("--model", help="Model name, WD_MODEL_NAME by default")
+    evaluate.add_argument(
+        "--precision", choices=("int8", "int8-static"), default="int8"
+    )
+    evaluate.add_argument("--top-k", type=int, default=10)
+    evaluate.add_argument("--limit", type=int, default=0, help="0 for all images")
+    evaluate.set_defaults(func=evaluate_command)
+
+    args = parser.parse_args(argv)
+    logger.remove()
+    logger.add(sys.stderr, level="INFO", colorize=True)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,12 @@
 # @Author  : sudoskys
 # @File    : main.py
 # @Software: PyCharm
+import os
+import signal
+import socket
 import sys
+import threading
+import time
 
 import uvicorn
 from dotenv import load_dotenv
@@ -11,8 +16,6 @@ from loguru import logger
 from pydantic import model_validator
 from pydantic_settings import BaseSettings
 
-import app
-
 load_dotenv()
 logger.remove()
 logger.add(sys.stderr, level="INFO", colorize=True, enqueue=True)
@@ -28,6 +31,8 @@ logger.add(
 class ServerSetting(BaseSettings):
     server_port: int = 10010
     server_host: str = "127.0.0.1"
+    # Processes accepting on the port, forked before anything is loaded
+    server_workers: int = 1
 
     @model_validator(mode="after")
     def check(self):
@@ -39,9 +44,107 @@ class ServerSetting(BaseSettings):
             logger.warning("Wrong HOST, should remove the prefix http://")
         assert isinstance(self.server_host, str)
         assert isinstance(self.server_port, int)
+        if self.server_workers < 1:
+            raise ValueError("server_workers must be at least 1")
         return self
 
 
-setting = ServerSetting()
-logger.info(f"Docs: http://{setting.server_host}:{setting.server_port}/docs")
-uvicorn.run(app.app, host=setting.server_host, port=setting.server_port)
+class Server(uvicorn.Server):
+    def handle_exit(self, sig, frame):
+        """
+        Drain before uvicorn stops, a second signal exits right away
+        """
+        import app
+
+        if self.should_exit or app.is_draining():
+            return super().handle_exit(sig, frame)
+        threading.Thread(
+            target=self._drain_and_exit, args=(sig, frame), daemon=True
+        ).start()
+
+    def _drain_and_exit(self, sig, frame):
+        import app
+
+        app.drain(
+            timeout=app.InferSettingCurrent.drain_timeout,
+            delay=app.InferSettingCurrent.drain_delay,
+        )
+        super().handle_exit(sig, frame)
+
+
+def serve(setting: ServerSetting, sockets=None):
+    # Imported here, so a forking parent holds no model, threads or connections
+    import app
+
+    Server(
+        uvicorn.Config(app.app, host=setting.server_host, port=setting.server_port)
+    ).run(sockets=sockets)
+
+
+def _fork_worker(setting: ServerSetting, sock: socket.socket) -> int:
+    pid = os.fork()
+    if pid:
+        return pid
+    # Own process group, so Ctrl+C reaches the workers once, through the parent
+    os.setpgid(0, 0)
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, signal.SIG_DFL)
+    code = 0
+    try:
+        serve(setting, sockets=[sock])
+    except BaseException:
+        logger.exception("Worker failed")
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def serve_workers(setting: ServerSetting):
+    """
+    Bind the port once and fork server_workers processes accepting on it.
+    Signals are passed on so every worker drains, workers exiting otherwise are
+    restarted.
+    """
+    sock = uvicorn.Config(
+        "app:app", host=setting.server_host, port=setting.server_port
+    ).bind_socket()
+    workers = set()
+    stopping = False
+
+    def stop(sig, frame):
+        nonlocal stopping
+        stopping = True
+        for worker in list(workers):
+            try:
+                os.kill(worker, sig)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(setting.server_workers):
+        workers.add(_fork_worker(setting, sock))
+    logger.info(f"Started {len(workers)} workers: {sorted(workers)}")
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        workers.discard(pid)
+        if stopping:
+            continue
+        logger.warning(f"Worker {pid} exited with status {status}, restarting")
+        time.sleep(1)
+        workers.add(_fork_worker(setting, sock))
+    sock.close()
+
+
+if __name__ == "__main__":
+    setting = ServerSetting()
+    logger.info(f"Docs: http://{setting.server_host}:{setting.server_port}/docs")
+    if setting.server_workers > 1 and hasattr(os, "fork"):
+        serve_workers(setting)
+    else:
+        if setting.server_workers > 1:
+            logger.warning("Workers need os.fork, serving in one process")
+        serve(setting)
@@ -3,26 +3,333 @@
 # @Author  : sudoskys
 # @File    : sdk.py
 # @Software: PyCharm
-import aiofiles
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+from typing import AsyncIterator, Iterable, List, Optional, Tuple
+
 import aiohttp
 
+# Answers worth another try, the server sends 503 with Retry-After when its queue is
+# full
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# The server expands these into a line per member, upload_many can't map those back
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
 
 class WdTaggerSDK:
-    def __init__(self, base_url):
-        self.base_url = base_url
+    def __init__(
+        self,
+        base_url: str,
+        token: Optional[str] = None,
+        max_connections: int = 16,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 300,
+    ):
+        """
+        Client of the tagger server, connections are kept alive and reused across calls.
+        Use `async with WdTaggerSDK(...) as sdk:`, or call close() when done.
+        :param token: Sent with every request unless a call passes its own
+        :param max_connections: Open connections to the server at most
+        :param retries: Further attempts on connection errors and RETRY_STATUSES
+        :param backoff: Seconds before the first retry, doubled each time, Retry-After
+            wins if longer
+        :param timeout: Seconds for a whole request, including a streamed batch
+        """
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._session = None
+        self._batch_supported = True
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
 
     async def upload(
-        self, file_path, token, general_threshold=0.35, character_threshold=0.85
-    ):
-        url = f"{self.base_url}/upload"
-        async with aiofiles.open(file_path, "rb") as f:
-            file = await f.read()
-        data = {
-            "file": file,
-            "token": token,
+        self,
+        file_path,
+        token: Optional[str] = None,
+        general_threshold: float = 0.35,
+        character_threshold: float = 0.85,
+        general_mcut_enabled: bool = False,
+        character_mcut_enabled: bool = False,
+        model: Optional[str] = None,
+    ) -> dict:
+        """
+        Tag one image, the file is streamed from disk
+        :raises: aiohttp.ClientResponseError, aiohttp.ClientError once retries are
+            used up, OSError if a file can't be read
+        """
+        params = self._params(
+            token,
+            general_threshold,
+            character_threshold,
+            general_mcut_enabled,
+            character_mcut_enabled,
+            model,
+        )
+        async with self._post("/upload", params, [("file", file_path)]) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def upload_batch(self, file_paths: List, **options) -> AsyncIterator[dict]:
+        """
+        Tag images or zip/tar archives in one request to /upload/batch.
+        Lines are yielded as the server streams them, a broken image only fails its own
+        line.
+        :param options: The keyword arguments of upload
+        :raises: aiohttp.ClientResponseError, aiohttp.ClientError once retries are
+            used up, OSError if a file can't be read
+        """
+        files = [("files", file_path) for file_path in file_paths]
+        async with self._post(
+            "/upload/batch", self._params(**options), files
+        ) as response:
+            response.raise_for_status()
+            buffer = b""
+            # Read in chunks, a line of a large result may pass the readline limit
+            async for data in response.content.iter_any():
+                *lines, buffer = (buffer + data).split(b"\n")
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)
+            if buffer.strip():
+                yield json.loads(buffer)
+
+    async def upload_many(
+        self,
+        file_paths: Iterable,
+        batch_size: int = 8,
+        concurrency: int = 4,
+        **options,
+    ) -> AsyncIterator[Tuple[str, dict]]:
+        """
+        Tag image paths, batch_size per request to /upload/batch and concurrency
+        requests in flight, falling back to /upload on servers without it.
+        Paths are read lazily. Results are yielded as they arrive, not in order.
+        An image that failed, or could not be read, gets a result with "error" instead
+        of stopping the others. Only image paths are supported, archives get an
+        "error" result, send them with upload_batch.
+        :param options: The keyword arguments of upload
+        :return: (path, result)
+        """
+        batches = iter(_chunks(file_paths, batch_size))
+        results = asyncio.Queue()
+        done = object()
+
+        async def worker():
+            # The shared iterator hands each batch to one worker
+            for batch in batches:
+                async for item in self._tag_batch(batch, options):
+                    await results.put(item)
+
+        async def run():
+            try:
+                await asyncio.gather(*[worker() for _ in range(concurrency)])
+            finally:
+                results.put_nowait(done)
+
+        runner = asyncio.ensure_future(run())
+        try:
+            while True:
+                item = await results.get()
+                if item is done:
+                    break
+                yield item
+            await runner
+        finally:
+            runner.cancel()
+
+    async def _tag_batch(self, batch: list, options: dict):
+        # An archive or an unreadable file fails alone instead of taking its batch down
+        pending, rejected = _sendable(batch)
+        for item in rejected:
+            yield item
+        if not self._batch_supported:
+            for item in await asyncio.gather(
+                *[self._tag_one(path, options) for path in pending]
+            ):
+                yield item
+            return
+        failed = []
+        for attempt in range(self.retries + 1):
+            if attempt:
+                # Files may have gone away while waiting to retry
+                pending, rejected = _sendable(pending)
+                for item in rejected:
+                    yield item
+            if not pending:
+                return
+            received = {}
+            error = None
+            give_up = False
+            try:
+                async for line in self.upload_batch(pending, **options):
+                    if not 0 <= line.get("index", -1) < len(pending):
+                        # Not one of the paths sent
+                        continue
+                    received[line["index"]] = line
+                    if not _queue_full(line):
+                        yield pending[line["index"]], line
+            except aiohttp.ClientResponseError as e:
+                if e.status == 404 and not received:
+                    # A server from before /upload/batch
+                    self._batch_supported = False
+                    async for item in self._tag_batch(pending, options):
+                        yield item
+                    return
+                # Statuses worth retrying were already retried
+                error, give_up = e, True
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                # The connection broke mid-stream, or a file went away since it was
+                # checked, the images without a line are sent again
+                error = e
+            failed = [
+                (path, received.get(index) or _error(error))
+                for index, path in enumerate(pending)
+                if index not in received or _queue_full(received[index])
+            ]
+            if not failed or give_up:
+                break
+            pending = [path for path, _ in failed]
+            if attempt < self.retries:
+                await asyncio.sleep(self._delay(attempt))
+        for item in failed:
+            yield item
+
+    async def _tag_one(self, path, options: dict):
+        try:
+            return path, await self.upload(path, **options)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            return path, _error(e)
+
+    @contextlib.asynccontextmanager
+    async def _post(self, path: str, params: dict, files: list):
+        """
+        POST the files as multipart, streamed from disk, retried with backoff
+        on connection errors and RETRY_STATUSES.
+        The last answer is yielded whatever it is.
+        """
+        url = f"{self.base_url}{path}"
+        attempt = 0
+        while True:
+            retry_after = None
+            with contextlib.ExitStack() as stack:
+                form = aiohttp.FormData()
+                for field, file_path in files:
+                    form.add_field(
+                        field,
+                        stack.enter_context(open(file_path, "rb")),
+                        filename=os.path.basename(file_path),
+                    )
+                try:
+                    response = await self.session.post(url, params=params, data=form)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if attempt >= self.retries:
+                        raise
+                else:
+                    if response.status not in RETRY_STATUSES or attempt >= self.retries:
+                        break
+                    retry_after = response.headers.get("Retry-After")
+                    response.release()
+            await asyncio.sleep(self._delay(attempt, retry_after))
+            attempt += 1
+        try:
+            yield response
+        finally:
+            response.release()
+
+    def _delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        # Jittered, so clients turned away together don't all come back together
+        delay = self.backoff * 2**attempt * random.uniform(1.0, 1.5)
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        return delay
+
+    def _params(
+        self,
+        token: Optional[str] = None,
+        general_threshold: float = 0.35,
+        character_threshold: float = 0.85,
+        general_mcut_enabled: bool = False,
+        character_mcut_enabled: bool = False,
+        model: Optional[str] = None,
+    ) -> dict:
+        params = {
             "general_threshold": str(general_threshold),
             "character_threshold": str(character_threshold),
+            "general_mcut_enabled": str(general_mcut_enabled).lower(),
+            "character_mcut_enabled": str(character_mcut_enabled).lower(),
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, data=data) as response:
-                return await response.json()
+        token = token or self.token
+        if token:
+            params["token"] = token
+        if model:
+            params["model"] = model
+        return params
+
+
+def _chunks(items: Iterable, size: int):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _sendable(paths: list) -> Tuple[list, list]:
+    """
+    :return: The image paths that can be opened, and (path, error result) for
+        archives and the paths that can't
+    """
+    sendable, rejected = [], []
+    for path in paths:
+        if str(path).lower().endswith(ARCHIVE_SUFFIXES):
+            error = ValueError(
+                "upload_many takes images, send archives with upload_batch"
+            )
+            rejected.append((path, _error(error)))
+            continue
+        try:
+            with open(path, "rb"):
+                pass
+        except OSError as e:
+            rejected.append((path, _error(e)))
+        else:
+            sendable.append(path)
+    return sendable, rejected
+
+
+def _queue_full(line: dict) -> bool:
+    return line.get("error", "").startswith("QueueFullError")
+
+
+def _error(e: Optional[Exception]) -> dict:
+    if e is None:
+        return {"error": "No result from the server"}
+    return {"error": f"{type(e).__name__}: {e}"}
@@ -3,9 +3,16 @@
 # @Author  : sudoskys
 # @File    : test_app.py
 # @Software: PyCharm
+import io
+import json
+import pathlib
+import threading
+import time
+import zipfile
 
 import pytest
 from fastapi.testclient import TestClient
+from PIL import Image
 
 from app import app
 
@@ -19,10 +26,298 @@ def test_cli():
 async def test_upload(test_cli):
     # Replace with your actual file and token
     data = {
-        "file": ("test_src_01.png", open("test_src_01.png", "rb")),
+        "file": (
+            "test_src_01.png",
+            pathlib.Path(__file__).parent.joinpath("test_src_01.png").read_bytes(),
+        ),
         "token": "your_token",
         "general_threshold": "0.35",
         "character_threshold": "0.85",
     }
     response = test_cli.post("/upload", files=data)
     assert response.status_code == 200
+
+
+def test_upload_batch(test_cli):
+    image = pathlib.Path(__file__).parent.joinpath("test_src_01.png").read_bytes()
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        for i in range(3):
+            zip_file.writestr(f"images/{i}.png", image)
+    files = [
+        ("files", ("test_src_01.png", image)),
+        ("files", ("images.zip", archive.getvalue())),
+        ("files", ("broken.png", b"not an image")),
+    ]
+    response = test_cli.post("/upload/batch", files=files)
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["file"] for line in lines] == [
+        "test_src_01.png",
+        "images/0.png",
+        "images/1.png",
+        "images/2.png",
+        "broken.png",
+    ]
+    assert all("rating" in line for line in lines[:4])
+    assert "error" in lines[4]
+
+
+def test_probability_store(test_cli, monkeypatch, tmp_path):
+    import app as app_package
+    from app.infer import ProbabilityStore
+
+    assert test_cli.get("/store/search", params={"tags": "1girl"}).status_code == 404
+    store = ProbabilityStore(str(tmp_path))
+    monkeypatch.setattr(app_package, "PROB_STORE", store)
+    monkeypatch.setattr(app_package.INFER_APP, "prob_store", store)
+    image = pathlib.Path(__file__).parent.joinpath("test_src_01.png").read_bytes()
+    response = test_cli.post(
+        "/upload", params={"image_id": "first"}, files={"file": ("a.png", image)}
+    )
+    tag = max(response.json()["general_res"].items(), key=lambda item: item[1])[0]
+    test_cli.post(
+        "/upload/batch", params={"store": "true"}, files=[("files", ("b.png", image))]
+    )
+
+    response = test_cli.get("/store/search", params={"tags": [tag], "threshold": 0.1})
+    assert [image["image_id"] for image in response.json()["images"]] == [
+        "first",
+        "b.png",
+    ]
+    registry = app_package.INFER_APP.registry
+    precision = registry.precision
+    assert list(store.stats()) == [f"{app_package.INFER_APP.model_name}@{precision}"]
+    # Predictions made at another precision are kept apart
+    monkeypatch.setattr(registry, "precision", "int8")
+    response = test_cli.get("/store/search", params={"tags": [tag], "threshold": 0.1})
+    assert response.json()["images"] == []
+    monkeypatch.setattr(registry, "precision", precision)
+    response = test_cli.get("/store/search", params={"tags": ["not a tag"]})
+    assert response.status_code == 400
+
+    response = test_cli.post(
+        "/store/rethreshold",
+        params={"general_threshold": 0.0},
+        json={"image_ids": ["first", "missing"]},
+    )
+    body = response.json()
+    assert [result["image_id"] for result in body["results"]] == ["first"]
+    assert body["missing"] == ["missing"]
+    assert tag in body["results"][0]["general_res"]
+    store.close()
+
+
+def test_cache_hit_skips_full_queue(test_cli, monkeypatch):
+    import app as app_package
+    from app.infer import ResultCache
+
+    cache = ResultCache(max_bytes=1024 * 1024)
+    monkeypatch.setattr(app_package, "RESULT_CACHE", cache)
+    monkeypatch.setattr(app_package.INFER_APP, "result_cache", cache)
+    image = pathlib.Path(__file__).parent.joinpath("test_src_01.png").read_bytes()
+    first = test_cli.post("/upload", files={"file": ("a.png", image)})
+    assert first.status_code == 200
+    executor = app_package.INFER_APP.executor
+    monkeypatch.setattr(
+        executor, "_pending", executor.max_workers + executor.max_queue_size
+    )
+    # A hit is answered without a free worker, a new image is turned away
+    second = test_cli.post("/upload", files={"file": ("a.png", image)})
+    assert second.status_code == 200
+    assert second.json() == first.json()
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32), "red").save(buffer, format="PNG")
+    response = test_cli.post("/upload", files={"file": ("b.png", buffer.getvalue())})
+    assert response.status_code == 503
+    assert cache.hits == 1
+
+
+def test_upload_fields(test_cli):
+    image = pathlib.Path(__file__).parent.joinpath("test_src_01.png").read_bytes()
+    files = {"file": ("test_src_01.png", image)}
+    full = test_cli.post("/upload", files=files).json()
+    assert "tag_result" in full
+    response = test_cli.post(
+        "/upload",
+        params={"fields": ["rating", "general_res"], "top_k": 3, "digits": 2},
+        files=files,
+    )
+    body = response.json()
+    assert set(body) == {"rating", "general_res"}
+    assert len(body["general_res"]) == min(3, len(full["general_res"]))
+    assert body["rating"] == {name: round(p, 2) for name, p in full["rating"].items()}
+
+    msgpack = pytest.importorskip("msgpack")
+    response = test_cli.post(
+        "/upload",
+        params={"fields": "sorted_general_strings", "response_format": "msgpack"},
+        files=files,
+    )
+    assert response.headers["content-type"] == "application/msgpack"
+    assert msgpack.unpackb(response.content) == {
+        "sorted_general_strings": full["sorted_general_strings"]
+    }
+
+
+def test_upload_tiles(test_cli):
+    image = io.BytesIO()
+    Image.new("RGB", (3000, 600), (200, 120, 40)).save(image, "PNG")
+    files = {"file": ("strip.png", image.getvalue())}
+    response = test_cli.post(
+        "/upload", params={"tiles": "true", "max_tiles": 4}, files=files
+    )
+    assert response.status_code == 200
+    assert "rating" in response.json()
+    response = test_cli.post(
+        "/upload", params={"tiles": "true", "tile_merge": "mean"}, files=files
+    )
+    assert response.status_code == 200
+    response = test_cli.post(
+        "/upload", params={"tiles": "true", "max_tiles": 1000}, files=files
+    )
+    assert response.status_code == 400
+
+
+def test_upload_too_large(test_cli, monkeypatch):
+    from app.settings import InferSettingCurrent
+
+    image = pathlib.Path(__file__).parent.joinpath("test_src_01.png").read_bytes()
+    monkeypatch.setattr(InferSettingCurrent, "max_image_pixels", 64 * 64)
+    response = test_cli.post("/upload", files={"file": ("test_src_01.png", image)})
+    assert response.status_code == 413
+
+    monkeypatch.setattr(InferSettingCurrent, "max_image_pixels", 0)
+    monkeypatch.setattr(InferSettingCurrent, "max_upload_mb", 1)
+    large = image + b"\0" * (1024 * 1024)
+    response = test_cli.post("/upload", files={"file": ("large.png", large)})
+    assert response.status_code == 413
+    response = test_cli.post("/upload/batch", files=[("files", ("large.png", large))])
+    assert "ImageTooLargeError" in json.loads(response.text)["error"]
+
+
+def test_metrics(test_cli, monkeypatch):
+    from app.infer import METRICS
+
+    monkeypatch.setattr(METRICS, "enabled", True)
+    image = pathlib.Path(__file__).parent.joinpath("test_src_01.png").read_bytes()
+    response = test_cli.post("/upload", files={"file": ("test_src_01.png", image)})
+    assert response.status_code == 200
+    text = test_cli.get("/metrics").text
+    for name in (
+        "wd_upload_read_seconds",
+        "wd_decode_seconds",
+        "wd_prepare_image_seconds",
+        "wd_model_run_seconds",
+        "wd_postprocess_seconds",
+    ):
+        assert f"{name}_count 0" not in text
+    assert "wd_model_load_seconds{model=" in text
+
+
+def test_readyz():
+    with TestClient(app) as client:
+        for _ in range(100):
+            response = client.get("/readyz")
+            if response.status_code == 200:
+                break
+            time.sleep(0.1)
+        assert response.status_code == 200
+        assert response.json()["ready"] is True
+
+
+def test_load_default_model_retries(test_cli, monkeypatch):
+    import app as app_package
+
+    client = app_package.INFER_APP
+    set_up = client.set_up
+    calls = []
+
+    def flaky_set_up(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise ConnectionError("hub unreachable")
+        return set_up(**kwargs)
+
+    monkeypatch.setattr(client, "model_path", None)
+    monkeypatch.setattr(client, "set_up", flaky_set_up)
+    monkeypatch.setattr(app_package, "LOAD_RETRY_DELAY", 0.01)
+    monkeypatch.setattr(app_package, "_stopping", threading.Event())
+    app_package._load_default_model()
+    assert len(calls) == 2
+    assert app_package._load_error is None
+    assert test_cli.get("/readyz").status_code == 200
+
+    # A request loading the default model makes the client ready too
+    monkeypatch.setattr(client, "model_path", None)
+    assert test_cli.get("/readyz").status_code == 503
+    image = pathlib.Path(__file__).parent.joinpath("test_src_01.png").read_bytes()
+    assert test_cli.post("/upload", files={"file": ("a.png", image)}).status_code == 200
+    assert test_cli.get("/readyz").status_code == 200
+
+
+def test_shutdown_stops_load_retries(monkeypatch):
+    import app as app_package
+
+    def failing_set_up(**kwargs):
+        raise ConnectionError("hub unreachable")
+
+    monkeypatch.setattr(app_package.INFER_APP, "model_path", None)
+    monkeypatch.setattr(app_package.INFER_APP, "set_up", failing_set_up)
+    monkeypatch.setattr(app_package, "LOAD_RETRY_DELAY", 60)
+    with TestClient(app) as client:
+        assert client.get("/readyz").status_code == 503
+    # Shutdown did not wait out the retry delay, and the retries ended
+    app_package._loader.join(timeout=5)
+    assert not app_package._loader.is_alive()
+
+
+def test_drain_rejects_new_work(test_cli, monkeypatch):
+    import app as app_package
+
+    monkeypatch.setattr(app_package, "_draining", threading.Event())
+    assert test_cli.get("/healthz").json()["draining"] is False
+    assert app_package.drain(timeout=1)
+    assert test_cli.get("/healthz").status_code == 200
+    response = test_cli.get("/readyz")
+    assert response.status_code == 503
+    assert response.json()["draining"] is True
+    image = pathlib.Path(__file__).parent.joinpath("test_src_01.png").read_bytes()
+    response = test_cli.post("/upload", files={"file": ("test_src_01.png", image)})
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+
+
+def test_admin_model_swap(test_cli, monkeypatch):
+    from app.settings import InferSettingCurrent
+
+    assert test_cli.get("/admin/model").status_code == 403
+    monkeypatch.setattr(InferSettingCurrent, "admin_token", "secret")
+    assert test_cli.get("/admin/model", params={"token": "secret"}).status_code == 401
+    wrong = {"Authorization": "Bearer wrong"}
+    assert test_cli.get("/admin/model", headers=wrong).status_code == 401
+    assert (
+        test_cli.get("/admin/model", headers={"X-Admin-Token": "secret"}).status_code
+        == 200
+    )
+    headers = {"Authorization": "Bearer secret"}
+    status = test_cli.get("/admin/model", headers=headers).json()
+    response = test_cli.post(
+        "/admin/model", params={"model_name": "not-a-model"}, headers=headers
+    )
+    assert response.status_code == 400
+
+    # Swapping to the current model only checks that it is loaded
+    response = test_cli.post(
+        "/admin/model", params={"model_name": status["model"]}, headers=headers
+    )
+    assert response.status_code == 202
+    for _ in range(100):
+        status = test_cli.get("/admin/model", headers=headers).json()
+        if status["swap"]["state"] == "done":
+            break
+        time.sleep(0.05)
+    assert status["swap"]["state"] == "done"
+    if status["previous"] is None:
+        response = test_cli.post("/admin/model/rollback", headers=headers)
+        assert response.status_code == 409
@@ -0,0 +1,77 @@
+import pytest
+
+from app.infer import Predictor
+from benchmarks.run import compare, encoded_image
+
+
+def test_compare_flags_regressions_past_threshold():
+    baseline = {"a": 1.0, "b": 1.0, "c": 1.0}
+    results = {"a": 1.1, "b": 1.3, "c": 0.5, "d": 9.0}
+    assert compare(results, baseline, threshold=0.2) == [("b", 1.0, 1.3)]
+
+
+def test_tiny_model_has_the_wd_layout(tmp_path):
+    pytest.importorskip("onnx")
+    from benchmarks.tiny_model import make_tiny_model
+
+    model_path, tag_csv_path = make_tiny_model(str(tmp_path), num_tags=100)
+    predictor = Predictor.load(model_path=model_path, tag_csv_path=tag_csv_path)
+    assert predictor.model_target_size == 448
+    assert predictor.rating_names == [
+        "general",
+        "sensitive",
+        "questionable",
+        "explicit",
+    ]
+    sorted_general_strings, rating, _, _ = predictor.predict(
+        encoded_image(64, 48, "RGB", "PNG"),
+        general_thresh=0.0,
+        general_mcut_enabled=False,
+        character_thresh=0.0,
+        character_mcut_enabled=False,
+    )
+    assert len(rating) == 4
+    assert len(sorted_general_strings.split(", ")) == len(predictor.general_names)
+
+
+def test_open_loop_reports_latency_and_errors():
+    import asyncio
+
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    from benchmarks.load import capacity, open_loop, parse_mix, summarize
+
+    calls = []
+
+    async def upload(request):
+        await request.read()
+        calls.append(request.path)
+        if len(calls) % 4 == 0:
+            raise web.HTTPServiceUnavailable()
+        await asyncio.sleep(0.01)
+        return web.json_response({})
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/upload", upload)
+        async with TestServer(app) as server:
+            return await open_loop(
+                str(server.make_url("")).rstrip("/"), [b"a", b"b"], [0.5, 0.5], 200, 0.5
+            )
+
+    results = asyncio.run(main())
+    step = summarize(results, 200, 0.5)
+    assert step["requests"] == len(calls) > 50
+    assert step["rejected"] == len(calls) // 4
+    assert step["error_rate"] == pytest.approx(step["rejected"] / step["requests"])
+    assert 10 <= step["p50_ms"] <= step["p95_ms"] <= step["p99_ms"]
+
+    steps = [
+        {"rate": 5, "p99_ms": 50, "error_rate": 0.0},
+        {"rate": 10, "p99_ms": 80, "error_rate": 0.0},
+        {"rate": 20, "p99_ms": 900, "error_rate": 0.0},
+        {"rate": 40, "p99_ms": 90, "error_rate": 0.2},
+    ]
+    assert capacity(steps, slo_ms=100, max_error_rate=0.01) == 10
+    assert parse_mix(["10x20=3", "30x40"]) == [(10, 20, 0.75), (30, 40, 0.25)]
@@ -0,0 +1,81 @@
+import json
+import pathlib
+import shutil
+import zipfile
+
+from app import INFER_APP
+from app.bulk import Checkpoint, JsonlWriter, iter_sources, tag_files
+
+TEST_IMAGE = pathlib.Path(__file__).parent.joinpath("test_src_01.png")
+
+
+def test_tag_files_resumes_from_checkpoint(tmp_path):
+    image_dir = tmp_path.joinpath("images")
+    image_dir.joinpath("nested").mkdir(parents=True)
+    for name in ("a.png", "b.png", "nested/c.png"):
+        shutil.copy(TEST_IMAGE, image_dir.joinpath(name))
+    image_dir.joinpath("broken.jpg").write_bytes(b"not an image")
+    output = tmp_path.joinpath("tags.jsonl")
+    checkpoint_path = str(tmp_path.joinpath("done.txt"))
+    predictor = INFER_APP.get_predictor()
+
+    def run():
+        checkpoint = Checkpoint(checkpoint_path)
+        writer = JsonlWriter(str(output))
+        try:
+            return tag_files(
+                iter_sources([str(image_dir)]),
+                predictor=predictor,
+                writer=writer,
+                checkpoint=checkpoint,
+                batch_size=2,
+                threads=2,
+            )
+        finally:
+            writer.close()
+            checkpoint.close()
+
+    assert run() == 3
+    assert run() == 0
+    lines = [json.loads(line) for line in output.read_text().splitlines()]
+    assert sorted(pathlib.Path(line["file"]).name for line in lines) == [
+        "a.png",
+        "b.png",
+        "c.png",
+    ]
+    assert all("general_res" in line for line in lines)
+
+
+def test_iter_sources_skips_without_reading(tmp_path):
+    shutil.copy(TEST_IMAGE, tmp_path.joinpath("a.png"))
+    archive = tmp_path.joinpath("more.zip")
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        zip_file.writestr("b.png", TEST_IMAGE.read_bytes())
+        zip_file.writestr("c.png", TEST_IMAGE.read_bytes())
+    # Opening the missing file would raise, skipping it must not try
+    missing = str(tmp_path.joinpath("missing.png"))
+    skip = {missing, f"{archive}::b.png"}
+    keys = [
+        key
+        for key, _ in iter_sources([str(tmp_path), str(archive), missing], skip=skip)
+    ]
+    assert keys == [str(tmp_path.joinpath("a.png")), f"{archive}::c.png"]
+
+
+def test_cli_client_uses_server_settings(monkeypatch):
+    import app.infer
+    from app.infer import OnnxRuntimeManager
+    from app.settings import InferSettingCurrent
+    from cli import _client
+
+    # Restored afterwards, configure sets these on the shared manager
+    for name in InferSettingCurrent.ort_options:
+        monkeypatch.setattr(OnnxRuntimeManager, name, getattr(OnnxRuntimeManager, name))
+    monkeypatch.setattr(InferSettingCurrent, "ort_intra_op_threads", 3)
+    monkeypatch.setattr(InferSettingCurrent, "ort_graph_optimization_level", "basic")
+    monkeypatch.setattr(InferSettingCurrent, "wd_model_precision", "int8")
+    # InferClient is a singleton, the app already built it in this process
+    monkeypatch.setattr(app.infer, "InferClient", lambda **kwargs: kwargs)
+    assert _client()["precision"] == "int8"
+    assert OnnxRuntimeManager.intra_op_threads == 3
+    assert OnnxRuntimeManager.graph_optimization_level == "basic"
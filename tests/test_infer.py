@@ -0,0 +1,559 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.infer import Predictor
+from app.infer.batch import BatchScheduler
+from app.infer.cache import ResultCache
+from app.infer.error import QueueFullError
+from app.infer.executor import InferExecutor
+from app.infer.load import RuntimeManager, cpu_fingerprint
+from app.infer.predictor import merge_tiles, prepare_image, tile_boxes
+from app.infer.preprocess import PreprocessPool
+from app.infer.quantize import ensure_precision, evaluate
+from app.infer.registry import ModelRegistry
+from app.infer.store import ProbabilityStore
+from app.settings import InferSettingCurrent
+from benchmarks.legacy import legacy_postprocess, legacy_prepare_image
+
+
+def test_executor_rejects_when_queue_full():
+    executor = InferExecutor(max_workers=1, max_queue_size=1)
+    release = threading.Event()
+
+    async def main():
+        running = [
+            asyncio.ensure_future(executor.submit(release.wait)) for _ in range(2)
+        ]
+        await asyncio.sleep(0.05)
+        assert executor.pending == 2
+        assert executor.queued == 1
+        with pytest.raises(QueueFullError):
+            await executor.submit(release.wait)
+        release.set()
+        await asyncio.gather(*running)
+        assert executor.pending == 0
+
+    asyncio.run(main())
+    executor.shutdown()
+
+
+def test_batch_scheduler_merges_concurrent_images():
+    executor = InferExecutor(max_workers=1, max_queue_size=8)
+    shapes = []
+
+    def run_batch(images):
+        shapes.append(images.shape[0])
+        return images.reshape(images.shape[0], -1)[:, :1] * 2
+
+    scheduler = BatchScheduler(
+        run_batch=run_batch, executor=executor, max_batch_size=4, max_wait_ms=50
+    )
+
+    async def main():
+        images = [np.full((1, 2, 2, 3), i, dtype=np.float32) for i in range(6)]
+        return await asyncio.gather(*[scheduler.submit(image) for image in images])
+
+    rows = asyncio.run(main())
+    assert [row[0] for row in rows] == [0, 2, 4, 6, 8, 10]
+    assert sum(shapes) == 6
+    assert max(shapes) == 4
+    assert scheduler.batch_sizes[4] == 1
+    executor.shutdown()
+
+
+def _random_predictor(num_tags=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    categories = rng.choice([0, 4], size=num_tags)
+    categories[:4] = 9
+    tag_names = [f"tag_{i}_(x)" for i in range(num_tags)]
+    predictor = Predictor(
+        model=None,
+        model_target_size=448,
+        tag_names=tag_names,
+        rating_indexes=list(np.where(categories == 9)[0]),
+        general_indexes=list(np.where(categories == 0)[0]),
+        character_indexes=list(np.where(categories == 4)[0]),
+    )
+    preds = rng.beta(0.3, 3, size=(6, num_tags)).astype(np.float32)
+    # Equal confidences must keep their csv order
+    preds[:, 10:20] = 0.9
+    return predictor, preds
+
+
+@pytest.mark.parametrize("general_mcut", [False, True])
+@pytest.mark.parametrize("character_mcut", [False, True])
+def test_postprocess_batch_matches_legacy(general_mcut, character_mcut):
+    predictor, preds = _random_predictor()
+    results = predictor.postprocess_batch(
+        preds,
+        general_thresh=0.35,
+        general_mcut_enabled=general_mcut,
+        character_thresh=0.85,
+        character_mcut_enabled=character_mcut,
+    )
+    for row, result in zip(preds, results):
+        expected = legacy_postprocess(
+            predictor.tag_names,
+            predictor.rating_indexes,
+            predictor.general_indexes,
+            predictor.character_indexes,
+            row,
+            general_thresh=0.35,
+            general_mcut_enabled=general_mcut,
+            character_thresh=0.85,
+            character_mcut_enabled=character_mcut,
+        )
+        assert json.dumps(result) == json.dumps(expected)
+
+
+def test_postprocess_batch_fields_and_top_k():
+    predictor, preds = _random_predictor()
+    kwargs = dict(
+        general_thresh=0.2,
+        general_mcut_enabled=False,
+        character_thresh=0.2,
+        character_mcut_enabled=False,
+    )
+    full = predictor.postprocess_batch(preds, **kwargs)
+    results = predictor.postprocess_batch(
+        preds, top_k=5, fields=("sorted_general_strings", "general_res"), **kwargs
+    )
+    for (strings, rating, character_res, general_res), expected in zip(results, full):
+        assert rating is None and character_res is None
+        top = sorted(expected[3].items(), key=lambda item: -item[1])[:5]
+        assert general_res == dict(top)
+        assert list(general_res) == [
+            name for name in expected[3] if name in general_res
+        ]
+        assert expected[0].startswith(strings)
+    _, _, character_res, _ = predictor.postprocess(
+        preds[0], top_k=2, fields=("character_res",), **kwargs
+    )
+    assert character_res == dict(
+        sorted(full[0][2].items(), key=lambda item: -item[1])[:2]
+    )
+
+
+@pytest.fixture
+def model_dir(tmp_path):
+    # Serve copies of the configured model under other names
+    for model_name in ("wd-vit-tagger-v3", "wd-convnext-tagger-v3"):
+        for suffix in (".onnx", ".csv"):
+            shutil.copy(
+                InferSettingCurrent.model_path.with_suffix(suffix),
+                tmp_path.joinpath(model_name + suffix),
+            )
+    return tmp_path
+
+
+def test_registry_loads_once_and_evicts_lru(model_dir):
+    executor = InferExecutor(max_workers=1, max_queue_size=8)
+    model_size = os.path.getsize(model_dir.joinpath("wd-vit-tagger-v3.onnx"))
+    registry = ModelRegistry(
+        executor=executor,
+        model_dir=str(model_dir),
+        skip_auto_download=True,
+        max_batch_size=2,
+    )
+    registry.memory_budget = model_size
+
+    async def main():
+        return await asyncio.gather(
+            *[registry.get("wd-vit-tagger-v3") for _ in range(4)]
+        )
+
+    entries = asyncio.run(main())
+    assert all(entry is entries[0] for entry in entries)
+    registry.load("wd-convnext-tagger-v3")
+    assert list(registry.entries) == ["wd-convnext-tagger-v3"]
+    executor.shutdown()
+
+
+def test_registry_unload_waits_for_requests(model_dir):
+    executor = InferExecutor(max_workers=1, max_queue_size=8)
+    registry = ModelRegistry(
+        executor=executor, model_dir=str(model_dir), skip_auto_download=True
+    )
+    entry = registry.load("wd-vit-tagger-v3", pin=True)
+    with entry.in_use():
+        assert registry.unload("wd-vit-tagger-v3", timeout=0.05) is False
+        assert "wd-vit-tagger-v3" not in registry.entries
+    assert entry.wait_idle(timeout=1)
+    assert registry.load("wd-vit-tagger-v3") is not entry
+    assert registry.unload("wd-vit-tagger-v3") is True
+    assert registry.entries == {}
+    executor.shutdown()
+
+
+def test_probability_store(tmp_path):
+    rng = np.random.default_rng(0)
+    preds = rng.random((5000, 16), dtype=np.float32)
+    store = ProbabilityStore(str(tmp_path), dtype="uint8", index_threshold=0.1)
+    for i, row in enumerate(preds):
+        store.put("model", f"image-{i}", row)
+    # Replacing a row drops its old postings
+    preds[3] = 0.0
+    preds[3, [2, 5]] = 0.9
+    store.put("model", "image-3", preds[3])
+    assert store.stats() == {"model": 5000}
+
+    ids, rows = store.get("model", ["image-4999", "missing", "image-3"])
+    assert ids == ["image-4999", "image-3"]
+    np.testing.assert_allclose(rows, preds[[4999, 3]], atol=0.5 / 255)
+
+    expected = np.flatnonzero(np.rint(preds[:, [2, 5]] * 255).min(axis=1) >= 204)
+    ids, probs = store.search("model", [2, 5], 0.8, limit=10000)
+    assert ids == [f"image-{i}" for i in expected]
+    assert (probs >= 0.8).all()
+    assert "image-3" in ids
+    ids, _ = store.search("model", [2, 5], 0.8, limit=2, offset=1)
+    assert ids == [f"image-{i}" for i in expected[1:3]]
+    # Off the 1/255 grid, 0.35 sits between levels 89 and 90
+    ids, probs = store.search("model", [2, 5], 0.35, limit=10000)
+    assert len(ids) and (probs >= 0.35).all()
+    expected = np.flatnonzero(np.rint(preds[:, [2, 5]] * 255).min(axis=1) >= 90)
+    assert ids == [f"image-{i}" for i in expected]
+    with pytest.raises(ValueError):
+        store.search("model", [2], 0.05)
+    store.close()
+
+    # Another process opening the store sees the same rows
+    store = ProbabilityStore(str(tmp_path))
+    assert store.get("model", ["image-0"])[0] == ["image-0"]
+    assert store.search("other", [0], 0.5)[0] == []
+    store.close()
+
+
+def test_result_cache_tiers(tmp_path):
+    disk_path = str(tmp_path.joinpath("cache.sqlite3"))
+    preds = np.linspace(0, 1, 100, dtype=np.float32)
+    cache = ResultCache(max_bytes=preds.nbytes * 2, disk_path=disk_path)
+    keys = [ResultCache.key(ResultCache.digest(bytes([i])), "m") for i in range(3)]
+    for key in keys:
+        cache.put(key, preds)
+    # Only the two most recent fit in memory, the oldest comes back from disk
+    assert cache.stats()["entries"] == 2
+    assert np.array_equal(cache.get(keys[2]), preds)
+    np.testing.assert_allclose(cache.get(keys[0]), preds, atol=1e-3)
+    assert cache.get(ResultCache.key("missing", "m")) is None
+    assert (cache.hits, cache.disk_hits, cache.misses) == (1, 1, 1)
+    cache.close()
+
+    reopened = ResultCache(max_bytes=preds.nbytes * 2, disk_path=disk_path)
+    np.testing.assert_allclose(reopened.get(keys[1]), preds, atol=1e-3)
+    reopened.close()
+
+
+def _encoded_image(width, height, mode, image_format):
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    array = np.stack(
+        [x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], -1
+    )
+    array = np.clip(array + rng.integers(-20, 20, array.shape), 0, 255)
+    image = Image.fromarray(array.astype(np.uint8))
+    if mode == "RGBA":
+        image.putalpha(Image.fromarray((x * 255 // width).astype(np.uint8)))
+    elif mode != "RGB":
+        image = image.convert(mode)
+    buffer = io.BytesIO()
+    image.save(buffer, image_format)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize(
+    "width,height,mode,image_format",
+    [
+        (3840, 2160, "RGB", "JPEG"),
+        (4000, 1000, "RGB", "JPEG"),
+        (1200, 1800, "RGBA", "PNG"),
+        (1024, 1024, "P", "PNG"),
+        (800, 600, "L", "JPEG"),
+        (300, 200, "RGB", "PNG"),
+        (448, 448, "RGB", "WEBP"),
+    ],
+)
+def test_prepare_image_matches_legacy(width, height, mode, image_format):
+    predictor, _ = _random_predictor()
+    data = _encoded_image(width, height, mode, image_format)
+    expected = legacy_prepare_image(Image.open(io.BytesIO(data)), 448)
+    out = np.zeros((1, 448, 448, 3), dtype=np.float32)
+    result = predictor.prepare_image(Image.open(io.BytesIO(data)), out=out)
+    assert result is out
+    diff = np.abs(result - expected)
+    assert diff.mean() < 1.0
+    assert np.percentile(diff, 99) <= 4.0
+
+
+@pytest.mark.parametrize("width,height", [(8000, 6000), (800, 20000), (1000, 400)])
+def test_tile_boxes_cover_the_image(width, height):
+    boxes = tile_boxes(width, height, 448, max_tiles=7)
+    assert 1 <= len(boxes) <= 7
+    covered = np.zeros((height, width), dtype=bool)
+    for left, upper, right, lower in boxes:
+        side = max(right - left, lower - upper)
+        assert 448 <= side < max(width, height)
+        covered[upper:lower, left:right] = True
+    assert covered.all()
+    assert tile_boxes(448, 300, 448, max_tiles=7) == []
+    assert tile_boxes(width, height, 448, max_tiles=0) == []
+
+
+def test_prepare_tiles():
+    predictor, _ = _random_predictor()
+    predictor.model_target_size = 64
+    image = Image.new("RGB", (64 * 6, 64), (255, 0, 0))
+    tiles = predictor.prepare_tiles(image, max_tiles=4)
+    assert tiles.shape == (4, 64, 64, 3)
+    np.testing.assert_array_equal(tiles[0], prepare_image(image, 64)[0])
+    # Crops of the strip are less wide, so less of them is white padding
+    red = (tiles[:, :, :, 2] == 255) & (tiles[:, :, :, 0] == 0)
+    assert (red[1:].mean(axis=(1, 2)) > 2 * red[0].mean()).all()
+    assert (
+        predictor.prepare_tiles(Image.new("RGB", (64, 32)), max_tiles=4).shape[0] == 1
+    )
+
+    preds = np.array([[0.1, 0.9], [0.5, 0.3]], dtype=np.float32)
+    np.testing.assert_allclose(merge_tiles(preds, "max"), [0.5, 0.9])
+    np.testing.assert_allclose(merge_tiles(preds, "mean"), [0.3, 0.6])
+
+
+def test_preprocess_pool_matches_in_process():
+    data = _encoded_image(1200, 900, "RGBA", "PNG")
+    pool = PreprocessPool(workers=2)
+    try:
+
+        async def main():
+            return await asyncio.gather(*[pool.prepare(data, 448) for _ in range(4)])
+
+        results = asyncio.run(main())
+    finally:
+        pool.shutdown()
+    expected = prepare_image(data, 448)
+    for result in results:
+        assert np.array_equal(result, expected)
+
+
+def test_runtime_manager_reuses_optimized_model(model_dir):
+    model_path = str(model_dir.joinpath("wd-vit-tagger-v3.onnx"))
+    images = np.full((1, 448, 448, 3), 128, dtype=np.float32)
+    first = RuntimeManager().configure(intra_op_threads=1, optimized_model_cache=True)
+    cache_path = first.optimized_model_path(model_path)
+    # Graphs saved at level all are tied to the instruction sets of the CPU
+    assert f".{cpu_fingerprint()}." in cache_path
+    session = first.get_runtime(model_path)
+    assert os.path.exists(cache_path)
+
+    second = RuntimeManager().configure(intra_op_threads=1, optimized_model_cache=True)
+    reloaded = second.get_runtime(model_path)
+    assert reloaded._model_path == cache_path
+    name = session.get_inputs()[0].name
+    np.testing.assert_allclose(
+        session.run(None, {name: images})[0], reloaded.run(None, {name: images})[0]
+    )
+
+
+def test_runtime_manager_shared_weights(tmp_path):
+    pytest.importorskip("onnx")
+    from benchmarks.tiny_model import make_tiny_model
+
+    model_path, _ = make_tiny_model(str(tmp_path), num_tags=1000)
+    images = np.full((1, 448, 448, 3), 128, dtype=np.float32)
+    plain = RuntimeManager().configure(intra_op_threads=1).get_runtime(model_path)
+    shared = RuntimeManager().configure(intra_op_threads=1, shared_weights=True)
+    cache_path = shared.optimized_model_path(model_path)
+    session = shared.get_runtime(model_path)
+    # Loaded from the saved graph, which keeps its weights in the mapped data file
+    assert session._model_path == cache_path
+    assert os.path.getsize(f"{cache_path}.data") >= 3 * 1000 * 4
+    name = session.get_inputs()[0].name
+    np.testing.assert_allclose(
+        plain.run(None, {name: images})[0],
+        session.run(None, {name: images})[0],
+        atol=1e-6,
+    )
+
+
+def test_int8_variant_is_created_and_evaluated(model_dir):
+    pytest.importorskip("onnx")
+    model_path = str(model_dir.joinpath("wd-vit-tagger-v3.onnx"))
+    tag_csv_path = str(model_dir.joinpath("wd-vit-tagger-v3.csv"))
+    int8_path = ensure_precision(model_path, "int8")
+    assert int8_path.endswith(".int8.onnx")
+    assert ensure_precision(model_path, "int8") == int8_path
+
+    reference = Predictor.load(model_path, tag_csv_path)
+    candidate = Predictor.load(int8_path, tag_csv_path)
+    images = [
+        (str(i), _encoded_image(320 + i * 64, 240, "RGB", "PNG")) for i in range(3)
+    ]
+    report = evaluate(reference, candidate, images, top_k=5, batch_size=2)
+    assert report["images"] == 3
+    assert 0.0 <= report["top5_agreement"] <= 1.0
+    assert report["rating_mean_abs_drift"] < 0.1
+
+
+def test_metrics_histogram():
+    from app.infer.metrics import Metrics
+
+    metrics = Metrics()
+    histogram = metrics.histogram("wd_test_seconds", "Test", buckets=(0.1, 1.0))
+    metrics.gauge("wd_test_loaded", "Test", lambda: {"a": 1, "b": 2}, label="model")
+    histogram.observe(0.05)
+    assert "wd_test_seconds_count 0" in metrics.render()
+
+    metrics.enabled = True
+    for value in (0.05, 0.5, 5.0):
+        histogram.observe(value)
+    with histogram.time():
+        pass
+    text = metrics.render()
+    assert 'wd_test_seconds_bucket{le="0.1"} 2' in text
+    assert 'wd_test_seconds_bucket{le="1.0"} 3' in text
+    assert 'wd_test_seconds_bucket{le="+Inf"} 4' in text
+    assert "wd_test_seconds_count 4" in text
+    assert 'wd_test_loaded{model="b"} 2.0' in text
+
+
+class _Hub(object):
+    """
+    Local stand-in for the hub: model files redirect to a storage route with their
+    sha256 as X-Linked-Etag, like LFS files do, and both routes take ranges
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.requests = []
+        self.fail_ranges = set()
+
+    def app(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_route(
+            "*", "/SmilingWolf/{model}/resolve/main/{file}", self.resolve
+        )
+        app.router.add_route("*", "/storage/{file}", self.storage)
+        return app
+
+    async def resolve(self, request):
+        from aiohttp import web
+
+        self.requests.append((request.method, request.headers.get("Range")))
+        path = self.root.joinpath(request.match_info["file"])
+        if path.suffix != ".onnx":
+            return web.FileResponse(path)
+        sha256 = hashlib.sha256(path.read_bytes()).hexdigest()
+        raise web.HTTPFound(
+            f"/storage/{path.name}", headers={"X-Linked-Etag": f'"{sha256}"'}
+        )
+
+    async def storage(self, request):
+        from aiohttp import web
+
+        self.requests.append((request.method, request.headers.get("Range")))
+        if request.headers.get("Range") in self.fail_ranges:
+            raise web.HTTPNotFound()
+        return web.FileResponse(self.root.joinpath(request.match_info["file"]))
+
+
+def _serve_hub(hub, func):
+    from aiohttp.test_utils import TestServer
+
+    async def main():
+        async with TestServer(hub.app()) as server:
+            return await func(str(server.make_url("")).rstrip("/"))
+
+    return asyncio.run(main())
+
+
+@pytest.fixture
+def hub(tmp_path):
+    root = tmp_path.joinpath("hub")
+    root.mkdir()
+    root.joinpath("model.onnx").write_bytes(os.urandom(1024 * 1024))
+    root.joinpath("selected_tags.csv").write_text("tag_id,name,category,count\n")
+    return _Hub(root)
+
+
+def test_download_model_files_caches_without_network(hub, tmp_path):
+    from app.infer.setup import download_model_files
+
+    model_dir = str(tmp_path.joinpath("models"))
+
+    def download(base_url):
+        return download_model_files("wd-vit-tagger-v3", model_dir, base_url=base_url)
+
+    model_path, tag_csv_path = _serve_hub(hub, download)
+    assert open(model_path, "rb").read() == hub.root.joinpath("model.onnx").read_bytes()
+    assert open(tag_csv_path).read() == "tag_id,name,category,count\n"
+
+    hub.requests.clear()
+    assert _serve_hub(hub, download) == (model_path, tag_csv_path)
+    assert hub.requests == []
+
+    # Files from before the metadata was kept are checked against the hub, not fetched
+    os.remove(f"{model_path}.download.json")
+    _serve_hub(hub, download)
+    assert [method for method, _ in hub.requests] == ["HEAD", "HEAD"]
+
+
+def test_concurrent_downloads_fetch_once(hub, tmp_path):
+    from app.infer.setup import download_model_files
+
+    model_dir = str(tmp_path.joinpath("models"))
+
+    async def download(base_url):
+        # Like the workers of SERVER_WORKERS starting together on a cold node
+        return await asyncio.gather(
+            *[
+                download_model_files("wd-vit-tagger-v3", model_dir, base_url=base_url)
+                for _ in range(3)
+            ]
+        )
+
+    paths = _serve_hub(hub, download)
+    assert len(set(paths)) == 1
+    model_path, _ = paths[0]
+    assert open(model_path, "rb").read() == hub.root.joinpath("model.onnx").read_bytes()
+    # The model from storage and the csv, once each
+    assert [method for method, _ in hub.requests].count("GET") == 2
+
+
+def test_download_file_resumes_chunks(hub, tmp_path):
+    from app.infer.error import DownloadError
+    from app.infer.setup import download_file, model_urls
+
+    model_dir = str(tmp_path)
+    chunk_size = 256 * 1024
+    hub.fail_ranges.add(f"bytes={2 * chunk_size}-{3 * chunk_size - 1}")
+
+    async def download(base_url):
+        model_url, _ = model_urls("wd-vit-tagger-v3", base_url)
+        return await download_file(
+            "model.onnx", model_url, model_dir, connections=2, chunk_size=chunk_size
+        )
+
+    with pytest.raises(DownloadError):
+        _serve_hub(hub, download)
+    with open(tmp_path.joinpath("model.onnx.part.json")) as f:
+        done = json.load(f)["done"]
+    assert 0 in done and 2 not in done
+
+    hub.fail_ranges.clear()
+    hub.requests.clear()
+    model_path = _serve_hub(hub, download)
+    assert open(model_path, "rb").read() == hub.root.joinpath("model.onnx").read_bytes()
+    assert ("GET", f"bytes={2 * chunk_size}-{3 * chunk_size - 1}") in hub.requests
+    # Only the chunks missing from the first attempt are fetched again
+    assert sum(method == "GET" for method, _ in hub.requests) == 4 - len(done)
+    assert not os.path.exists(f"{model_path}.part.json")
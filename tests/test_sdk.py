@@ -0,0 +1,173 @@
+import asyncio
+import json
+import pathlib
+import shutil
+import socket
+import threading
+import time
+import zipfile
+
+import httpx
+import pytest
+import uvicorn
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from sdk import WdTaggerSDK
+
+IMAGE = pathlib.Path(__file__).parent.joinpath("test_src_01.png")
+
+
+@pytest.fixture(scope="module")
+def server_url():
+    from app import app
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning"))
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]})
+    thread.start()
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/readyz").status_code == 200:
+                break
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    yield url
+    server.should_exit = True
+    thread.join()
+
+
+def _images(tmp_path, count):
+    paths = []
+    for i in range(count):
+        path = tmp_path.joinpath(f"{i}.png")
+        shutil.copy(IMAGE, path)
+        paths.append(str(path))
+    return paths
+
+
+def test_upload_many(server_url, tmp_path):
+    paths = _images(tmp_path, 5)
+    broken = tmp_path.joinpath("broken.png")
+    broken.write_bytes(b"not an image")
+    missing = str(tmp_path.joinpath("missing.png"))
+    archive = tmp_path.joinpath("images.zip")
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.write(paths[0], "a.png")
+        zf.write(paths[1], "b.png")
+
+    async def main():
+        async with WdTaggerSDK(server_url) as sdk:
+            single = await sdk.upload(paths[0], general_mcut_enabled=True)
+            results = [
+                item
+                async for item in sdk.upload_many(
+                    paths + [str(broken), missing, str(archive)],
+                    batch_size=2,
+                    concurrency=2,
+                )
+            ]
+        return single, dict(results)
+
+    single, results = asyncio.run(main())
+    assert "sorted_general_strings" in single
+    assert set(results) == set(paths) | {str(broken), missing, str(archive)}
+    assert all("sorted_general_strings" in results[path] for path in paths)
+    assert "error" in results[str(broken)]
+    # A missing file fails alone, its batch mate is still tagged
+    assert results[missing]["error"].startswith("FileNotFoundError")
+    # Archives expand to several lines, they are turned away instead of sent
+    assert results[str(archive)]["error"].startswith("ValueError")
+
+
+class _FlakyServer(object):
+    """
+    Turns away the first batch with 503, and reports a full queue for one image of
+    the second one
+    """
+
+    def __init__(self, batch: bool = True):
+        self.batch = batch
+        self.calls = []
+
+    def app(self):
+        app = web.Application()
+        if self.batch:
+            app.router.add_post("/upload/batch", self.upload_batch)
+        app.router.add_post("/upload", self.upload)
+        return app
+
+    async def upload_batch(self, request):
+        files = await _filenames(request)
+        self.calls.append(("batch", files))
+        if len(self.calls) == 1:
+            raise web.HTTPServiceUnavailable(headers={"Retry-After": "0"})
+        lines = []
+        for index, filename in enumerate(files):
+            line = {"index": index, "file": filename, "tags": filename}
+            if len(self.calls) == 2 and index == 1:
+                line = {
+                    "index": index,
+                    "file": filename,
+                    "error": "QueueFullError: full",
+                }
+            lines.append(json.dumps(line) + "\n")
+        return web.Response(text="".join(lines), content_type="application/x-ndjson")
+
+    async def upload(self, request):
+        files = await _filenames(request)
+        self.calls.append(("single", files))
+        return web.json_response({"tags": files[0]})
+
+
+async def _filenames(request) -> list:
+    reader = await request.multipart()
+    filenames = []
+    while True:
+        field = await reader.next()
+        if field is None:
+            return filenames
+        await field.read()
+        filenames.append(field.filename)
+
+
+def _run_flaky(flaky, paths):
+    async def main():
+        async with TestServer(flaky.app()) as server:
+            async with WdTaggerSDK(str(server.make_url("")), backoff=0) as sdk:
+                return dict(
+                    [item async for item in sdk.upload_many(paths, batch_size=2)]
+                )
+
+    return asyncio.run(main())
+
+
+def test_upload_many_retries(tmp_path):
+    paths = _images(tmp_path, 2)
+    flaky = _FlakyServer()
+    results = _run_flaky(flaky, paths)
+    assert {path: result["tags"] for path, result in results.items()} == {
+        paths[0]: "0.png",
+        paths[1]: "1.png",
+    }
+    # 503, then one image turned away by the full queue is sent again alone
+    assert flaky.calls == [
+        ("batch", ["0.png", "1.png"]),
+        ("batch", ["0.png", "1.png"]),
+        ("batch", ["1.png"]),
+    ]
+
+    # Servers without /upload/batch get one request per image
+    flaky = _FlakyServer(batch=False)
+    missing = str(tmp_path.joinpath("missing.png"))
+    results = _run_flaky(flaky, paths + [missing])
+    assert results.pop(missing)["error"].startswith("FileNotFoundError")
+    assert {path: result["tags"] for path, result in results.items()} == {
+        paths[0]: "0.png",
+        paths[1]: "1.png",
+    }
+    assert sorted(flaky.calls) == [("single", ["0.png"]), ("single", ["1.png"])]